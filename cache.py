@@ -0,0 +1,156 @@
+"""Content addressed file cache for pipeline inputs that are expensive to
+recreate. Lives outside the directories clean_all.sh empties"""
+
+from datetime import datetime
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+CACHE_DIR = f"{ROOT_DIR}/data/cache"
+
+GRIB_CACHE_BYTES = 20 * 1024**3
+GRIB_CACHE_AGE = 7 * 24 * 3600
+
+# Disk budget for ungribbed FILE:* intermediates, INTERMEDIATE_CACHE_GB overrides
+INTERMEDIATE_CACHE_BYTES = int(
+    float(os.environ.get("INTERMEDIATE_CACHE_GB", 10)) * 1024**3
+)
+INTERMEDIATE_CACHE_AGE = 7 * 24 * 3600
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def file_digest(fpath):
+    sha = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def link_or_copy(src, dest):
+    "Hard links src to dest, replacing dest. Copies across filesystems"
+    tmp = f"{dest}.tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+class FileCache:
+    """Stores one file per key along with a json metadata file holding the
+    key fields, size and sha256 of the data. Entries are evicted oldest
+    first once they exceed max_age seconds or the cache exceeds max_bytes"""
+
+    def __init__(self, cache_dir, max_bytes, max_age):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, **fields):
+        encoded = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def data_path(self, key):
+        return f"{self.cache_dir}/{key}.data"
+
+    def meta_path(self, key):
+        return f"{self.cache_dir}/{key}.json"
+
+    def read_meta(self, key):
+        try:
+            with open(self.meta_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def remove(self, key):
+        for fpath in (self.meta_path(key), self.data_path(key)):
+            if os.path.exists(fpath):
+                os.remove(fpath)
+
+    def is_intact(self, key, verify=True):
+        meta = self.read_meta(key)
+        data_path = self.data_path(key)
+        if meta is None or not os.path.exists(data_path):
+            return False
+        if os.path.getsize(data_path) != meta["size"]:
+            return False
+        return not verify or file_digest(data_path) == meta["sha256"]
+
+    def fetch(self, key, dest, verify=True):
+        """Links the cached file for key to dest. Returns False on a miss.
+        Entries failing the integrity check are dropped"""
+        if self.read_meta(key) is None:
+            return False
+
+        if not self.is_intact(key, verify=verify):
+            print("Dropping corrupt cache entry", key)
+            self.remove(key)
+            return False
+
+        link_or_copy(self.data_path(key), dest)
+        # meta mtime doubles as the last used time for eviction
+        os.utime(self.meta_path(key))
+        return True
+
+    def store(self, key, src, **fields):
+        "Adds src to the cache under key"
+        link_or_copy(src, self.data_path(key))
+
+        meta = {
+            "fields": fields,
+            "size": os.path.getsize(src),
+            "sha256": file_digest(src),
+            "created": datetime.utcnow().isoformat(),
+        }
+        tmp = f"{self.meta_path(key)}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f, default=str)
+        os.replace(tmp, self.meta_path(key))
+
+    def entries(self):
+        "(key, last used, size) of every entry"
+        entries = []
+        for meta_path in glob.glob(f"{self.cache_dir}/*.json"):
+            key = os.path.basename(meta_path)[: -len(".json")]
+            data_path = self.data_path(key)
+            if not os.path.exists(data_path):
+                self.remove(key)
+                continue
+            entries.append(
+                (key, os.path.getmtime(meta_path), os.path.getsize(data_path))
+            )
+        return entries
+
+    def evict(self):
+        "Drops expired entries then least recently used ones until under budget"
+        now = time.time()
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+
+        total = sum(size for _, _, size in entries)
+        for key, last_used, size in entries:
+            if now - last_used > self.max_age or total > self.max_bytes:
+                self.remove(key)
+                total -= size
+
+        return total
+
+
+def grib_cache():
+    return FileCache(f"{CACHE_DIR}/grib", GRIB_CACHE_BYTES, GRIB_CACHE_AGE)
+
+
+def intermediate_cache():
+    return FileCache(
+        f"{CACHE_DIR}/intermediate", INTERMEDIATE_CACHE_BYTES, INTERMEDIATE_CACHE_AGE
+    )
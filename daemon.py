@@ -0,0 +1,224 @@
+"""Long running service replacing run_full_pipeline.sh's fresh processes per
+cycle. It polls NOMADS for new GFS cycles, runs each forecast in process and
+hands the diag files to a pool of plot workers started once, with cartopy,
+metpy and scipy imported and the mesh geometry loaded. Each hour is drawn as
+soon as the model closes its diag file, on cores the model leaves free"""
+
+import argparse
+import concurrent.futures
+import multiprocessing as mp
+import os
+import subprocess
+import time
+
+import diag_watcher
+import manifest
+import mesh
+import nomads
+import plot_raw
+import run_mpas
+import workspace
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+POLL_SECONDS = 5 * 60
+PLOT_WORKERS = 2
+# Runs of a failing cycle before waiting for the next one
+CYCLE_ATTEMPTS = 2
+
+
+def last_finished_cycle(domain_name):
+    "Init date of the domain's last run whose model stage finished, else None"
+    stages = manifest.Manifest(manifest.manifest_path(domain_name))
+    if "model" not in stages.data["stages"]:
+        return None
+    return stages.init_date
+
+
+def plot_cpus(n_workers):
+    """The last n_workers cores this process may use. MPI ranks bind from
+    the first core up"""
+    cpus = sorted(os.sched_getaffinity(0))
+    return cpus[-n_workers:] if n_workers < len(cpus) else None
+
+
+class Daemon:
+    """Runs every new cycle of one domain and plots it on warm workers.
+    run_options are passed on to run_mpas.main, limited_area defaults to
+    whether the mesh has boundary cells"""
+
+    def __init__(
+        self,
+        domain_name,
+        resolution_km,
+        flength,
+        plot_workers=PLOT_WORKERS,
+        downscale_file="15km-800m-downscale.nc",
+        publish_cmd=None,
+        **run_options,
+    ):
+        self.domain_name = domain_name
+        self.resolution_km = resolution_km
+        self.flength = flength
+        self.plot_workers = plot_workers
+        self.downscale_file = downscale_file
+        self.publish_cmd = publish_cmd
+        self.run_options = run_options
+        if run_options.get("limited_area") is None:
+            run_options["limited_area"] = mesh.is_limited_area(
+                workspace.static_path(domain_name)
+            )
+        self.product = run_mpas.gfs_product(resolution_km, run_options["limited_area"])
+        self.products = plot_raw.product_names(os.path.exists(downscale_file))
+        self.last_cycle = last_finished_cycle(domain_name)
+        self.failures = {}
+
+    def run_dir(self, init_date):
+        if self.run_options.get("use_workspace"):
+            return workspace.Workspace(self.domain_name, init_date).path
+        return run_mpas.MPAS_DIR
+
+    def products_dir(self, init_date):
+        if self.run_options.get("use_workspace"):
+            return workspace.Workspace(self.domain_name, init_date).products_dir()
+        return workspace.PRODUCTS_DIR
+
+    def run_forecast(self):
+        """Runs the newest cycle through run_mpas. Returns its init date,
+        None if it failed"""
+        try:
+            return run_mpas.main(
+                domain_name=self.domain_name,
+                resolution_km=self.resolution_km,
+                flength=self.flength,
+                discover=True,
+                plot_cores=self.plot_workers,
+                **self.run_options,
+            )
+        except Exception as e:
+            print("Forecast failed:", str(e))
+            return None
+
+    def run_cycle(self, pool, newest):
+        """Runs the forecast in a thread while the main thread draws each
+        hour it writes. Returns the cycle's init date, None if it failed"""
+        watcher = diag_watcher.DiagWatcher(self.run_dir(newest), newest, self.flength)
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            forecast = executor.submit(self.run_forecast)
+            results = plot_raw.render_live(
+                pool,
+                watcher,
+                lambda: not forecast.done(),
+                self.products_dir(newest),
+                self.domain_name,
+                self.products,
+            )
+            init_date = forecast.result()
+
+        if init_date is not None and init_date != newest:
+            # A newer cycle came out before run_mpas looked, draw its files
+            watcher = diag_watcher.DiagWatcher(
+                self.run_dir(init_date), init_date, self.flength
+            )
+            for diag_file in watcher.leftover(self.products_dir(init_date)):
+                results += plot_raw.queue_products(
+                    pool, diag_file, self.domain_name, self.products
+                )
+        for result in results:
+            result.wait()
+        return init_date
+
+    def publish(self):
+        if self.publish_cmd:
+            subprocess.call(self.publish_cmd, shell=True, cwd=ROOT_DIR)
+
+    def serve(self, poll_seconds=POLL_SECONDS):
+        # Workers fork before any forecast threads exist and stay up
+        with mp.Pool(
+            self.plot_workers,
+            initializer=plot_raw.init_worker,
+            initargs=(
+                workspace.static_path(self.domain_name),
+                self.downscale_file,
+                plot_cpus(self.plot_workers),
+            ),
+        ) as pool:
+            while True:
+                try:
+                    newest, _ = nomads.discover_latest_cycle(self.product)
+                except RuntimeError as e:
+                    print(str(e))
+                    newest = None
+
+                if (
+                    newest is not None
+                    and newest != self.last_cycle
+                    and self.failures.get(newest, 0) < CYCLE_ATTEMPTS
+                ):
+                    init_date = self.run_cycle(pool, newest)
+                    if init_date is None:
+                        self.failures[newest] = self.failures.get(newest, 0) + 1
+                    else:
+                        self.publish()
+                        self.last_cycle = init_date
+                time.sleep(poll_seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default="colorado12km")
+    parser.add_argument("--resolution", type=int, default=12)
+    parser.add_argument("--length", type=int, default=24, help="Forecast hours")
+    parser.add_argument(
+        "--plot-workers",
+        type=int,
+        default=PLOT_WORKERS,
+        help="Plot processes kept running, and cores the model leaves them",
+    )
+    parser.add_argument(
+        "--downscale-file",
+        type=str,
+        default="15km-800m-downscale.nc",
+        help="Precip downscale ratio file",
+    )
+    parser.add_argument(
+        "--publish-cmd",
+        type=str,
+        default=None,
+        help="Shell command run after each cycle's plots, e.g. an scp",
+    )
+    parser.add_argument(
+        "--limited-area",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Run with boundary conditions, by default if the mesh has boundary cells",
+    )
+    parser.add_argument("--workspace", action="store_true")
+    parser.add_argument("--python-ungrib", action="store_true")
+    parser.add_argument("--lbc-chunks", type=int, default=0)
+    parser.add_argument(
+        "--on-deadline", choices=("shorten", "refuse", "ignore"), default="shorten"
+    )
+    parser.add_argument(
+        "--poll-minutes",
+        type=float,
+        default=POLL_SECONDS / 60,
+        help="How often NOMADS is checked for a new cycle",
+    )
+    args = parser.parse_args()
+
+    # The plots write to products/images relative to the working directory
+    os.chdir(ROOT_DIR)
+    Daemon(
+        args.domain,
+        args.resolution,
+        args.length,
+        plot_workers=args.plot_workers,
+        downscale_file=args.downscale_file,
+        publish_cmd=args.publish_cmd,
+        limited_area=args.limited_area,
+        use_workspace=args.workspace,
+        python_ungrib=args.python_ungrib,
+        lbc_chunks=args.lbc_chunks,
+        on_deadline=args.on_deadline,
+    ).serve(args.poll_minutes * 60)
@@ -0,0 +1,160 @@
+"""Chooses the MPI rank count for a mesh and makes sure its METIS graph
+partition exists. Partitions are cached per (mesh, rank count) and
+strong scaling runs record which rank count ran fastest"""
+
+import glob
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import xarray as xr
+
+import cache
+import workspace
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+MPAS_DIR = f"{ROOT_DIR}/MPAS-Model"
+METIS_DIR = f"{ROOT_DIR}/tools/metis-5.1.0"
+REPORTS_DIR = f"{ROOT_DIR}/data/reports"
+
+# Below this many cells per rank halo exchanges outweigh the extra cores
+CELLS_PER_RANK = 2000
+
+PARTITION_CACHE_BYTES = 1024**3
+PARTITION_CACHE_AGE = 90 * 24 * 3600
+
+
+def partition_cache():
+    return cache.FileCache(
+        f"{cache.CACHE_DIR}/partitions", PARTITION_CACHE_BYTES, PARTITION_CACHE_AGE
+    )
+
+
+def mesh_cells(domain_name):
+    with xr.open_dataset(workspace.static_path(domain_name)) as ds:
+        return ds.sizes["nCells"]
+
+
+def graph_path(domain_name, run_dir=MPAS_DIR):
+    "The domain's graph.info, None if there isn't one"
+    for directory in (run_dir, MPAS_DIR, workspace.STATIC_DIR):
+        fpath = f"{directory}/{domain_name}.graph.info"
+        if os.path.exists(fpath):
+            return fpath
+    return None
+
+
+def gpmetis():
+    "gpmetis built by scripts/tools/metis.sh, else from PATH"
+    built = glob.glob(f"{METIS_DIR}/build/*/programs/gpmetis")
+    return built[0] if built else shutil.which("gpmetis")
+
+
+def available_ranks(domain_name, budget, run_dir=MPAS_DIR):
+    """Most ranks up to budget that already have a graph.info.part file"""
+    for ranks in range(max(1, budget), 1, -1):
+        if os.path.exists(f"{run_dir}/{domain_name}.graph.info.part.{ranks}"):
+            return ranks
+    return 1
+
+
+def choose_ranks(n_cells, cores, cells_per_rank=CELLS_PER_RANK):
+    return max(1, min(cores, n_cells // cells_per_rank))
+
+
+def run_gpmetis(graph, nparts, dest):
+    "Partitions graph into nparts with gpmetis, writing the result to dest"
+    with tempfile.TemporaryDirectory() as tmp:
+        local_graph = f"{tmp}/graph.info"
+        shutil.copyfile(graph, local_graph)
+        subprocess.check_call(
+            [gpmetis(), "-minconn", "-contig", "-niter=200", local_graph, str(nparts)],
+            stdout=subprocess.DEVNULL,
+        )
+        shutil.move(f"{local_graph}.part.{nparts}", dest)
+
+
+def ensure_partition(domain_name, nparts, run_dir=MPAS_DIR):
+    """Makes {domain}.graph.info.part.{nparts} in run_dir from the cache or
+    gpmetis. Returns False when neither can provide it"""
+    dest = f"{run_dir}/{domain_name}.graph.info.part.{nparts}"
+    if nparts == 1 or os.path.exists(dest):
+        return True
+
+    graph = graph_path(domain_name, run_dir)
+    if graph is None:
+        return False
+
+    partitions = partition_cache()
+    fields = {"mesh_sha256": cache.file_digest(graph), "nparts": nparts}
+    key = partitions.key(**fields)
+    if partitions.fetch(key, dest):
+        print("Cached", os.path.basename(dest))
+        return True
+
+    if gpmetis() is None:
+        print("gpmetis not found, run scripts/tools/metis.sh")
+        return False
+
+    print("Partitioning", domain_name, "into", nparts)
+    run_gpmetis(graph, nparts, dest)
+    partitions.store(key, dest, domain=domain_name, **fields)
+    partitions.evict()
+    return True
+
+
+def scaling_report_path(domain_name):
+    return f"{REPORTS_DIR}/scaling.{domain_name}.json"
+
+
+def read_scaling(domain_name):
+    "{mesh sha256: {ranks: best seconds}} from earlier strong scaling runs"
+    try:
+        with open(scaling_report_path(domain_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_scaling(domain_name, mesh_sha256, ranks, seconds):
+    "Keeps the fastest time to solution seen for each rank count"
+    report = read_scaling(domain_name)
+    runs = report.setdefault(mesh_sha256, {})
+    best = runs.get(str(ranks))
+    if best is None or seconds < best:
+        runs[str(ranks)] = seconds
+
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    with open(scaling_report_path(domain_name), "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def fastest_ranks(domain_name, mesh_sha256, cores):
+    "Rank count with the best recorded time that fits in cores, else None"
+    runs = read_scaling(domain_name).get(mesh_sha256, {})
+    fitting = {int(n): seconds for n, seconds in runs.items() if int(n) <= cores}
+    if not fitting:
+        return None
+    return min(fitting, key=fitting.get)
+
+
+def decompose(domain_name, cores, run_dir=MPAS_DIR):
+    """Rank count for the domain on this many cores, with its partition in
+    run_dir. A strong scaling result for the mesh wins over the cells per
+    rank target. Falls back to existing partitions if one can't be made"""
+    ranks = choose_ranks(mesh_cells(domain_name), cores)
+
+    graph = graph_path(domain_name, run_dir)
+    if graph is not None:
+        fastest = fastest_ranks(domain_name, cache.file_digest(graph), cores)
+        if fastest is not None:
+            ranks = fastest
+
+    if not ensure_partition(domain_name, ranks, run_dir):
+        ranks = available_ranks(domain_name, ranks, run_dir)
+
+    print(f"{domain_name}: {ranks} ranks on {cores} cores")
+    return ranks
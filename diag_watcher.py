@@ -0,0 +1,149 @@
+"""Follows the diag files atmosphere_model writes into its run directory and
+reports each one once MPAS has closed it, so its products can be drawn while
+later hours are still integrating"""
+
+from datetime import datetime, timedelta
+import glob
+import os
+import shutil
+import time
+
+import supervisor
+
+POLL_SECONDS = 10
+# How long watch() waits for the model to start before giving up
+STARTUP_SECONDS = 60 * 60
+DIAG_DATE_FORMAT = "diag.%Y-%m-%d_%H.%M.%S.nc"
+# Written by run_mpas.run_mpas_script for the model stage
+PROGRESS_NAME = "progress.model.json"
+
+
+def diag_valid_date(fpath):
+    "Valid time in a diag file's name, None for other files"
+    try:
+        return datetime.strptime(os.path.basename(fpath), DIAG_DATE_FORMAT)
+    except ValueError:
+        return None
+
+
+def publish(fpath, products_dir):
+    """Copies a completed diag file into products_dir under its own name.
+    The move after the model finishes then replaces it with the same file"""
+    os.makedirs(products_dir, exist_ok=True)
+    dest = f"{products_dir}/{os.path.basename(fpath)}"
+    tmp = f"{products_dir}/.{os.path.basename(fpath)}.tmp"
+    shutil.copyfile(fpath, tmp)
+    os.replace(tmp, dest)
+    return dest
+
+
+class DiagWatcher:
+    """Completed diag files of the forecast from init_date in run_dir. A file
+    is complete once the model log has stepped to its valid time and its
+    size held still between two polls, or once the model exited cleanly.
+    startup_timeout: Seconds after which model_running() gives up on a
+    model that has not started"""
+
+    def __init__(self, run_dir, init_date, flength, startup_timeout=None):
+        self.run_dir = run_dir
+        self.init_date = init_date
+        self.end_date = init_date + timedelta(hours=flength)
+        self.startup_timeout = startup_timeout
+        self.started = time.time()
+        self.sizes = {}
+        # Valid dates already reported
+        self.done = set()
+
+    def of_forecast(self, progress):
+        "True if the progress is of a model run from this forecast's init date"
+        return progress.get("start_date") == self.init_date.isoformat()
+
+    def progress(self):
+        """The model's progress, None before this run's model has started.
+        A model that exited before the watcher started counts if it ran
+        this forecast"""
+        fpath = f"{self.run_dir}/{PROGRESS_NAME}"
+        progress = supervisor.read_progress(fpath)
+        if progress is None:
+            return None
+        try:
+            stale = os.path.getmtime(fpath) < self.started
+        except OSError:
+            return None
+        if stale and progress["status"] != "running" and not self.of_forecast(progress):
+            return None
+        return progress
+
+    def model_running(self):
+        """True until this run's model has exited, or until startup_timeout
+        if it never starts"""
+        progress = self.progress()
+        if progress is not None:
+            return progress["status"] == "running"
+        waited = time.time() - self.started
+        if self.startup_timeout is not None and waited > self.startup_timeout:
+            print(f"No model started in {self.run_dir} after {waited / 60:.0f} min")
+            return False
+        return True
+
+    def poll(self):
+        "Diag files completed since the last poll, oldest first"
+        progress = self.progress()
+        if progress is None:
+            return []
+        finished = progress["status"] == "done"
+        reached = progress["model_time"] and datetime.fromisoformat(
+            progress["model_time"]
+        )
+
+        complete = []
+        for fpath in sorted(glob.glob(f"{self.run_dir}/diag.*.nc")):
+            valid_date = diag_valid_date(fpath)
+            if valid_date is None or valid_date in self.done:
+                continue
+            if not self.init_date <= valid_date <= self.end_date:
+                continue
+            try:
+                size = os.path.getsize(fpath)
+            except OSError:
+                # Moved to the products directory after the model finished
+                continue
+            if size == 0:
+                continue
+            stable = self.sizes.get(fpath) == size
+            self.sizes[fpath] = size
+            if finished or (stable and reached and reached >= valid_date):
+                self.done.add(valid_date)
+                complete.append(fpath)
+        return complete
+
+    def _publish(self, fpaths, products_dir):
+        for fpath in fpaths:
+            try:
+                yield publish(fpath, products_dir)
+            except OSError:
+                # Moved by the pipeline meanwhile, leftover() finds it
+                self.done.discard(diag_valid_date(fpath))
+
+    def follow(self, running, products_dir, poll_seconds=POLL_SECONDS):
+        """Publishes each completed diag file to products_dir and yields its
+        path there while running() is True, then the rest of the forecast's
+        files once it stopped"""
+        while running():
+            yield from self._publish(self.poll(), products_dir)
+            time.sleep(poll_seconds)
+        yield from self._publish(self.poll(), products_dir)
+        yield from self.leftover(products_dir)
+
+    def leftover(self, products_dir):
+        """Diag files of the forecast already moved to products_dir that no
+        poll reported, e.g. the last hour"""
+        fpaths = []
+        for fpath in sorted(glob.glob(f"{products_dir}/diag.*.nc")):
+            valid_date = diag_valid_date(fpath)
+            if valid_date is None or valid_date in self.done:
+                continue
+            if self.init_date <= valid_date <= self.end_date:
+                self.done.add(valid_date)
+                fpaths.append(fpath)
+        return fpaths
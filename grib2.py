@@ -0,0 +1,344 @@
+"""Minimal GRIB2 decoder for the GFS pgrb2 products.
+
+Handles lat/lon grids (template 3.0), instantaneous products (template 4.0)
+and simple or complex packing with spatial differencing (templates 5.0, 5.2
+and 5.3), which is everything the Vtable.GFS fields in the NCEP files use.
+Bit unpacking and the spatial differencing are vectorized with NumPy"""
+
+from datetime import datetime, timedelta
+import struct
+
+import numpy as np
+
+SIMPLE_PACKING = 0
+COMPLEX_PACKING = 2
+COMPLEX_PACKING_SPATIAL_DIFF = 3
+LATLON_GRID = 0
+BITMAP_PRESENT = 0
+BITMAP_PREVIOUS = 254
+NO_BITMAP = 255
+
+# Seconds per forecast time unit (code table 4.4)
+TIME_UNITS = {0: 60, 1: 3600, 2: 86400, 10: 3 * 3600, 11: 6 * 3600, 12: 12 * 3600}
+
+# Values per call to _unpack_bits, keeps the gather buffer small
+UNPACK_CHUNK = 1 << 20
+
+
+class GribError(ValueError):
+    pass
+
+
+def _signed(value, nbits):
+    "GRIB2 signed integers store a sign bit instead of two's complement"
+    sign_bit = 1 << (nbits - 1)
+    if value & sign_bit:
+        return -(value & (sign_bit - 1))
+    return value
+
+
+def _uint(buf, start, size):
+    "Unsigned big endian integer from 1 based GRIB octet positions"
+    return int.from_bytes(buf[start - 1 : start - 1 + size], "big")
+
+
+def _int(buf, start, size):
+    return _signed(_uint(buf, start, size), size * 8)
+
+
+def _float(buf, start):
+    return struct.unpack(">f", buf[start - 1 : start + 3])[0]
+
+
+class Field:
+    """One product of a GRIB2 message with the sections needed to decode it.
+    Section buffers include their 5 octet headers so octet numbers match the
+    WMO tables"""
+
+    def __init__(
+        self, discipline, section1, section3, section4, section5, bitmap, section7
+    ):
+        self.discipline = discipline
+        self.section1 = section1
+        self.section3 = section3
+        self.section4 = section4
+        self.section5 = section5
+        self.bitmap = bitmap
+        self.section7 = section7
+
+    @property
+    def product_template(self):
+        return _uint(self.section4, 8, 2)
+
+    @property
+    def code(self):
+        return (self.discipline, self.section4[9], self.section4[10])
+
+    def reference_time(self):
+        s1 = self.section1
+        return datetime(_uint(s1, 13, 2), s1[14], s1[15], s1[16], s1[17], s1[18])
+
+    def valid_time(self):
+        "Reference time plus the forecast time of a template 4.0 product"
+        unit = self.section4[17]
+        if unit not in TIME_UNITS:
+            raise GribError(f"Forecast time unit {unit} not supported")
+        seconds = _uint(self.section4, 19, 4) * TIME_UNITS[unit]
+        return self.reference_time() + timedelta(seconds=seconds)
+
+    def _surface(self, octet):
+        level_type = self.section4[octet - 1]
+        scale = _signed(self.section4[octet], 8)
+        value = _uint(self.section4, octet + 2, 4)
+        if level_type == 255 or value == 0xFFFFFFFF:
+            return level_type, None
+        return level_type, _signed(value, 32) / 10**scale
+
+    @property
+    def first_surface(self):
+        return self._surface(23)
+
+    @property
+    def second_surface(self):
+        return self._surface(29)
+
+    def grid(self):
+        """(ni, nj, lat1, lon1, lat2, lon2, di, dj, scan mode) of a lat/lon
+        grid, angles in degrees"""
+        s3 = self.section3
+        template = _uint(s3, 13, 2)
+        if template != LATLON_GRID:
+            raise GribError(f"Grid template 3.{template} not supported")
+
+        ni = _uint(s3, 31, 4)
+        nj = _uint(s3, 35, 4)
+        lat1 = _int(s3, 47, 4) / 1e6
+        lon1 = _int(s3, 51, 4) / 1e6
+        lat2 = _int(s3, 56, 4) / 1e6
+        lon2 = _int(s3, 60, 4) / 1e6
+        di = _uint(s3, 64, 4) / 1e6
+        dj = _uint(s3, 68, 4) / 1e6
+        scan_mode = s3[71]
+        return ni, nj, lat1, lon1, lat2, lon2, di, dj, scan_mode
+
+    def values(self):
+        """Decodes the field to a float32 (nj, ni) array ordered south to north
+        and west to east. Points masked by the bitmap are NaN"""
+        ni, nj, _, _, _, _, _, _, scan_mode = self.grid()
+        n_points = _uint(self.section3, 7, 4)
+
+        packed = decode_values(self.section5, self.section7)
+
+        if self.bitmap is not None:
+            mask = np.unpackbits(np.frombuffer(self.bitmap, dtype=np.uint8))
+            mask = mask[:n_points].astype(bool)
+            data = np.full(n_points, np.nan, dtype=np.float32)
+            data[mask] = packed
+        else:
+            data = packed
+
+        if scan_mode & 0x10:
+            raise GribError("Boustrophedonic scanning not supported")
+        if scan_mode & 0x20:
+            data = data.reshape(ni, nj).T
+        else:
+            data = data.reshape(nj, ni)
+        if scan_mode & 0x80:
+            data = data[:, ::-1]
+        if not scan_mode & 0x40:
+            data = data[::-1, :]
+
+        return np.ascontiguousarray(data)
+
+
+def fields(fpath):
+    "Yields every Field in a GRIB2 file"
+    with open(fpath, "rb") as f:
+        buf = f.read()
+
+    offset = 0
+    while offset < len(buf):
+        if buf[offset : offset + 4] != b"GRIB":
+            raise GribError(f"No GRIB header at byte {offset}")
+        discipline = buf[offset + 6]
+        (length,) = struct.unpack(">Q", buf[offset + 8 : offset + 16])
+        end = offset + length
+
+        section1 = section3 = section4 = section5 = bitmap = None
+        pos = offset + 16
+        while pos < end - 4:
+            (section_length,) = struct.unpack(">I", buf[pos : pos + 4])
+            number = buf[pos + 4]
+            section = buf[pos : pos + section_length]
+
+            if number == 1:
+                section1 = section
+            elif number == 3:
+                section3 = section
+            elif number == 4:
+                section4 = section
+            elif number == 5:
+                section5 = section
+            elif number == 6:
+                indicator = section[5]
+                if indicator == BITMAP_PRESENT:
+                    bitmap = section[6:]
+                elif indicator == NO_BITMAP:
+                    bitmap = None
+                elif indicator != BITMAP_PREVIOUS:
+                    raise GribError(f"Predefined bitmap {indicator} not supported")
+            elif number == 7:
+                yield Field(
+                    discipline, section1, section3, section4, section5, bitmap, section
+                )
+
+            pos += section_length
+
+        offset = end
+
+
+def _unpack_bits(data, bit_offsets, widths):
+    "Vectorized read of unsigned integers of up to 57 bits at any bit offset"
+    out = np.zeros(len(bit_offsets), dtype=np.uint64)
+    widths = np.broadcast_to(np.asarray(widths, dtype=np.int64), bit_offsets.shape)
+    byte_shifts = np.arange(56, -8, -8, dtype=np.uint64)
+
+    for start in range(0, len(bit_offsets), UNPACK_CHUNK):
+        stop = start + UNPACK_CHUNK
+        offsets = bit_offsets[start:stop]
+        width = widths[start:stop]
+
+        index = (offsets >> 3)[:, None] + np.arange(8)
+        words = data[index].astype(np.uint64) << byte_shifts
+        words = np.bitwise_or.reduce(words, axis=1)
+        words <<= (offsets & 7).astype(np.uint64)
+
+        nonzero = width > 0
+        shifts = (64 - width[nonzero]).astype(np.uint64)
+        out[start:stop][nonzero] = words[nonzero] >> shifts
+
+    return out
+
+
+def _padded(data):
+    "Pads so the 8 byte gather never reads past the end"
+    return np.frombuffer(bytes(data) + b"\0" * 8, dtype=np.uint8)
+
+
+def _unpack_fixed(data, bit_start, count, width):
+    if width == 0:
+        return np.zeros(count, dtype=np.uint64)
+    offsets = bit_start + np.arange(count, dtype=np.int64) * width
+    return _unpack_bits(data, offsets, width)
+
+
+def _octet_align(bits):
+    return -(-bits // 8) * 8
+
+
+def _scale(s5, x):
+    reference = _float(s5, 12)
+    binary_scale = _int(s5, 16, 2)
+    decimal_scale = _int(s5, 18, 2)
+    values = reference + x.astype(np.float64) * 2.0**binary_scale
+    return (values / 10.0**decimal_scale).astype(np.float32)
+
+
+def _decode_simple(s5, payload):
+    n_values = _uint(s5, 6, 4)
+    nbits = s5[19]
+    x = _unpack_fixed(payload, 0, n_values, nbits)
+    return _scale(s5, x)
+
+
+def _decode_complex(s5, payload, template):
+    n_values = _uint(s5, 6, 4)
+    ref_bits = s5[19]
+    missing_management = s5[22]
+    n_groups = _uint(s5, 32, 4)
+    width_reference = s5[35]
+    width_bits = s5[36]
+    length_reference = _uint(s5, 38, 4)
+    length_increment = s5[41]
+    last_length = _uint(s5, 43, 4)
+    length_bits = s5[46]
+
+    bit = 0
+    if template == COMPLEX_PACKING_SPATIAL_DIFF:
+        order = s5[47]
+        extra_octets = s5[48]
+        descriptors = []
+        for i in range(order + 1):
+            raw = bytes(payload[i * extra_octets : (i + 1) * extra_octets])
+            descriptors.append(_signed(int.from_bytes(raw, "big"), extra_octets * 8))
+        initial, minimum = descriptors[:order], descriptors[order]
+        bit = (order + 1) * extra_octets * 8
+
+    refs = _unpack_fixed(payload, bit, n_groups, ref_bits).astype(np.int64)
+    bit = _octet_align(bit + n_groups * ref_bits)
+    widths = _unpack_fixed(payload, bit, n_groups, width_bits).astype(np.int64)
+    widths += width_reference
+    bit = _octet_align(bit + n_groups * width_bits)
+    lengths = _unpack_fixed(payload, bit, n_groups, length_bits).astype(np.int64)
+    lengths = lengths * length_increment + length_reference
+    lengths[-1] = last_length
+    bit = _octet_align(bit + n_groups * length_bits)
+
+    if lengths.sum() != n_values:
+        raise GribError("Group lengths do not add up to the number of values")
+
+    value_widths = np.repeat(widths, lengths)
+    offsets = bit + np.concatenate(([0], np.cumsum(value_widths)[:-1]))
+    packed = _unpack_bits(payload, offsets, value_widths).astype(np.int64)
+    x = packed + np.repeat(refs, lengths)
+
+    missing = np.zeros(n_values, dtype=bool)
+    if missing_management in (1, 2):
+        all_ones = (np.int64(1) << value_widths) - 1
+        group_missing = np.repeat(refs == (1 << ref_bits) - 1, lengths)
+        missing = np.where(value_widths > 0, packed == all_ones, group_missing)
+        if missing_management == 2:
+            missing |= (value_widths > 0) & (packed == all_ones - 1)
+
+    if template == COMPLEX_PACKING_SPATIAL_DIFF:
+        x = x.copy()
+        x[~missing] = _undo_spatial_differencing(x[~missing], initial, minimum)
+
+    values = _scale(s5, x)
+    values[missing] = np.nan
+    return values
+
+
+def _undo_spatial_differencing(x, initial, minimum):
+    "Rebuilds values from first or second order differences"
+    order = len(initial)
+    if len(x) <= order:
+        return np.asarray(initial[: len(x)], dtype=np.int64)
+
+    diffs = x + minimum
+    values = np.empty(len(x), dtype=np.int64)
+    values[0] = initial[0]
+    if order == 1:
+        values[1:] = initial[0] + np.cumsum(diffs[1:])
+        return values
+
+    # d[i] = f[i] - 2f[i-1] + f[i-2], so the first differences
+    # g[i] = f[i] - f[i-1] are a running sum of d
+    first_diffs = np.empty(len(x) - 1, dtype=np.int64)
+    first_diffs[0] = initial[1] - initial[0]
+    first_diffs[1:] = first_diffs[0] + np.cumsum(diffs[2:])
+    values[1:] = initial[0] + np.cumsum(first_diffs)
+    return values
+
+
+def decode_values(section5, section7):
+    "Unpacks the data section to float32 values, NaN where missing"
+    template = _uint(section5, 10, 2)
+    payload = _padded(section7[5:])
+
+    if template == SIMPLE_PACKING:
+        return _decode_simple(section5, payload)
+    if template in (COMPLEX_PACKING, COMPLEX_PACKING_SPATIAL_DIFF):
+        return _decode_complex(section5, payload, template)
+
+    raise GribError(f"Data representation template 5.{template} not supported")
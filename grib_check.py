@@ -0,0 +1,204 @@
+"""Fast structural checks of downloaded GRIB2 files before ungrib reads them"""
+
+from collections import Counter
+import os
+import statistics
+import struct
+
+import vtable
+
+SECTION0_SIZE = 16
+END_MARKER = b"7777"
+PRODUCT_SECTION = 4
+DATA_SECTION = 7
+
+
+def _first_surface(section4):
+    "(level type, value) of the first fixed surface of a product definition"
+    level_type = section4[22]
+    scale = section4[23]
+    (value,) = struct.unpack(">I", section4[24:28])
+    if level_type == 255 or value == 0xFFFFFFFF:
+        return level_type, None
+    # GRIB2 signed integers use a sign bit instead of two's complement
+    if scale & 0x80:
+        scale = -(scale & 0x7F)
+    if value & 0x80000000:
+        value = -(value & 0x7FFFFFFF)
+    return level_type, value / 10**scale
+
+
+def scan_grib2(fpath):
+    """Walks the section headers of every message without decoding data.
+    Returns (fields, problems). fields holds a
+    (discipline, category, parameter, level type, level value) tuple per
+    product, problems lists anything structurally wrong with the file"""
+    fields = []
+    problems = []
+    size = os.path.getsize(fpath)
+
+    with open(fpath, "rb") as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            section0 = f.read(SECTION0_SIZE)
+            if section0[:4] != b"GRIB":
+                if offset == 0 and section0.lstrip()[:1] == b"<":
+                    problems.append("HTML instead of GRIB")
+                else:
+                    problems.append(f"No GRIB header at byte {offset}")
+                break
+
+            discipline = section0[6]
+            edition = section0[7]
+            (length,) = struct.unpack(">Q", section0[8:16])
+            if edition != 2:
+                problems.append(f"GRIB edition {edition} at byte {offset}")
+                break
+            if offset + length > size:
+                problems.append(f"Truncated message at byte {offset}")
+                break
+
+            end = offset + length
+            pos = offset + SECTION0_SIZE
+            has_data = False
+            while pos < end - 4:
+                f.seek(pos)
+                header = f.read(5)
+                (section_length,) = struct.unpack(">I", header[:4])
+                section = header[4]
+                if section_length < 5 or pos + section_length > end - 4:
+                    problems.append(f"Bad section {section} at byte {pos}")
+                    break
+
+                if section == PRODUCT_SECTION:
+                    section4 = header + f.read(min(section_length, 34) - 5)
+                    level_type, level = _first_surface(section4)
+                    fields.append(
+                        (discipline, section4[9], section4[10], level_type, level)
+                    )
+                elif section == DATA_SECTION:
+                    has_data = True
+
+                pos += section_length
+
+            f.seek(end - 4)
+            if f.read(4) != END_MARKER:
+                problems.append(f"Message at byte {offset} not terminated by 7777")
+                break
+            if not has_data:
+                problems.append(f"Message at byte {offset} has no data section")
+
+            offset = end
+
+    if not fields and not problems:
+        problems.append("Empty file")
+
+    return fields, problems
+
+
+def required_keys(entries):
+    """((code alternatives), level type) for every Vtable entry. Any of the
+    alternative codes satisfies the entry"""
+    keys = set()
+    for entry in entries:
+        code = (entry.discipline, entry.category, entry.parameter)
+        keys.add((frozenset(vtable.equivalent_codes(code)), entry.grib2_level))
+    return keys
+
+
+def isobaric_codes(entries):
+    return {
+        frozenset(vtable.equivalent_codes((e.discipline, e.category, e.parameter)))
+        for e in entries
+        if e.grib2_level == vtable.ISOBARIC and e.level1 is None
+    }
+
+
+def isobaric_levels(fields, codes):
+    "Pressures in Pa of the isobaric messages of the codes"
+    return {f[4] for f in fields if f[:3] in codes and f[3] == vtable.ISOBARIC}
+
+
+def expected_levels(nfglevels):
+    "Pressures in Pa of the isobaric levels init_atmosphere reads"
+    return {round(level * 100, 3) for level in vtable.isobaric_levels(nfglevels)}
+
+
+def _present(fields, codes, level_type):
+    return any(f[:3] in codes and f[3] == level_type for f in fields)
+
+
+def validate_gribs(fpaths, entries, nfglevels):
+    """fpaths: {forecast hour: grib path}
+
+    Checks the structure of every file and that it has each Vtable field,
+    the isobaric ones on every level of nfglevels. A field or level missing
+    from a file is a problem if most hours have it, and only a warning if
+    they don't, as data GFS never provides would otherwise fail every file.
+    Fewer messages than the other hours is a warning too, since the fields
+    GFS writes vary with the forecast hour.
+    Returns {fhour: report} where report["problems"] is empty for good files"""
+    keys = required_keys(entries)
+    isobaric = isobaric_codes(entries)
+    levels = expected_levels(nfglevels)
+
+    scans = {}
+    for fhour, fpath in fpaths.items():
+        if not os.path.exists(fpath):
+            scans[fhour] = ([], ["File missing"])
+        else:
+            scans[fhour] = scan_grib2(fpath)
+
+    presence = Counter()
+    for fields, _ in scans.values():
+        for key in keys:
+            if _present(fields, *key):
+                presence[key] += 1
+        for codes in isobaric:
+            for level in isobaric_levels(fields, codes) & levels:
+                presence[codes, level] += 1
+
+    def provided(key):
+        "Whether most hours have the key, so GFS writes it"
+        return presence[key] > len(scans) / 2
+
+    counts = [len(fields) for fhour, (fields, _) in scans.items() if fhour > 0]
+    median_count = statistics.median(counts) if counts else 0
+
+    report = {}
+    for fhour, (fields, problems) in scans.items():
+        problems = list(problems)
+        warnings = []
+        if fields:
+            for key in keys:
+                if not _present(fields, *key):
+                    codes, level_type = key
+                    missing = f"No {sorted(codes)} on level type {level_type}"
+                    if provided(key):
+                        problems.append(missing)
+                    else:
+                        warnings.append(f"{missing}, nor in most hours")
+
+            for codes in isobaric:
+                missing = levels - isobaric_levels(fields, codes)
+                short = sorted(level for level in missing if provided((codes, level)))
+                never = sorted(missing.difference(short))
+                if short:
+                    problems.append(f"No {sorted(codes)} at {short} Pa")
+                if never:
+                    warnings.append(f"No {sorted(codes)} at {never} Pa in most hours")
+
+            if fhour > 0 and len(fields) < median_count:
+                warnings.append(
+                    f"{len(fields)} messages, other hours have {median_count:g}"
+                )
+
+        report[fhour] = {
+            "path": fpaths[fhour],
+            "messages": len(fields),
+            "problems": problems,
+            "warnings": warnings,
+        }
+
+    return report
@@ -0,0 +1,326 @@
+"""Reads and writes WPS intermediate format files (FILE:YYYY-MM-DD_HH)"""
+
+import argparse
+from collections import namedtuple
+import glob
+import os
+import struct
+
+import numpy as np
+
+import vtable
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+WPS_DIR = f"{ROOT_DIR}/tools/WPS-4.4"
+MPAS_DIR = f"{ROOT_DIR}/MPAS-Model"
+
+# xlvl codes ungrib uses for non isobaric fields
+SURFACE_XLVL = 200100.0
+SEA_LEVEL_XLVL = 201300.0
+
+# ungrib writes geopotential height on pressure levels as GHT
+FIELD_ALIASES = {"HGT": "GHT"}
+
+INTERMEDIATE_VERSION = 5
+CYLINDRICAL_EQUIDISTANT = 0
+EARTH_RADIUS_KM = 6371.229
+MISSING_VALUE = -1.0e30
+
+HEADER_FORMAT = ">24sf32s9s25s46sf3i"
+LATLON_FORMAT = ">8s5f"
+
+# One 2D field of an intermediate file on a lat/lon grid
+Slab = namedtuple(
+    "Slab",
+    [
+        "hdate",
+        "map_source",
+        "field",
+        "units",
+        "desc",
+        "xlvl",
+        "startloc",
+        "startlat",
+        "startlon",
+        "deltalat",
+        "deltalon",
+        "values",
+    ],
+)
+
+# Fields init_atmosphere can't run without. A gap in these fails the check
+REQUIRED_3D_FIELDS = ("TT", "UU", "VV", "RH", "GHT")
+
+
+def _read_record(f):
+    "Returns one big endian Fortran sequential record, None at EOF"
+    marker = f.read(4)
+    if len(marker) < 4:
+        return None
+    (length,) = struct.unpack(">i", marker)
+    data = f.read(length)
+    f.read(4)
+    return data
+
+
+def _skip_record(f):
+    marker = f.read(4)
+    (length,) = struct.unpack(">i", marker)
+    f.seek(length + 4, os.SEEK_CUR)
+
+
+def _write_record(f, data):
+    marker = struct.pack(">i", len(data))
+    f.write(marker + data + marker)
+
+
+def _text(s, size):
+    return s.ljust(size)[:size].encode()
+
+
+def write_intermediate(fpath, slabs):
+    """Writes lat/lon slabs as version 5 intermediate records, the layout
+    ungrib produces and metgrid or init_atmosphere read. Values are an
+    (ny, nx) array, NaN is written as the missing value"""
+    tmp = f"{fpath}.tmp"
+    with open(tmp, "wb") as f:
+        for slab in slabs:
+            ny, nx = slab.values.shape
+            _write_record(f, struct.pack(">i", INTERMEDIATE_VERSION))
+            header = struct.pack(
+                HEADER_FORMAT,
+                _text(slab.hdate, 24),
+                0.0,
+                _text(slab.map_source, 32),
+                _text(slab.field, 9),
+                _text(slab.units, 25),
+                _text(slab.desc, 46),
+                slab.xlvl,
+                nx,
+                ny,
+                CYLINDRICAL_EQUIDISTANT,
+            )
+            _write_record(f, header)
+            projection = struct.pack(
+                LATLON_FORMAT,
+                _text(slab.startloc, 8),
+                slab.startlat,
+                slab.startlon,
+                slab.deltalat,
+                slab.deltalon,
+                EARTH_RADIUS_KM,
+            )
+            _write_record(f, projection)
+            # Winds on a lat/lon grid are earth relative
+            _write_record(f, struct.pack(">i", 0))
+            values = np.where(np.isnan(slab.values), MISSING_VALUE, slab.values)
+            _write_record(f, values.astype(">f4").tobytes())
+
+    os.replace(tmp, fpath)
+
+
+def read_slabs(fpath):
+    """Every record of an intermediate file with its data. Only the lat/lon
+    projection ungrib uses for GFS is supported"""
+    slabs = []
+    with open(fpath, "rb") as f:
+        while _read_record(f) is not None:
+            header = struct.unpack(HEADER_FORMAT, _read_record(f))
+            hdate, _, map_source, field, units, desc, xlvl, nx, ny, iproj = header
+            if iproj != CYLINDRICAL_EQUIDISTANT:
+                raise ValueError(f"Projection {iproj} not supported in {fpath}")
+
+            projection = struct.unpack(LATLON_FORMAT, _read_record(f)[:28])
+            startloc, startlat, startlon, deltalat, deltalon, _ = projection
+            _read_record(f)
+            values = np.frombuffer(_read_record(f), dtype=">f4").reshape(ny, nx)
+
+            slabs.append(
+                Slab(
+                    hdate=hdate.decode().strip(),
+                    map_source=map_source.decode().strip(),
+                    field=field.decode().strip(),
+                    units=units.decode().strip(),
+                    desc=desc.decode().strip(),
+                    xlvl=xlvl,
+                    startloc=startloc.decode().strip(),
+                    startlat=startlat,
+                    startlon=startlon,
+                    deltalat=deltalat,
+                    deltalon=deltalon,
+                    values=values.astype(np.float32),
+                )
+            )
+
+    return slabs
+
+
+def read_headers(fpath):
+    """Returns (field, xlvl, hdate) of every record in an intermediate file
+    without reading the data slabs"""
+    headers = []
+    with open(fpath, "rb") as f:
+        while True:
+            version = _read_record(f)
+            if version is None:
+                break
+
+            header = _read_record(f)
+            hdate = header[0:24].decode().strip()
+            field = header[60:69].decode().strip()
+            (xlvl,) = struct.unpack(">f", header[140:144])
+
+            # projection, wind rotation flag and data slab
+            _skip_record(f)
+            _skip_record(f)
+            _skip_record(f)
+
+            headers.append((field, xlvl, hdate))
+
+    return headers
+
+
+def expected_fields(entries, nfglevels):
+    """(field, xlvl) pairs the Vtable should produce in each intermediate
+    file. Max wind and tropopause fields are optional and not listed"""
+    expected = set()
+    for entry in entries:
+        name = entry.name
+        if entry.grib2_level == vtable.ISOBARIC:
+            name = FIELD_ALIASES.get(name, name)
+            if entry.level1 is None:
+                levels = vtable.isobaric_levels(nfglevels)
+            else:
+                levels = [entry.level1]
+            for mb in levels:
+                expected.add((name, round(mb * 100.0, 2)))
+        elif entry.grib2_level == vtable.MEAN_SEA_LEVEL:
+            expected.add((name, SEA_LEVEL_XLVL))
+        elif entry.grib2_level in (
+            vtable.SURFACE,
+            vtable.HEIGHT_ABOVE_GROUND,
+            vtable.DEPTH_BELOW_GROUND,
+        ):
+            expected.add((name, SURFACE_XLVL))
+
+    return expected
+
+
+def missing_fields(fpath, entries, nfglevels):
+    present = {(field, round(xlvl, 2)) for field, xlvl, _ in read_headers(fpath)}
+    return sorted(expected_fields(entries, nfglevels) - present)
+
+
+def check_intermediates(nfglevels, dirs=(WPS_DIR, MPAS_DIR), entries=None):
+    """Confirms every FILE:* written by ungrib or linked from the cache holds
+    the fields and levels init_atmosphere needs. Missing surface fields are
+    reported, missing pressure level data raises RuntimeError"""
+    if entries is None:
+        entries = vtable.read_vtable()
+
+    # MPAS-Model holds links to the WPS files as well as cache hits
+    by_name = {}
+    for directory in dirs:
+        for fpath in glob.glob(f"{directory}/FILE:*"):
+            by_name.setdefault(os.path.basename(fpath), fpath)
+    fpaths = [by_name[name] for name in sorted(by_name)]
+    if not fpaths:
+        raise RuntimeError(f"No intermediate files in {dirs}")
+
+    fatal = {}
+    for fpath in fpaths:
+        missing = missing_fields(fpath, entries, nfglevels)
+        if missing:
+            print("Missing from", os.path.basename(fpath), missing)
+        missing_3d = [m for m in missing if m[0] in REQUIRED_3D_FIELDS]
+        if missing_3d:
+            fatal[fpath] = missing_3d
+
+    if fatal:
+        raise RuntimeError(f"Incomplete intermediate files: {sorted(fatal)}")
+
+
+def _south_to_north(slab):
+    "Grid origin and values with rows running south to north"
+    values = np.where(slab.values == MISSING_VALUE, np.nan, slab.values)
+    startlat, deltalat = slab.startlat, slab.deltalat
+    if deltalat < 0:
+        startlat += (values.shape[0] - 1) * deltalat
+        deltalat = -deltalat
+        values = values[::-1]
+    return (round(startlat, 3), round(slab.startlon % 360, 3), deltalat), values
+
+
+def compare_slabs(slab, reference, rtol=1e-5, atol=1e-4):
+    "Describes how slab differs from reference, None when they match"
+    if slab.values.shape != reference.values.shape:
+        return f"shape {slab.values.shape} != {reference.values.shape}"
+
+    grid, values = _south_to_north(slab)
+    ref_grid, ref_values = _south_to_north(reference)
+    if grid != ref_grid:
+        return f"grid {grid} != {ref_grid}"
+    if not np.array_equal(np.isnan(values), np.isnan(ref_values)):
+        return "missing value masks differ"
+    if not np.allclose(values, ref_values, rtol=rtol, atol=atol, equal_nan=True):
+        diff = np.nanmax(np.abs(values - ref_values))
+        return f"max abs difference {diff:g}"
+
+    return None
+
+
+def compare_intermediates(fpath, reference, rtol=1e-5, atol=1e-4):
+    """Compares an intermediate file with a reference written by ungrib.exe.
+    Returns a list of problems, empty when every reference record is matched
+    within tolerance. Extra records in fpath are reported but not counted"""
+    slabs = {(s.field, round(s.xlvl, 2)): s for s in read_slabs(fpath)}
+    ref_slabs = {(s.field, round(s.xlvl, 2)): s for s in read_slabs(reference)}
+
+    extra = sorted(set(slabs) - set(ref_slabs))
+    if extra:
+        print("Not written by ungrib:", extra)
+
+    problems = []
+    for key in sorted(ref_slabs):
+        if key not in slabs:
+            problems.append((key, "missing"))
+            continue
+        problem = compare_slabs(slabs[key], ref_slabs[key], rtol=rtol, atol=atol)
+        if problem is not None:
+            problems.append((key, problem))
+
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare intermediate files against ungrib.exe output"
+    )
+    parser.add_argument("files", help="Directory or FILE:* to check")
+    parser.add_argument("reference", help="Directory or FILE:* from ungrib.exe")
+    parser.add_argument("--rtol", type=float, default=1e-5)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.reference):
+        references = sorted(glob.glob(f"{args.reference}/FILE:*"))
+    else:
+        references = [args.reference]
+
+    failed = False
+    for reference in references:
+        name = os.path.basename(reference)
+        fpath = f"{args.files}/{name}" if os.path.isdir(args.files) else args.files
+        if not os.path.exists(fpath):
+            print(name, "missing")
+            failed = True
+            continue
+
+        problems = compare_intermediates(fpath, reference, args.rtol, args.atol)
+        print(name, "matches" if not problems else f"{len(problems)} problems")
+        for key, problem in problems:
+            print("   ", key, problem)
+        failed = failed or bool(problems)
+
+    raise SystemExit(1 if failed else 0)
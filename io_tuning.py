@@ -0,0 +1,130 @@
+"""Tunes how atmosphere_model writes its output streams. Short forecasts are
+run with different PIO io task counts, io_types and output precisions, and
+the one that stalls the ranks least per write is kept for each domain"""
+
+import argparse
+from collections import namedtuple
+import itertools
+import json
+import os
+
+import mpas_log
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+REPORTS_DIR = f"{ROOT_DIR}/data/reports"
+
+# Streams atmosphere_model writes while the forecast runs
+TUNED_STREAMS = ("output", "diagnostics")
+IO_TYPES = ("pnetcdf", "pnetcdf,cdf5", "netcdf4")
+PRECISIONS = ("single", "native")
+
+# num_iotasks 0 lets PIO use every rank
+IOConfig = namedtuple("IOConfig", ["io_tasks", "stride", "io_type", "precision"])
+
+
+def config_key(config):
+    return ":".join(str(value) for value in config)
+
+
+def parse_config(key):
+    io_tasks, stride, io_type, precision = key.split(":")
+    return IOConfig(int(io_tasks), int(stride), io_type, precision)
+
+
+def io_task_layouts(ranks):
+    """(io tasks, stride) pairs spreading the io tasks evenly over the ranks,
+    from every rank writing down to a single writer"""
+    layouts = [(0, 1)]
+    io_tasks = ranks // 2
+    while io_tasks >= 1:
+        layouts.append((io_tasks, ranks // io_tasks))
+        io_tasks //= 2
+    return list(dict.fromkeys(layouts))
+
+
+def candidate_configs(ranks):
+    return [
+        IOConfig(io_tasks, stride, io_type, precision)
+        for (io_tasks, stride), io_type, precision in itertools.product(
+            io_task_layouts(ranks), IO_TYPES, PRECISIONS
+        )
+    ]
+
+
+def apply_namelist(nml, config):
+    nml["io"]["config_pio_num_iotasks"] = config.io_tasks
+    nml["io"]["config_pio_stride"] = config.stride
+
+
+def apply_streams(root, config):
+    "Sets io_type and precision on the output streams of a streams XML root"
+    for node in root:
+        if node.attrib.get("name") in TUNED_STREAMS:
+            node.attrib["io_type"] = config.io_type
+            node.attrib["precision"] = config.precision
+
+
+def write_stall(run_dir, n_writes):
+    """Seconds per output write the ranks spend outside of initialization
+    and time integration, from the timer summary of the last run. None if
+    the log has no summary"""
+    try:
+        timers = mpas_log.read_timers(mpas_log.log_path(run_dir))
+    except OSError:
+        return None
+    if "total time" not in timers:
+        return None
+
+    outside = timers["total time"].total
+    for name in ("initialize", "time integration"):
+        if name in timers:
+            outside -= timers[name].total
+    return max(0.0, outside) / n_writes
+
+
+def report_path(domain_name):
+    return f"{REPORTS_DIR}/io.{domain_name}.json"
+
+
+def read_report(domain_name):
+    "{ranks: {config key: best seconds per write}} from earlier tuning runs"
+    try:
+        with open(report_path(domain_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_stall(domain_name, ranks, config, seconds):
+    report = read_report(domain_name)
+    runs = report.setdefault(str(ranks), {})
+    key = config_key(config)
+    best = runs.get(key)
+    if best is None or seconds < best:
+        runs[key] = seconds
+
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    with open(report_path(domain_name), "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def best_config(domain_name, ranks):
+    "Config with the smallest recorded stall at this rank count, else None"
+    runs = read_report(domain_name).get(str(ranks), {})
+    if not runs:
+        return None
+    return parse_config(min(runs, key=runs.get))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default="colorado12km")
+    args = parser.parse_args()
+
+    for ranks, runs in sorted(
+        read_report(args.domain).items(), key=lambda r: int(r[0])
+    ):
+        print(f"{ranks} ranks")
+        for key, seconds in sorted(runs.items(), key=lambda run: run[1]):
+            print(f"  {seconds:>8.2f}s per write  {key}")
@@ -0,0 +1,127 @@
+"""Records what each stage of a run read and wrote so a rerun of the same
+cycle skips the stages whose inputs are unchanged and whose outputs are
+still in place, e.g. picking up at the model after it failed"""
+
+from datetime import datetime
+import json
+import os
+import time
+
+import cache
+import spans
+import workspace
+
+STAGES = ("download", "wps", "init", "lbc", "model")
+
+DATE_FORMAT = "%Y%m%d%H"
+
+
+def manifest_path(domain_name, runs_dir=workspace.RUNS_DIR):
+    return f"{runs_dir}/{domain_name}/manifest.json"
+
+
+def digests(fpaths):
+    "{path: sha256} of the files that exist"
+    return {
+        fpath: cache.file_digest(fpath) for fpath in fpaths if os.path.exists(fpath)
+    }
+
+
+def file_state(fpath):
+    "Size and modification time, enough to tell an output was replaced"
+    stat = os.stat(fpath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def states(fpaths):
+    """{path: file state} of the files that exist, for inputs that earlier
+    stages wrote and the manifest already tracks"""
+    return {fpath: file_state(fpath) for fpath in fpaths if os.path.exists(fpath)}
+
+
+class Manifest:
+    """{"init_date", "run_dir", "stages": {stage: {"inputs", "outputs"}}}
+    kept as json. Stages before from_stage are taken as done, stages from
+    from_stage on always run and nothing runs after until_stage"""
+
+    def __init__(self, fpath, from_stage=None, until_stage=None):
+        self.fpath = fpath
+        self.first = STAGES.index(from_stage) if from_stage else 0
+        self.last = STAGES.index(until_stage) if until_stage else len(STAGES) - 1
+        self.force = from_stage is not None
+        # Wall seconds of the stages run this time
+        self.timings = {}
+        try:
+            with open(fpath) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault("stages", {})
+
+    @property
+    def init_date(self):
+        init_date = self.data.get("init_date")
+        return datetime.strptime(init_date, DATE_FORMAT) if init_date else None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fpath), exist_ok=True)
+        tmp = f"{self.fpath}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp, self.fpath)
+
+    def start(self, init_date, run_dir):
+        """Forgets the recorded stages if they were for another cycle or run
+        directory. Returns True if any were kept"""
+        cycle = init_date.strftime(DATE_FORMAT)
+        if self.data.get("init_date") == cycle and self.data.get("run_dir") == run_dir:
+            return bool(self.data["stages"])
+
+        self.data = {"init_date": cycle, "run_dir": run_dir, "stages": {}}
+        self.save()
+        return False
+
+    def skipped(self, stage):
+        "True if the stage is outside --from-stage/--until-stage"
+        index = STAGES.index(stage)
+        return index < self.first or index > self.last
+
+    def recorded_inputs(self, stage):
+        "Inputs the stage last ran with, None if it has no record"
+        record = self.data["stages"].get(stage)
+        return record["inputs"] if record else None
+
+    def is_current(self, stage, inputs):
+        # Compare as stored, tuples become lists in json
+        inputs = json.loads(json.dumps(inputs, default=str))
+        record = self.data["stages"].get(stage)
+        if record is None or record["inputs"] != inputs:
+            return False
+        for fpath, state in record["outputs"].items():
+            if not os.path.exists(fpath) or file_state(fpath) != state:
+                return False
+        return True
+
+    def run(self, stage, func, inputs, outputs):
+        """Runs func unless the stage is skipped or up to date, then records
+        inputs, a json-able dict, and the files outputs() lists"""
+        if self.skipped(stage):
+            print("Skipping", stage)
+            return False
+        if not self.force and self.is_current(stage, inputs):
+            print(stage, "is up to date")
+            return False
+
+        # A rerun invalidates the record until it finishes
+        self.data["stages"].pop(stage, None)
+        self.save()
+        start = time.monotonic()
+        with spans.span(stage, kind="stage"):
+            func()
+        self.timings[stage] = time.monotonic() - start
+        self.data["stages"][stage] = {
+            "inputs": json.loads(json.dumps(inputs, default=str)),
+            "outputs": {fpath: file_state(fpath) for fpath in outputs()},
+        }
+        self.save()
+        return True
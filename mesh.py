@@ -0,0 +1,141 @@
+"""Derives the model time step and dissipation length from the cell spacing
+of a static file instead of a single nominal resolution"""
+
+import argparse
+from collections import namedtuple
+import os
+
+import numpy as np
+import xarray as xr
+
+import workspace
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+SOUND_SPEED = 340.0
+# Fastest jet stream winds the advective limit has to allow for
+MAX_WIND = 120.0
+# Courant numbers the split explicit RK3 scheme stays stable at. The acoustic
+# limit allows MPAS's 6 s per km guidance with 2 acoustic sub steps
+ACOUSTIC_COURANT = 1.05
+ADVECTIVE_COURANT = 1.4
+DEFAULT_SUB_STEPS = 2
+
+# dt has to divide the hourly output and boundary intervals
+OUTPUT_INTERVAL = 3600
+
+# Core seconds per cell per time step, for rough wall time estimates
+CORE_SECONDS_PER_CELL_STEP = 1.8e-4
+
+MeshSpacing = namedtuple("MeshSpacing", ["n_cells", "min_dc", "typical_dc", "max_dc"])
+
+
+def analyze(static_path):
+    """Cell spacing in meters from dcEdge. The typical spacing is the median
+    of sqrt(areaCell), which is what the mesh's nominal resolution means"""
+    with xr.open_dataset(static_path) as ds:
+        dc_edge = ds.dcEdge.values
+        area_cell = ds.areaCell.values
+        n_cells = ds.sizes["nCells"]
+
+    return MeshSpacing(
+        n_cells=n_cells,
+        min_dc=float(np.min(dc_edge)),
+        typical_dc=float(np.median(np.sqrt(area_cell))),
+        max_dc=float(np.max(dc_edge)),
+    )
+
+
+def is_limited_area(static_path):
+    """True if the mesh has boundary cells, which global meshes such as
+    x1.40962 do not"""
+    with xr.open_dataset(static_path) as ds:
+        return "bdyMaskCell" in ds and bool(ds.bdyMaskCell.max() > 0)
+
+
+def acoustic_courant(dt, min_dc, sub_steps=DEFAULT_SUB_STEPS):
+    return SOUND_SPEED * dt / sub_steps / min_dc
+
+
+def advective_courant(dt, min_dc):
+    return MAX_WIND * dt / min_dc
+
+
+def dt_limit(spacing, sub_steps=DEFAULT_SUB_STEPS):
+    "Largest dt in seconds within both Courant limits on the finest cells"
+    acoustic = ACOUSTIC_COURANT * sub_steps * spacing.min_dc / SOUND_SPEED
+    advective = ADVECTIVE_COURANT * spacing.min_dc / MAX_WIND
+    return min(acoustic, advective)
+
+
+def candidate_dts(limit=None):
+    "Whole second divisors of the output interval, up to limit if given"
+    dts = [dt for dt in range(1, OUTPUT_INTERVAL + 1) if OUTPUT_INTERVAL % dt == 0]
+    if limit is not None:
+        dts = [dt for dt in dts if dt <= limit]
+    return dts
+
+
+def stable_dt(spacing, sub_steps=DEFAULT_SUB_STEPS):
+    "Largest stable dt that divides the output interval"
+    dts = candidate_dts(dt_limit(spacing, sub_steps))
+    return float(dts[-1]) if dts else 1.0
+
+
+def len_disp(spacing):
+    "config_len_disp is the finest cell spacing in meters"
+    return round(spacing.min_dc, -2) or spacing.min_dc
+
+
+def predicted_wall_time(spacing, dt, flength, ranks):
+    steps = flength * 3600 / dt
+    return steps * spacing.n_cells * CORE_SECONDS_PER_CELL_STEP / ranks
+
+
+def dt_table(spacing, flength, ranks, sub_steps=DEFAULT_SUB_STEPS, count=8):
+    """(dt, acoustic Courant, advective Courant, stable, predicted seconds)
+    for the largest dt choices around the stability limit"""
+    limit = dt_limit(spacing, sub_steps)
+    stable = candidate_dts(limit)
+    unstable = [dt for dt in candidate_dts() if dt > limit]
+    dts = stable[-count:] + unstable[:2]
+
+    return [
+        (
+            dt,
+            acoustic_courant(dt, spacing.min_dc, sub_steps),
+            advective_courant(dt, spacing.min_dc),
+            dt <= limit,
+            predicted_wall_time(spacing, dt, flength, ranks),
+        )
+        for dt in dts
+    ]
+
+
+def print_dt_table(rows):
+    print(f"{'dt':>6} {'acoustic':>9} {'advective':>10} {'stable':>7} {'wall':>9}")
+    for dt, acoustic, advective, stable, seconds in rows:
+        print(
+            f"{dt:>6} {acoustic:>9.2f} {advective:>10.2f} {str(stable):>7} "
+            f"{seconds / 60:>8.1f}m"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default="colorado12km")
+    parser.add_argument("--length", type=int, default=24, help="Forecast hours")
+    parser.add_argument("--ranks", type=int, default=6)
+    parser.add_argument("--sub-steps", type=int, default=DEFAULT_SUB_STEPS)
+    args = parser.parse_args()
+
+    spacing = analyze(workspace.static_path(args.domain))
+    print(
+        f"{spacing.n_cells} cells, spacing min {spacing.min_dc / 1000:.1f} km "
+        f"typical {spacing.typical_dc / 1000:.1f} km "
+        f"max {spacing.max_dc / 1000:.1f} km"
+    )
+    print(
+        f"dt {stable_dt(spacing, args.sub_steps):g}s, len_disp {len_disp(spacing):g}m"
+    )
+    print_dt_table(dt_table(spacing, args.length, args.ranks, args.sub_steps))
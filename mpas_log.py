@@ -0,0 +1,27 @@
+"""Reads the timer summary MPAS writes at the end of log.<core>.0000.out"""
+
+from collections import namedtuple
+import re
+
+# "  2  time integration    118.4   24   118.3   118.4   118.4   88.12  90.01  1.00"
+TIMER_PATTERN = re.compile(
+    r"^\s*(\d+)\s+(\S.*?)\s+(\d+\.\d+)\s+(\d+)\s+\d+\.\d+\s+\d+\.\d+\s+\d+\.\d+"
+)
+
+Timer = namedtuple("Timer", ["level", "total", "calls"])
+
+
+def log_path(run_dir, core="atmosphere"):
+    return f"{run_dir}/log.{core}.0000.out"
+
+
+def read_timers(fpath):
+    "{timer name: Timer} from a model log, empty if the run didn't finish"
+    timers = {}
+    with open(fpath) as f:
+        for line in f:
+            match = TIMER_PATTERN.match(line)
+            if match:
+                level, name, total, calls = match.groups()
+                timers[name] = Timer(int(level), float(total), int(calls))
+    return timers
@@ -0,0 +1,325 @@
+"""Runs several domains off one GFS cycle. GRIBs covering every limited area
+domain are downloaded and ungribbed once, then the cores are shared between
+the domains' MPI jobs by how much work each has left before its deadline.
+Global domains only need the 0.5 degree initial conditions"""
+
+import argparse
+from collections import namedtuple
+import concurrent.futures
+import os
+import subprocess
+import sys
+import time
+
+import cache
+import decomposition
+import intermediate
+import io_tuning
+import mesh
+import run_mpas
+import spans
+import ungrib
+import workspace
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+DEFAULT_DEADLINE_MINUTES = 180
+
+# resolution_km sets the time step, deadline is minutes from the start
+DomainSpec = namedtuple(
+    "DomainSpec", ["name", "resolution_km", "flength", "deadline_minutes"]
+)
+
+
+def parse_domain(spec, flength):
+    "name:resolution_km[:deadline minutes], e.g. colorado12km:12:120"
+    parts = spec.split(":")
+    deadline = float(parts[2]) if len(parts) > 2 else DEFAULT_DEADLINE_MINUTES
+    return DomainSpec(parts[0], int(parts[1]), flength, deadline)
+
+
+def union_extent(extents):
+    "Smallest ((lon_min, lon_max), (lat_min, lat_max)) covering every extent"
+    lons = [lon for (lon_range, _) in extents for lon in lon_range]
+    lats = [lat for (_, lat_range) in extents for lat in lat_range]
+    return (min(lons), max(lons)), (min(lats), max(lats))
+
+
+def domain_weight(domain, spacing):
+    """Cell updates per second needed to finish by the deadline, with the
+    time step prep_run_namelist derives from the mesh"""
+    steps = domain.flength * 3600 / mesh.stable_dt(spacing)
+    return spacing.n_cells * steps / (domain.deadline_minutes * 60)
+
+
+def core_shares(weights, ncpus):
+    """Splits ncpus between the weights, at least one core each. Remainders
+    go to the largest fractional shares, and cores given to shares rounded
+    up to one come from the largest shares"""
+    if len(weights) > ncpus:
+        raise ValueError(f"{len(weights)} domains need at least {len(weights)} cores")
+    total = sum(weights.values())
+    exact = {name: ncpus * weight / total for name, weight in weights.items()}
+    shares = {name: max(1, int(share)) for name, share in exact.items()}
+
+    while sum(shares.values()) > ncpus:
+        largest = max(shares, key=shares.get)
+        shares[largest] -= 1
+
+    spare = ncpus - sum(shares.values())
+    by_remainder = sorted(exact, key=lambda name: exact[name] % 1, reverse=True)
+    for name in by_remainder[: max(0, spare)]:
+        shares[name] += 1
+
+    return shares
+
+
+def prepare_intermediates(init_dt, fhours, cycle_dir, python_ungrib=False):
+    "Ungribs the shared GRIBs once into cycle_dir for every domain to link"
+    os.makedirs(cycle_dir, exist_ok=True)
+    pending = run_mpas.link_cached_intermediates(
+        init_dt, fhours, python_ungrib, cycle_dir
+    )
+    todo = sorted(pending)
+    if python_ungrib and todo:
+        cycle = str(init_dt.hour).zfill(2)
+        gribs = [run_mpas.grib_path(init_dt, cycle, fhour) for fhour in todo]
+        ungrib.convert_gribs(gribs, run_mpas.NFGLEVELS, out_dir=cycle_dir)
+    elif todo:
+        run_mpas.parallel_ungrib_hours(init_dt, todo, out_dir=cycle_dir)
+    run_mpas.store_intermediates(pending, cycle_dir)
+    cache.intermediate_cache().evict()
+    intermediate.check_intermediates(run_mpas.NFGLEVELS, dirs=(cycle_dir,))
+
+
+def plot_products(domain_name, products_dir):
+    subprocess.call(
+        [
+            sys.executable,
+            "plot_raw.py",
+            "--domain",
+            domain_name,
+            "--products-dir",
+            products_dir,
+        ],
+        cwd=ROOT_DIR,
+    )
+
+
+def run_domain(
+    domain,
+    init_dt,
+    cycle_dir,
+    cores,
+    plot=True,
+    archive_diagnostics=False,
+    limited_area=True,
+):
+    """Initial conditions, boundary conditions and forecast for one domain in
+    its own workspace. Products are emitted as soon as the forecast ends.
+    limited_area: False for a global mesh, which has no boundary conditions"""
+    start = time.monotonic()
+    ws = workspace.Workspace(domain.name, init_dt).create()
+    ranks = decomposition.decompose(domain.name, cores, run_dir=ws.path)
+
+    run_mpas.prep_initial_conditions(
+        domain.name, init_dt, domain.flength, limited_area, run_dir=ws.path
+    )
+    stage_seconds = {}
+    usage = run_mpas.run_mpas_script(
+        "run_init_atmosphere.sh", "init", init_dt, 0, ws.path, cycle_dir, ranks
+    )
+    stage_seconds["init"] = usage.wall_seconds
+
+    if limited_area:
+        run_mpas.prep_lbc(domain.name, init_dt, domain.flength, run_dir=ws.path)
+        usage = run_mpas.run_mpas_script(
+            "run_init_atmosphere.sh",
+            "lbc",
+            init_dt,
+            domain.flength,
+            ws.path,
+            cycle_dir,
+            ranks,
+            run_mpas.stage_timeout(
+                domain.name, domain.resolution_km, "lbc", domain.flength, ranks
+            ),
+        )
+        stage_seconds["lbc"] = usage.wall_seconds
+
+    run_mpas.prep_run(
+        domain.name,
+        init_dt,
+        domain.flength,
+        domain.resolution_km,
+        limited_area=limited_area,
+        archive_diagnostics=archive_diagnostics,
+        io_config=io_tuning.best_config(domain.name, ranks),
+        run_dir=ws.path,
+        ranks=ranks,
+    )
+    usage = run_mpas.run_mpas_script(
+        "run_atmosphere.sh",
+        "model",
+        init_dt,
+        domain.flength,
+        ws.path,
+        cycle_dir,
+        ranks,
+        run_mpas.stage_timeout(
+            domain.name, domain.resolution_km, "model", domain.flength, ranks
+        ),
+    )
+    stage_seconds["model"] = usage.wall_seconds
+    run_mpas.record_performance(
+        domain.name, init_dt, domain.flength, ranks, stage_seconds, run_dir=ws.path
+    )
+
+    products_dir = ws.collect_products()
+    elapsed = (time.monotonic() - start) / 60
+    late = elapsed - domain.deadline_minutes
+    print(
+        f"{domain.name} products in {products_dir} after {elapsed:.0f} min"
+        + (f", {late:.0f} min past deadline" if late > 0 else "")
+    )
+    if plot:
+        plot_products(domain.name, products_dir)
+
+    return products_dir
+
+
+def run_cycle(
+    domains,
+    ncpus=run_mpas.NCPUS,
+    discover=False,
+    python_ungrib=False,
+    plot=True,
+    archive_diagnostics=False,
+):
+    """Downloads the union of the limited area domains' extents for their
+    longest forecast, ungribs it once and runs the domains concurrently on
+    their core shares. Global domains get the initial time of the 0.5 degree
+    GFS in a directory of their own.
+    Returns {domain name: products dir} of the domains that finished"""
+    limited_area = {
+        domain.name: mesh.is_limited_area(workspace.static_path(domain.name))
+        for domain in domains
+    }
+    regional = [domain for domain in domains if limited_area[domain.name]]
+
+    # Global domains start from the 0.5 degree analysis, the 0.25 is waited for
+    product = "pgrb2.0p25" if len(regional) == len(domains) else "pgrb2.0p50"
+    init_dt = run_mpas.latest_gfs_init_date(discover, product)
+    spans.set_cycle(init_dt)
+    cycle_dir = workspace.cycle_dir(init_dt)
+    global_dir = f"{cycle_dir}/global"
+    wps_dirs = {
+        domain.name: cycle_dir if limited_area[domain.name] else global_dir
+        for domain in domains
+    }
+
+    # Both downloads write the same data/grib paths, so they run one by one
+    if len(regional) < len(domains):
+        print("Downloading global initial conditions")
+        run_mpas.download_0p50_gribs(init_dt, 0, wait=discover)
+        prepare_intermediates(init_dt, [0], global_dir, python_ungrib)
+
+    if regional:
+        extent = union_extent(
+            [
+                run_mpas.add_extent_buffer(
+                    run_mpas.get_mesh_extent(workspace.static_path(domain.name))
+                )
+                for domain in regional
+            ]
+        )
+        flength = max(domain.flength for domain in regional)
+        print("Downloading", extent, "for", [domain.name for domain in regional])
+        run_mpas.download_gribs(init_dt, flength, extent=extent, wait=discover)
+        prepare_intermediates(
+            init_dt, list(range(flength + 1)), cycle_dir, python_ungrib
+        )
+    cache.grib_cache().evict()
+
+    weights = {
+        domain.name: domain_weight(
+            domain, mesh.analyze(workspace.static_path(domain.name))
+        )
+        for domain in domains
+    }
+    shares = core_shares(weights, ncpus)
+
+    products = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(domains)) as executor:
+        futures = {
+            executor.submit(
+                run_domain,
+                domain,
+                init_dt,
+                wps_dirs[domain.name],
+                shares[domain.name],
+                plot,
+                archive_diagnostics,
+                limited_area[domain.name],
+            ): domain
+            for domain in domains
+        }
+        for future in concurrent.futures.as_completed(futures):
+            domain = futures[future]
+            try:
+                products[domain.name] = future.result()
+            except Exception as e:
+                print(domain.name, "failed:", str(e))
+
+    return products
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "domains",
+        nargs="+",
+        help="name:resolution_km[:deadline minutes], e.g. colorado12km:12:120",
+    )
+    parser.add_argument(
+        "--length",
+        type=int,
+        default=24,
+        help="Forecast length in hours",
+    )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=os.cpu_count() or run_mpas.NCPUS,
+        help="Cores shared between the domains",
+    )
+    parser.add_argument(
+        "--discover-cycle",
+        action="store_true",
+        help="Find the newest cycle on NOMADS and download hours as they publish",
+    )
+    parser.add_argument(
+        "--python-ungrib",
+        action="store_true",
+        help="Write the WPS intermediate files in Python instead of ungrib.exe",
+    )
+    parser.add_argument(
+        "--no-plot",
+        action="store_true",
+        help="Skip plot_raw.py after each domain finishes",
+    )
+    parser.add_argument(
+        "--archive-diagnostics",
+        action="store_true",
+        help="Write the archive fields to the diag files as well as the plotted ones",
+    )
+    args = parser.parse_args()
+
+    run_cycle(
+        [parse_domain(spec, args.length) for spec in args.domains],
+        ncpus=args.cores,
+        discover=args.discover_cycle,
+        python_ungrib=args.python_ungrib,
+        plot=not args.no_plot,
+        archive_diagnostics=args.archive_diagnostics,
+    )
@@ -0,0 +1,613 @@
+"""HTTP download engine for NOMADS GRIB files"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import concurrent.futures
+import os
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1024 * 1024
+POOL_SIZE = 16
+TIMEOUT = (10, 120)
+RETRIES = 3
+
+_session = None
+_session_lock = threading.Lock()
+# Set in DownloadScheduler threads, whose jobs it retries itself
+_scheduled = threading.local()
+
+
+def get_session():
+    """Returns a process wide requests session. The connection pool is shared
+    by every download thread so TLS connections to NOMADS are reused"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def nomads_get(url, **kwargs):
+    """GET through the shared session after taking a token from the process
+    wide request budget. Every request to NOMADS goes through here"""
+    request_budget().acquire()
+    return get_session().get(url, **kwargs)
+
+
+def retry_delay(attempt):
+    "Exponential backoff with jitter before retry number attempt + 1"
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) + random.uniform(0, BACKOFF_BASE)
+
+
+def _retries(retries):
+    """Retries a download makes on its own. A DownloadScheduler job gets none
+    since the scheduler retries the whole job"""
+    if retries is not None:
+        return retries
+    return 0 if getattr(_scheduled, "active", False) else RETRIES
+
+
+def partial_path(fpath):
+    "Hidden so link_grib.csh never picks up an incomplete file"
+    dirname, fname = os.path.split(fpath)
+    return os.path.join(dirname, f".{fname}.part")
+
+
+def range_total(content_range):
+    "Full size from a Content-Range header such as bytes */1234, None if unknown"
+    total = (content_range or "").rpartition("/")[2].strip()
+    return int(total) if total.isdigit() else None
+
+
+def _download_once(url, fpath, params=None, resume=True):
+    tmp_path = partial_path(fpath)
+
+    offset = 0
+    if resume and os.path.exists(tmp_path):
+        offset = os.path.getsize(tmp_path)
+
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    with nomads_get(
+        url, params=params, headers=headers, stream=True, timeout=TIMEOUT
+    ) as r:
+        if r.status_code == 416:
+            if offset and range_total(r.headers.get("Content-Range")) == offset:
+                # An earlier transfer got every byte but stopped before the rename
+                os.replace(tmp_path, fpath)
+                return 206, 0
+            # Stale partial file does not match the server's copy. Start over
+            os.remove(tmp_path)
+            return _download_once(url, fpath, params=params, resume=False)
+
+        if not r.ok:
+            return r.status_code, 0
+
+        # Server ignored the range header and is sending the whole file
+        mode = "ab" if r.status_code == 206 else "wb"
+
+        transferred = 0
+        with open(tmp_path, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                transferred += len(chunk)
+
+    os.replace(tmp_path, fpath)
+
+    return r.status_code, transferred
+
+
+def download_file(url, fpath, params=None, retries=None):
+    """Streams url to fpath.
+
+    The body is written in chunks to a hidden .part file and renamed over fpath only
+    once the transfer completes, so fpath is never left truncated. If the
+    connection drops mid transfer, or a .part file is left over from a
+    previous run, the download resumes with a Range request.
+    retries: Defaults to RETRIES, or none inside a DownloadScheduler job
+    Returns (status_code, bytes_transferred)"""
+    retries = _retries(retries)
+    for attempt in range(retries + 1):
+        try:
+            return _download_once(url, fpath, params=params)
+        except requests.exceptions.RequestException as e:
+            print("Download interrupted", os.path.basename(fpath), str(e))
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay(attempt))
+
+
+# NOMADS blocks clients that go over 120 hits per minute. Stay under it
+REQUESTS_PER_MINUTE = 100
+REQUEST_BURST = 10
+MIN_WORKERS = 1
+MAX_WORKERS = 12
+START_WORKERS = 4
+THROTTLE_CODES = (429, 503)
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+MAX_ATTEMPTS = 6
+
+
+class TokenBucket:
+    "Request budget refilled at rate tokens per second"
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Blocks until a token is available"
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        "Empties the bucket after the server pushed back"
+        with self.lock:
+            self.tokens = 0
+            self.last = time.monotonic()
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def request_budget():
+    """The process wide TokenBucket every request to NOMADS takes a token
+    from, shared by all schedulers and threads"""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = TokenBucket(REQUESTS_PER_MINUTE / 60, REQUEST_BURST)
+    return _budget
+
+
+class DownloadScheduler:
+    """Runs download jobs with a concurrency limit that adapts to the server.
+
+    Concurrency grows by one worker while measured throughput keeps rising
+    and is halved when NOMADS answers 429/503. Every request a job sends
+    takes a token from request_budget() so the hit rate stays under the
+    NOMADS limit regardless of concurrency or how many schedulers run.
+    Failed jobs are retried here with backoff, not inside the download.
+
+    Jobs are callables returning (status_code, bytes_transferred)"""
+
+    def __init__(
+        self,
+        min_workers=MIN_WORKERS,
+        max_workers=MAX_WORKERS,
+        start_workers=START_WORKERS,
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.limit = start_workers
+        self.active = 0
+        self.cond = threading.Condition()
+
+        self.total_bytes = 0
+        self.window_bytes = 0
+        self.window_start = time.monotonic()
+        self.window_done = 0
+        self.last_throughput = 0
+        self.backoff_until = 0
+
+    def _enter(self):
+        with self.cond:
+            while True:
+                backoff = self.backoff_until - time.monotonic()
+                if backoff > 0:
+                    self.cond.wait(timeout=backoff)
+                elif self.active >= self.limit:
+                    self.cond.wait()
+                else:
+                    break
+            self.active += 1
+
+    def _exit(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def _throttled(self, attempt):
+        with self.cond:
+            self.limit = max(self.min_workers, self.limit // 2)
+            delay = retry_delay(attempt)
+            self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+            self._reset_window()
+            print(
+                f"Throttled by server, backing off {delay:.0f}s, "
+                f"workers {self.limit}"
+            )
+        request_budget().drain()
+
+    def _reset_window(self):
+        self.window_bytes = 0
+        self.window_done = 0
+        self.window_start = time.monotonic()
+
+    def _completed(self, nbytes):
+        with self.cond:
+            self.total_bytes += nbytes
+            self.window_bytes += nbytes
+            self.window_done += 1
+            if self.window_done < self.limit:
+                return
+
+            elapsed = time.monotonic() - self.window_start
+            throughput = self.window_bytes / max(elapsed, 1e-6)
+            if throughput > self.last_throughput * 1.05:
+                self.limit = min(self.max_workers, self.limit + 1)
+            elif throughput < self.last_throughput * 0.8:
+                self.limit = max(self.min_workers, self.limit - 1)
+            self.last_throughput = throughput
+            self._reset_window()
+            self.cond.notify_all()
+
+    def _run_job(self, job):
+        func, args = job
+        _scheduled.active = True
+        status_code = None
+        for attempt in range(MAX_ATTEMPTS):
+            self._enter()
+            try:
+                status_code, nbytes = func(*args)
+            except requests.exceptions.RequestException as e:
+                print("Download failed", str(e))
+                status_code, nbytes = None, 0
+            finally:
+                self._exit()
+
+            if status_code is None and attempt + 1 < MAX_ATTEMPTS:
+                time.sleep(retry_delay(attempt))
+                continue
+
+            if status_code in THROTTLE_CODES:
+                self._throttled(attempt)
+                continue
+
+            if status_code is not None:
+                self._completed(nbytes)
+                break
+
+        return status_code
+
+    def run(self, jobs):
+        """jobs: iterable of (func, args) tuples. May be a generator that
+        yields jobs as their files get published; each job starts as soon
+        as it is yielded. Returns the final status code of every job"""
+        start = time.monotonic()
+        self.total_bytes = 0
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            status_codes = list(executor.map(self._run_job, jobs))
+
+        elapsed = time.monotonic() - start
+        megabytes = self.total_bytes / 1e6
+        print(
+            f"Downloaded {megabytes:.1f} MB in {elapsed:.1f}s "
+            f"({megabytes / max(elapsed, 1e-6):.2f} MB/s)"
+        )
+
+        return status_codes
+
+
+GFS_PROD_URL = "https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod"
+CYCLE_HOURS = 6
+CYCLE_LOOKBACK = 4
+POLL_INTERVAL = 60
+POLL_TIMEOUT = 6 * 3600
+
+
+def gfs_cycle_url(date):
+    day = date.strftime("%Y%m%d")
+    cycle = str(date.hour).zfill(2)
+    return f"{GFS_PROD_URL}/gfs.{day}/{cycle}/atmos"
+
+
+def gfs_file_url(date, fhour, product="pgrb2.0p25"):
+    cycle = str(date.hour).zfill(2)
+    fhour = str(fhour).zfill(3)
+    return f"{gfs_cycle_url(date)}/gfs.t{cycle}z.{product}.f{fhour}"
+
+
+def published_fhours(date, product="pgrb2.0p25"):
+    """Forecast hours of a cycle that are on NOMADS. NCEP writes the .idx
+    after the GRIB file so a listed .idx means the file is complete"""
+    cycle = str(date.hour).zfill(2)
+    pattern = re.compile(rf"gfs\.t{cycle}z\.{re.escape(product)}\.f(\d{{3}})\.idx")
+
+    try:
+        r = nomads_get(f"{gfs_cycle_url(date)}/", timeout=TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print("Could not list", gfs_cycle_url(date), str(e))
+        return set()
+
+    if not r.ok:
+        return set()
+
+    return {int(fhour) for fhour in pattern.findall(r.text)}
+
+
+def discover_latest_cycle(product="pgrb2.0p25", now=None):
+    """Probes NOMADS for the newest GFS cycle that has at least its analysis
+    published. Returns (init_date, published forecast hours)"""
+    if now is None:
+        now = datetime.utcnow()
+
+    latest = now.replace(
+        hour=now.hour - now.hour % CYCLE_HOURS, minute=0, second=0, microsecond=0
+    )
+
+    for i in range(CYCLE_LOOKBACK):
+        date = latest - timedelta(hours=i * CYCLE_HOURS)
+        fhours = published_fhours(date, product)
+        print("Cycle", date.isoformat(), "published hours", len(fhours))
+        if 0 in fhours:
+            return date, fhours
+
+    raise RuntimeError(f"No GFS cycle with {product} f000 in the last day")
+
+
+def wait_for_fhours(
+    date,
+    fhours,
+    product="pgrb2.0p25",
+    poll_interval=POLL_INTERVAL,
+    timeout=POLL_TIMEOUT,
+):
+    """Yields each forecast hour as soon as NOMADS publishes it, polling the
+    cycle listing until every hour has appeared or timeout expires"""
+    pending = sorted(fhours)
+    deadline = time.monotonic() + timeout
+
+    while pending:
+        published = published_fhours(date, product)
+        ready = [fhour for fhour in pending if fhour in published]
+        for fhour in ready:
+            pending.remove(fhour)
+            yield fhour
+
+        if not pending:
+            break
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Forecast hours {pending} never published")
+
+        print("Waiting for forecast hours", pending[0], "to", pending[-1])
+        time.sleep(poll_interval)
+
+
+MAX_RANGES_PER_REQUEST = 100
+# Fetch the unwanted messages between two ranges when they are smaller than
+# this rather than paying for another range part
+RANGE_GAP = 64 * 1024
+
+IdxRecord = namedtuple(
+    "IdxRecord", ["number", "start", "end", "name", "level", "forecast"]
+)
+
+
+def parse_idx(text):
+    """Parses a wgrib2 .idx inventory. end is the inclusive last byte of the
+    message, None for the last message in the file"""
+    rows = []
+    for line in text.splitlines():
+        cols = line.split(":")
+        if len(cols) < 6:
+            continue
+        rows.append((int(cols[0]), int(cols[1]), cols[3], cols[4], cols[5]))
+
+    records = []
+    for i, (number, start, name, level, forecast) in enumerate(rows):
+        end = rows[i + 1][1] - 1 if i + 1 < len(rows) else None
+        records.append(IdxRecord(number, start, end, name, level, forecast))
+
+    return records
+
+
+def coalesce_ranges(records, gap=RANGE_GAP):
+    "Merges the byte ranges of adjacent or nearly adjacent messages"
+    ranges = []
+    for record in sorted(records, key=lambda r: r.start):
+        if ranges:
+            start, end = ranges[-1]
+            if end is not None and record.start - end - 1 <= gap:
+                ranges[-1] = (start, record.end)
+                continue
+        ranges.append((record.start, record.end))
+
+    return ranges
+
+
+def range_header(ranges):
+    parts = [f"{start}-" if end is None else f"{start}-{end}" for start, end in ranges]
+    return "bytes=" + ",".join(parts)
+
+
+class _ChunkReader:
+    "File like reader over a response's iter_content for multipart parsing"
+
+    def __init__(self, response):
+        self.chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+        self.buf = b""
+
+    def _fill(self):
+        chunk = next(self.chunks, b"")
+        self.buf += chunk
+        return bool(chunk)
+
+    def readline(self):
+        while b"\n" not in self.buf:
+            if not self._fill():
+                break
+        line, sep, self.buf = self.buf.partition(b"\n")
+        return line + sep
+
+    def read(self, n):
+        "Yields the next n bytes in chunks"
+        while n > 0:
+            if not self.buf and not self._fill():
+                raise requests.exceptions.ChunkedEncodingError(
+                    "Response ended inside a byte range"
+                )
+            data, self.buf = self.buf[:n], self.buf[n:]
+            n -= len(data)
+            yield data
+
+
+def _write_multipart(response, f):
+    content_type = response.headers["Content-Type"]
+    boundary = content_type.split("boundary=")[1].strip('"').encode()
+    reader = _ChunkReader(response)
+
+    transferred = 0
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        line = line.strip()
+        if line == b"--" + boundary + b"--":
+            break
+        if line != b"--" + boundary:
+            continue
+
+        headers = {}
+        while True:
+            header = reader.readline().strip()
+            if not header:
+                break
+            key, _, value = header.decode().partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        # Content-Range: bytes start-end/total
+        start, end = headers["content-range"].split()[1].split("/")[0].split("-")
+        for data in reader.read(int(end) - int(start) + 1):
+            f.write(data)
+            transferred += len(data)
+
+    return transferred
+
+
+def _write_ranges_from_full(response, f, ranges):
+    "Server ignored the Range header. Keep only the requested bytes"
+    transferred = 0
+    offset = 0
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        chunk_end = offset + len(chunk)
+        for start, end in ranges:
+            stop = chunk_end if end is None else min(chunk_end, end + 1)
+            lo = max(start, offset)
+            if lo < stop:
+                f.write(chunk[lo - offset : stop - offset])
+                transferred += stop - lo
+        offset = chunk_end
+
+    return transferred
+
+
+def download_byte_ranges(url, fpath, ranges, max_ranges=MAX_RANGES_PER_REQUEST):
+    """Fetches the byte ranges of url with multi range requests and writes
+    them, concatenated in order, atomically to fpath.
+    Returns (status_code, bytes_transferred)"""
+    tmp_path = partial_path(fpath)
+
+    transferred = 0
+    status_code = None
+    # Subset bytes left in the partial file would be resumed from by a full
+    # download falling back to the same path
+    try:
+        with open(tmp_path, "wb") as f:
+            for i in range(0, len(ranges), max_ranges):
+                batch = ranges[i : i + max_ranges]
+                headers = {"Range": range_header(batch)}
+                with nomads_get(
+                    url, headers=headers, stream=True, timeout=TIMEOUT
+                ) as r:
+                    status_code = r.status_code
+                    if not r.ok:
+                        break
+
+                    content_type = r.headers.get("Content-Type", "")
+                    if r.status_code == 206 and "multipart/byteranges" in content_type:
+                        transferred += _write_multipart(r, f)
+                    elif r.status_code == 206:
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                            transferred += len(chunk)
+                    else:
+                        transferred += _write_ranges_from_full(r, f, batch)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if status_code is None or not 200 <= status_code < 300:
+        os.remove(tmp_path)
+        return status_code, 0
+
+    os.replace(tmp_path, fpath)
+
+    return status_code, transferred
+
+
+def download_grib_subset(url, fpath, keep):
+    """Downloads only the GRIB messages of url whose .idx record passes
+    keep(name, level, forecast). Falls back to the full file when there is
+    no inventory. Any other error, throttling included, is returned for the
+    scheduler to retry. Returns (status_code, bytes_transferred)"""
+    r = nomads_get(f"{url}.idx", timeout=TIMEOUT)
+    if r.status_code == 404:
+        print("No inventory for", url, "downloading full file")
+        return download_file(url, fpath)
+    if not r.ok:
+        return r.status_code, 0
+
+    records = parse_idx(r.text)
+    wanted = [rec for rec in records if keep(rec.name, rec.level, rec.forecast)]
+    if not wanted:
+        print("No wanted messages in", url, "downloading full file")
+        return download_file(url, fpath)
+
+    ranges = coalesce_ranges(wanted)
+    print(
+        f"Subsetting {os.path.basename(url)}: {len(wanted)}/{len(records)} messages "
+        f"in {len(ranges)} ranges"
+    )
+
+    retries = _retries(None)
+    for attempt in range(retries + 1):
+        try:
+            return download_byte_ranges(url, fpath, ranges)
+        except requests.exceptions.RequestException as e:
+            print("Download interrupted", os.path.basename(fpath), str(e))
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay(attempt))
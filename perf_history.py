@@ -0,0 +1,185 @@
+"""Append-only history of how long each run took, from the MPAS timer
+summaries and the pipeline's own stage timings, with a report flagging
+timers that got slower than their rolling median"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import shutil
+import statistics
+
+import mpas_log
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+HISTORY_PATH = f"{ROOT_DIR}/data/reports/history.jsonl"
+
+# Stages whose timers scale with the forecast length, compared per hour
+PER_HOUR_STAGES = ("lbc", "model")
+MPAS_STAGES = ("init", "lbc", "model")
+
+DEFAULT_WINDOW = 10
+DEFAULT_THRESHOLD = 0.15
+# Timers shorter than this are too noisy to flag
+MIN_SECONDS = 1.0
+
+
+def saved_log_path(run_dir, stage):
+    return f"{run_dir}/log.{stage}.out"
+
+
+def clear_log(run_dir, stage):
+    "Removes a saved log before the stage runs again so none is left stale"
+    if os.path.exists(saved_log_path(run_dir, stage)):
+        os.remove(saved_log_path(run_dir, stage))
+
+
+def save_log(run_dir, core, stage, log_dir=None):
+    """Keeps the log of the stage that just ran, since init and lbc both
+    write log.init_atmosphere.0000.out. log_dir: Where the core ran if not
+    in run_dir"""
+    log = mpas_log.log_path(log_dir or run_dir, core)
+    if os.path.exists(log):
+        shutil.copyfile(log, saved_log_path(run_dir, stage))
+
+
+def collect_timers(run_dir, stages=MPAS_STAGES):
+    "{stage: {timer name: seconds}} from the saved logs of a run"
+    timers = {}
+    for stage in stages:
+        try:
+            stage_timers = mpas_log.read_timers(saved_log_path(run_dir, stage))
+        except OSError:
+            continue
+        timers[stage] = {name: timer.total for name, timer in stage_timers.items()}
+    return timers
+
+
+def record_run(
+    domain_name,
+    init_date,
+    run_dir,
+    n_cells,
+    ranks,
+    dt,
+    flength,
+    stage_seconds,
+    max_rss_mb=None,
+):
+    """Appends one run to the history. stage_seconds are the pipeline's wall
+    times of the stages run this time, whose timers are collected, and
+    max_rss_mb the model's largest rank"""
+    record = {
+        "recorded": datetime.utcnow().isoformat(timespec="seconds"),
+        "domain": domain_name,
+        "init_date": init_date.isoformat(),
+        "n_cells": n_cells,
+        "ranks": ranks,
+        "dt": dt,
+        "flength": flength,
+        "stages": stage_seconds,
+        "max_rss_mb": max_rss_mb,
+        "timers": collect_timers(
+            run_dir, [stage for stage in MPAS_STAGES if stage in stage_seconds]
+        ),
+    }
+    os.makedirs(os.path.dirname(HISTORY_PATH), exist_ok=True)
+    with open(HISTORY_PATH, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return record
+
+
+def read_history(domain_name=None, fpath=HISTORY_PATH):
+    records = []
+    try:
+        with open(fpath) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if domain_name is None or record["domain"] == domain_name:
+                    records.append(record)
+    except OSError:
+        pass
+    return records
+
+
+def metrics(record):
+    """{metric: seconds} of a run, per forecast hour for the stages that
+    scale with the forecast length"""
+    hours = max(1, record["flength"])
+    values = {}
+    for stage, seconds in record["stages"].items():
+        if stage.split(":")[0] in PER_HOUR_STAGES:
+            values[f"stage/{stage} per hour"] = seconds / hours
+        else:
+            values[f"stage/{stage}"] = seconds
+    for stage, timers in record["timers"].items():
+        for name, seconds in timers.items():
+            if stage in PER_HOUR_STAGES:
+                values[f"{stage}/{name} per hour"] = seconds / hours
+            else:
+                values[f"{stage}/{name}"] = seconds
+    return values
+
+
+def regressions(records, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD):
+    """(metric, latest, rolling median) for the metrics of the last run that
+    are more than threshold slower than the median of the window before it"""
+    if len(records) < 2:
+        return []
+    latest = metrics(records[-1])
+    earlier = [metrics(record) for record in records[-window - 1 : -1]]
+
+    flagged = []
+    for metric, seconds in latest.items():
+        past = [values[metric] for values in earlier if metric in values]
+        if not past:
+            continue
+        median = statistics.median(past)
+        if median > 0 and seconds >= MIN_SECONDS and seconds > median * (1 + threshold):
+            flagged.append((metric, seconds, median))
+    return sorted(flagged, key=lambda flag: flag[1] / flag[2], reverse=True)
+
+
+def print_report(domain_name, window=DEFAULT_WINDOW, threshold=DEFAULT_THRESHOLD):
+    records = read_history(domain_name)
+    if not records:
+        print("No runs recorded for", domain_name)
+        return []
+
+    print(f"{'init':<20} {'ranks':>5} {'dt':>6} {'hours':>5} {'model':>9}")
+    for record in records[-window - 1 :]:
+        model = record["stages"].get("model")
+        print(
+            f"{record['init_date']:<20} {record['ranks']:>5} {record['dt']:>6g} "
+            f"{record['flength']:>5} "
+            + (f"{model:>8.0f}s" if model is not None else f"{'-':>9}")
+        )
+
+    flagged = regressions(records, window, threshold)
+    if not flagged:
+        print("No regressions against the last", window, "runs")
+    for metric, seconds, median in flagged:
+        print(
+            f"REGRESSION {metric}: {seconds:.1f}s vs median {median:.1f}s "
+            f"(+{(seconds / median - 1) * 100:.0f}%)"
+        )
+    return flagged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default="colorado12km")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Fraction slower than the rolling median to flag",
+    )
+    args = parser.parse_args()
+
+    print_report(args.domain, args.window, args.threshold)
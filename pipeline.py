@@ -0,0 +1,122 @@
+"""Event driven stage runner. Each stage starts as soon as the events it
+depends on have fired instead of following a fixed call order"""
+
+import threading
+import time
+
+import spans
+
+
+class StageFailed(RuntimeError):
+    pass
+
+
+class EventPipeline:
+    """Stages are functions run in their own thread once every event in
+    `after` has fired. A finished stage fires an event with its own name.
+    Stages can also fire events while running through emit(), e.g. the
+    download stage announcing each forecast hour as it lands.
+
+    Stages sharing a lock name never run at the same time, for tools that
+    write to a shared working directory. add_lock() lets a lock admit more
+    than one stage to cap concurrency instead. Waiting for the lock is not
+    counted in the stage's duration"""
+
+    def __init__(self):
+        self.stages = []
+        self.fired = {}
+        self.timings = {}
+        self.failed = None
+        self.cond = threading.Condition()
+        self.locks = {}
+        self.start = None
+        self.end = None
+
+    def add_lock(self, name, slots=1):
+        self.locks[name] = threading.BoundedSemaphore(slots)
+
+    def add_stage(self, name, func, after=(), lock=None):
+        if lock is not None:
+            self.locks.setdefault(lock, threading.Lock())
+        self.stages.append((name, func, tuple(after), lock))
+
+    def emit(self, event):
+        with self.cond:
+            if event not in self.fired:
+                self.fired[event] = time.monotonic()
+                self.cond.notify_all()
+
+    def _wait_for(self, events):
+        "Returns False if another stage failed while waiting"
+        with self.cond:
+            while self.failed is None and not all(e in self.fired for e in events):
+                self.cond.wait()
+            return self.failed is None
+
+    def _fail(self, name, e):
+        with self.cond:
+            if self.failed is None:
+                self.failed = (name, e)
+            self.cond.notify_all()
+
+    def _timed(self, name, func):
+        start = time.monotonic()
+        with spans.span(name, kind="stage"):
+            func()
+        self.timings[name] = (start, time.monotonic())
+
+    def _run_stage(self, name, func, after, lock):
+        if not self._wait_for(after):
+            return
+
+        print("Starting", name)
+        try:
+            if lock is None:
+                self._timed(name, func)
+            else:
+                with self.locks[lock]:
+                    if self.failed is not None:
+                        return
+                    self._timed(name, func)
+        except Exception as e:
+            print("Stage", name, "failed:", str(e))
+            self._fail(name, e)
+            return
+
+        self.emit(name)
+
+    def run(self):
+        self.start = time.monotonic()
+        threads = [
+            threading.Thread(target=self._run_stage, args=stage, name=stage[0])
+            for stage in self.stages
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.end = time.monotonic()
+
+        if self.failed is not None:
+            name, e = self.failed
+            raise StageFailed(f"Stage {name} failed") from e
+
+        self.report()
+
+    def report(self):
+        """Logs each stage and the time saved against running every stage
+        back to back"""
+        for name, (start, end) in sorted(self.timings.items(), key=lambda t: t[1]):
+            print(
+                f"{name:<16} start {start - self.start:8.1f}s "
+                f"took {end - start:8.1f}s"
+            )
+
+        serial = sum(end - start for start, end in self.timings.values())
+        wall = self.end - self.start
+        print(
+            f"Pipeline wall time {wall:.1f}s, serial path {serial:.1f}s, "
+            f"saved {serial - wall:.1f}s"
+        )
+
+        return serial, wall
@@ -0,0 +1,269 @@
+"""Estimates a run's wall time, memory per rank and diag output from the
+static file and the performance history, so a forecast length or rank count
+is picked that finishes before the next GFS cycle is out instead of taking
+--length blindly"""
+
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import os
+import statistics
+
+import xarray as xr
+
+import manifest
+import mesh
+import perf_history
+import products
+import workspace
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+# A GFS cycle is on NOMADS about 4 hours after its init time, 6 hours apart
+CYCLE_HOURS = 6
+GFS_DELAY_HOURS = 4
+# Time left after the model for the plots
+PLOT_MARGIN_SECONDS = 15 * 60
+MIN_FLENGTH = 1
+
+DEFAULT_VERT_LEVELS = 55
+# Rough memory per rank: a fixed cost plus the model state per owned cell
+# and level. Replaced by the measured peaks once the history has them
+BASE_RANK_MB = 150
+MB_PER_CELL_LEVEL = 6e-4
+# Share of the host's memory the ranks may use
+MEMORY_FRACTION = 0.8
+
+# Stage seconds until the history has runs of the domain. lbc is per hour
+DEFAULT_STAGE_SECONDS = {"download": 300, "wps": 120, "init": 120, "lbc": 10}
+PER_HOUR_STAGES = ("lbc",)
+
+MeshSize = namedtuple("MeshSize", ["n_cells", "n_vert_levels"])
+Estimate = namedtuple(
+    "Estimate",
+    [
+        "flength",
+        "ranks",
+        "dt",
+        "stage_seconds",
+        "wall_seconds",
+        "rank_memory_mb",
+        "output_bytes",
+    ],
+)
+
+
+def mesh_size(domain_name):
+    "Static files without vertical levels get DEFAULT_VERT_LEVELS"
+    with xr.open_dataset(workspace.static_path(domain_name)) as ds:
+        return MeshSize(
+            ds.sizes["nCells"], ds.sizes.get("nVertLevels", DEFAULT_VERT_LEVELS)
+        )
+
+
+def model_dt(domain_name, resolution_km):
+    "The time step prep_run_namelist will derive for the mesh"
+    try:
+        return mesh.stable_dt(mesh.analyze(workspace.static_path(domain_name)))
+    except (OSError, AttributeError):
+        return 6.0 * resolution_km
+
+
+def host_memory_mb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**2
+
+
+def cycle_deadline(init_date):
+    "When the next cycle's GRIBs are out and this run is stale"
+    return init_date + timedelta(hours=CYCLE_HOURS + GFS_DELAY_HOURS)
+
+
+def _recent(records, ranks):
+    """The window of runs at this rank count, since the parallel efficiency
+    changes with it, else of every rank count"""
+    same_ranks = [record for record in records if record["ranks"] == ranks]
+    return (same_ranks or records)[-perf_history.DEFAULT_WINDOW :]
+
+
+def cell_step_seconds(records, ranks):
+    "Core seconds per cell per time step of atmosphere_model"
+    costs = [
+        record["stages"]["model"]
+        * record["ranks"]
+        / (record["n_cells"] * record["flength"] * 3600 / record["dt"])
+        for record in _recent(records, ranks)
+        if record["stages"].get("model") and record["flength"] > 0
+    ]
+    return statistics.median(costs) if costs else mesh.CORE_SECONDS_PER_CELL_STEP
+
+
+def stage_seconds(records, stage, flength, ranks):
+    "Median of the stage's past wall times, per hour for the lbc"
+    per_hour = stage in PER_HOUR_STAGES
+    times = [
+        record["stages"][stage] / (max(1, record["flength"]) if per_hour else 1)
+        for record in _recent(records, ranks)
+        if stage in record["stages"]
+    ]
+    seconds = statistics.median(times) if times else DEFAULT_STAGE_SECONDS[stage]
+    return seconds * max(1, flength) if per_hour else seconds
+
+
+def rank_memory_mb(records, size, ranks):
+    """Peak RSS of one rank, scaled to this rank count from the largest peak
+    measured in the history if it has any"""
+    per_cell_level = [
+        (record["max_rss_mb"] - BASE_RANK_MB)
+        * record["ranks"]
+        / (record["n_cells"] * size.n_vert_levels)
+        for record in _recent(records, ranks)
+        if record.get("max_rss_mb")
+    ]
+    coefficient = max(per_cell_level) if per_cell_level else MB_PER_CELL_LEVEL
+    return BASE_RANK_MB + coefficient * size.n_cells * size.n_vert_levels / ranks
+
+
+def output_bytes(size, flength, archive=False, precision="single"):
+    "Hourly diag files of the plotted fields, every field is 2D"
+    n_fields = len(products.diagnostics_fields(archive=archive)) - len(
+        products.TIME_FIELDS
+    )
+    value_bytes = 8 if precision == "native" else 4
+    return size.n_cells * n_fields * value_bytes * (flength + 1)
+
+
+def estimate(
+    domain_name,
+    resolution_km,
+    flength,
+    ranks,
+    stages=manifest.STAGES,
+    archive=False,
+    records=None,
+    size=None,
+    dt=None,
+):
+    """Estimate of a run of the stages. records, size and dt are read from
+    the history and static file if not given"""
+    if records is None:
+        records = perf_history.read_history(domain_name)
+    size = size or mesh_size(domain_name)
+    dt = dt or model_dt(domain_name, resolution_km)
+
+    seconds = {
+        stage: stage_seconds(records, stage, flength, ranks)
+        for stage in stages
+        if stage != "model"
+    }
+    if "model" in stages:
+        steps = flength * 3600 / dt
+        seconds["model"] = (
+            cell_step_seconds(records, ranks) * size.n_cells * steps / ranks
+        )
+
+    return Estimate(
+        flength,
+        ranks,
+        dt,
+        seconds,
+        sum(seconds.values()),
+        rank_memory_mb(records, size, ranks),
+        output_bytes(size, flength, archive),
+    )
+
+
+def _read_once(domain_name, resolution_km, kwargs):
+    "Reads the history, mesh and time step once for a series of estimates"
+    kwargs = dict(kwargs)
+    if kwargs.get("records") is None:
+        kwargs["records"] = perf_history.read_history(domain_name)
+    if kwargs.get("size") is None:
+        kwargs["size"] = mesh_size(domain_name)
+    if kwargs.get("dt") is None:
+        kwargs["dt"] = model_dt(domain_name, resolution_km)
+    return kwargs
+
+
+def fits(run, seconds_left, memory_mb=None):
+    memory_mb = memory_mb or host_memory_mb() * MEMORY_FRACTION
+    return (
+        run.wall_seconds + PLOT_MARGIN_SECONDS <= seconds_left
+        and run.rank_memory_mb * run.ranks <= memory_mb
+    )
+
+
+def longest_run(domain_name, resolution_km, flength, ranks, seconds_left, **kwargs):
+    """Estimate of the longest forecast up to flength that finishes within
+    seconds_left, None if not even MIN_FLENGTH does"""
+    kwargs = _read_once(domain_name, resolution_km, kwargs)
+    for hours in range(flength, MIN_FLENGTH - 1, -1):
+        run = estimate(domain_name, resolution_km, hours, ranks, **kwargs)
+        if fits(run, seconds_left):
+            return run
+    return None
+
+
+def fewest_ranks(
+    domain_name, resolution_km, flength, max_ranks, seconds_left, **kwargs
+):
+    """Estimate at the fewest ranks up to max_ranks that finish the whole
+    forecast within seconds_left, leaving the other cores free. None if
+    none do"""
+    kwargs = _read_once(domain_name, resolution_km, kwargs)
+    for ranks in range(1, max_ranks + 1):
+        run = estimate(domain_name, resolution_km, flength, ranks, **kwargs)
+        if fits(run, seconds_left):
+            return run
+    return None
+
+
+def print_estimate(run):
+    stages = ", ".join(
+        f"{stage} {seconds / 60:.1f}m" for stage, seconds in run.stage_seconds.items()
+    )
+    print(
+        f"{run.flength}h on {run.ranks} ranks (dt {run.dt:g}s): "
+        f"{run.wall_seconds / 60:.1f} min ({stages}), "
+        f"{run.rank_memory_mb:.0f} MB per rank, "
+        f"{run.output_bytes / 1024**2:.0f} MB of diag files"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domain", type=str, default="colorado12km")
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=12,
+        help="Horizontal spacing in km, for the time step without a mesh",
+    )
+    parser.add_argument("--length", type=int, default=24, help="Forecast hours")
+    parser.add_argument("--ranks", type=int, default=6)
+    parser.add_argument(
+        "--deadline-minutes",
+        type=float,
+        default=CYCLE_HOURS * 60,
+        help="Minutes from now the products are needed by",
+    )
+    args = parser.parse_args()
+
+    seconds_left = args.deadline_minutes * 60
+    print_estimate(estimate(args.domain, args.resolution, args.length, args.ranks))
+    print(f"Deadline {datetime.utcnow() + timedelta(seconds=seconds_left):%H:%M}Z")
+
+    longest = longest_run(
+        args.domain, args.resolution, args.length, args.ranks, seconds_left
+    )
+    if longest is None:
+        print("No forecast length finishes in time")
+    else:
+        print("Longest forecast in time:")
+        print_estimate(longest)
+
+    fewest = fewest_ranks(
+        args.domain, args.resolution, args.length, args.ranks, seconds_left
+    )
+    if fewest is not None:
+        print("Fewest ranks in time:")
+        print_estimate(fewest)
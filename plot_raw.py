@@ -13,16 +13,20 @@ from scipy.interpolate import griddata
 from metpy.plots import USCOUNTIES
 import simplekml
 from dateutil.parser import isoparse
-from datetime import timezone
+from datetime import datetime, timezone
 import multiprocessing as mp
 import argparse
+import functools
 
 from geojson import GeometryCollection, LineString, Feature, FeatureCollection
 import json
-import time
 
 import matplotlib.style as mplstyle
 
+import diag_watcher
+import spans
+import workspace
+
 mplstyle.use("fast")
 
 
@@ -48,6 +52,16 @@ FRONT_RANGE_LABELS = [
 ]
 
 
+# Regions the downscaled products are drawn for
+DOWNSCALE_REGIONS = [
+    ("frange-downscaled", FRONT_RANGE_EXTENT),
+    ("wasatch-downscaled", WASATCH_EXTENT),
+]
+
+# Static file variables the plots read, all a warm plot worker keeps loaded
+MESH_VARIABLES = ["latCell", "lonCell", "latVertex", "lonVertex", "ter"]
+
+
 WASATCH_LABELS = [
     ("Powder Mtn", -111.78, 41.38),
     ("Snowbasin", -111.855, 41.2),
@@ -189,18 +203,6 @@ PRECIP_CMAP_DATA = (
 )
 
 
-def time_it(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"{func.__name__} took {elapsed_time:.5f} seconds to run.")
-        return result
-
-    return wrapper
-
-
 def longtitude_360_to_180(lons):
     "Converts 0:360 longitude to -180:180"
     # return lons[lons > 180] -= 360
@@ -387,6 +389,7 @@ def plot_title(init_dt, valid_dt, fhour, field_name, model_name="", field_units=
     return f"{model_name}   Init: {init_str}    Valid: {valid_str}    {field_name} ({field_units})   Hour: {fhour}"
 
 
+@spans.timed("plot", product="precip")
 def accumulated_precip_plot(diag_ds, mesh_ds, domain_name="colorado12km"):
     """outfile_path: Path of MPAS output file (history*, diagnostics*)
        mesh_path: Path of static/init mesh to provide cell lat/lons.
@@ -398,40 +401,44 @@ def accumulated_precip_plot(diag_ds, mesh_ds, domain_name="colorado12km"):
     init_dt, valid_dt, fhour = ds_times(diag_ds)
     cycle = str(init_dt.hour).zfill(2)
     fhour_str = "f" + str(fhour).zfill(2)
+    phase = functools.partial(spans.span, product="precip", fhour=fhour)
+
+    with phase("load"):
+        lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
+        lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
+        lons_cell[lons_cell > 180] -= 360
+        # lons_cell = longtitude_360_to_180(lons_cell)
+
+        rain_in = diag_ds["rainnc"][0] * MM_TO_IN
+
+    with phase("contour"):
+        fig, ax = basemap()
+
+        cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
+        norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
+
+        rain_contours = ax.tricontourf(
+            lons_cell,
+            lats_cell,
+            rain_in,
+            PRECIP_CLEVS,
+            levels=PRECIP_CLEVS,
+            cmap=cmap,
+            norm=norm,
+            # tranform=crs.PlateCarree(),
+        )
+        fig.colorbar(rain_contours, ax=ax, orientation="vertical", pad=0.05)
+        title = plot_title(init_dt, valid_dt, fhour, "Accum Precip", "Dan MPAS", "in")
+        ax.set_title(title)
 
-    lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
-    lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
-    lons_cell[lons_cell > 180] -= 360
-    # lons_cell = longtitude_360_to_180(lons_cell)
-
-    rain_in = diag_ds["rainnc"][0] * MM_TO_IN
-
-    fig, ax = basemap()
-
-    cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
-    norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
-
-    rain_contours = ax.tricontourf(
-        lons_cell,
-        lats_cell,
-        rain_in,
-        PRECIP_CLEVS,
-        levels=PRECIP_CLEVS,
-        cmap=cmap,
-        norm=norm,
-        # tranform=crs.PlateCarree(),
-    )
-    fig.colorbar(rain_contours, ax=ax, orientation="vertical", pad=0.05)
-    title = plot_title(init_dt, valid_dt, fhour, "Accum Precip", "Dan MPAS", "in")
-    ax.set_title(title)
-
-    ax.set_extent(WEST_CONUS_EXTENT, crs=crs.PlateCarree())
+        ax.set_extent(WEST_CONUS_EXTENT, crs=crs.PlateCarree())
 
     print("saving", f"products/images/{domain_name}-{cycle}z-precip-{fhour_str}.png")
-    fig.savefig(
-        f"products/images/mpas.{cycle}z.{domain_name}.precip.{fhour_str}.png",
-        bbox_inches="tight",
-    )
+    with phase("savefig"):
+        fig.savefig(
+            f"products/images/mpas.{cycle}z.{domain_name}.precip.{fhour_str}.png",
+            bbox_inches="tight",
+        )
     # plt.close(fig)
 
     plt.show()
@@ -456,55 +463,61 @@ def interp_to_downscale_ds(data, model_lons, model_lats, downscale_ds):
     return data_at_prism_points
 
 
+@spans.timed("plot", product="precip-downscaled")
 def downscaled_precip_plot(
     diag_ds, mesh_ds, downscale_ds, extent, domain_name="colorado12km"
 ):
     init_dt, valid_dt, fhour = ds_times(diag_ds)
     cycle = str(init_dt.hour).zfill(2)
     fhour_str = "f" + str(fhour).zfill(2)
+    phase = functools.partial(spans.span, product="precip-downscaled", fhour=fhour)
+
+    with phase("load"):
+        lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
+        lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
+        lons_cell[lons_cell > 180] -= 360
+        # lons_cell = longtitude_360_to_180(lons_cell)
+
+        rain_in = diag_ds["rainnc"][0] * MM_TO_IN
+    with phase("interp"):
+        trimmed_downscale = set_downscale_ds_extent(downscale_ds, extent)
+        trimmed_downscale = downscale_ds
+        rain_at_downscale = interp_to_downscale_ds(
+            rain_in.to_numpy(), lons_cell, lats_cell, trimmed_downscale
+        )
 
-    lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
-    lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
-    lons_cell[lons_cell > 180] -= 360
-    # lons_cell = longtitude_360_to_180(lons_cell)
-
-    rain_in = diag_ds["rainnc"][0] * MM_TO_IN
-    trimmed_downscale = set_downscale_ds_extent(downscale_ds, extent)
-    trimmed_downscale = downscale_ds
-    rain_at_downscale = interp_to_downscale_ds(
-        rain_in.to_numpy(), lons_cell, lats_cell, trimmed_downscale
-    )
-
-    downscaled_rain = rain_at_downscale * trimmed_downscale.band_data[0]
+        downscaled_rain = rain_at_downscale * trimmed_downscale.band_data[0]
 
-    fig, ax = basemap(display_counties=True)
+    with phase("contour"):
+        fig, ax = basemap(display_counties=True)
 
-    cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
-    norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
+        cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
+        norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
 
-    rain_contours = ax.contourf(
-        trimmed_downscale.x,
-        trimmed_downscale.y,
-        downscaled_rain,
-        PRECIP_CLEVS,
-        levels=PRECIP_CLEVS,
-        cmap=cmap,
-        norm=norm,
-        # tranform=crs.PlateCarree(),
-    )
+        rain_contours = ax.contourf(
+            trimmed_downscale.x,
+            trimmed_downscale.y,
+            downscaled_rain,
+            PRECIP_CLEVS,
+            levels=PRECIP_CLEVS,
+            cmap=cmap,
+            norm=norm,
+            # tranform=crs.PlateCarree(),
+        )
 
-    fig.colorbar(rain_contours, ax=ax, orientation="vertical", pad=0.05)
-    title = plot_title(
-        init_dt, valid_dt, fhour, "Accum Precip", "Dan MPAS Downscaled", "in"
-    )
-    ax.set_title(title)
-    ax.set_extent(extent, crs=crs.PlateCarree())
+        fig.colorbar(rain_contours, ax=ax, orientation="vertical", pad=0.05)
+        title = plot_title(
+            init_dt, valid_dt, fhour, "Accum Precip", "Dan MPAS Downscaled", "in"
+        )
+        ax.set_title(title)
+        ax.set_extent(extent, crs=crs.PlateCarree())
 
     print("saving", f"products/images/{domain_name}-{cycle}z-precip-{fhour_str}.png")
-    fig.savefig(
-        f"products/images/mpas.{cycle}z.{domain_name}.precip.{fhour_str}.png",
-        bbox_inches="tight",
-    )
+    with phase("savefig"):
+        fig.savefig(
+            f"products/images/mpas.{cycle}z.{domain_name}.precip.{fhour_str}.png",
+            bbox_inches="tight",
+        )
     plt.close(fig)
     # plt.show()
 
@@ -521,60 +534,66 @@ def tst2():
     )
 
 
+@spans.timed("plot", product="swe-downscaled")
 def downscaled_swe_plot(
     diag_ds, mesh_ds, downscale_ds, extent, domain_name="colorado12km"
 ):
     init_dt, valid_dt, fhour = ds_times(diag_ds)
     cycle = str(init_dt.hour).zfill(2)
     fhour_str = "f" + str(fhour).zfill(2)
+    phase = functools.partial(spans.span, product="swe-downscaled", fhour=fhour)
+
+    with phase("load"):
+        lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
+        lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
+        lons_cell[lons_cell > 180] -= 360
+        # lons_cell = longtitude_360_to_180(lons_cell)
+
+        snow_in = diag_ds["snownc"][0] * MM_TO_IN
+    with phase("interp"):
+        trimmed_downscale = set_downscale_ds_extent(downscale_ds, extent)
+        trimmed_downscale = downscale_ds
+        snow_at_downscale = interp_to_downscale_ds(
+            snow_in.to_numpy(), lons_cell, lats_cell, trimmed_downscale
+        )
 
-    lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
-    lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
-    lons_cell[lons_cell > 180] -= 360
-    # lons_cell = longtitude_360_to_180(lons_cell)
-
-    snow_in = diag_ds["snownc"][0] * MM_TO_IN
-    trimmed_downscale = set_downscale_ds_extent(downscale_ds, extent)
-    trimmed_downscale = downscale_ds
-    snow_at_downscale = interp_to_downscale_ds(
-        snow_in.to_numpy(), lons_cell, lats_cell, trimmed_downscale
-    )
-
-    downscaled_snow = snow_at_downscale * trimmed_downscale.band_data[0]
+        downscaled_snow = snow_at_downscale * trimmed_downscale.band_data[0]
 
-    fig, ax = basemap(display_counties=True)
+    with phase("contour"):
+        fig, ax = basemap(display_counties=True)
 
-    cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
-    norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
+        cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
+        norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
 
-    snow_contours = ax.contourf(
-        trimmed_downscale.x,
-        trimmed_downscale.y,
-        downscaled_snow,
-        PRECIP_CLEVS,
-        levels=PRECIP_CLEVS,
-        cmap=cmap,
-        norm=norm,
-        # tranform=crs.PlateCarree(),
-    )
+        snow_contours = ax.contourf(
+            trimmed_downscale.x,
+            trimmed_downscale.y,
+            downscaled_snow,
+            PRECIP_CLEVS,
+            levels=PRECIP_CLEVS,
+            cmap=cmap,
+            norm=norm,
+            # tranform=crs.PlateCarree(),
+        )
 
-    fig.colorbar(snow_contours, ax=ax, orientation="vertical", pad=0.05)
-    title = plot_title(
-        init_dt, valid_dt, fhour, "Accum SWE", "Dan MPAS Downscaled", "in"
-    )
-    ax.set_title(title)
-    ax.set_extent(extent, crs=crs.PlateCarree())
+        fig.colorbar(snow_contours, ax=ax, orientation="vertical", pad=0.05)
+        title = plot_title(
+            init_dt, valid_dt, fhour, "Accum SWE", "Dan MPAS Downscaled", "in"
+        )
+        ax.set_title(title)
+        ax.set_extent(extent, crs=crs.PlateCarree())
 
     print("saving", f"products/images/{domain_name}-{cycle}z-swe-{fhour_str}.png")
 
-    fig.savefig(
-        f"products/images/mpas.{cycle}z.{domain_name}.swe.{fhour_str}.png",
-        bbox_inches="tight",
-    )
+    with phase("savefig"):
+        fig.savefig(
+            f"products/images/mpas.{cycle}z.{domain_name}.swe.{fhour_str}.png",
+            bbox_inches="tight",
+        )
     plt.close(fig)
 
 
-@time_it
+@spans.timed("plot", product="swe")
 def accumulated_swe_plot(diag_ds, mesh_ds, domain_name="colorado12km"):
     """outfile_path: Path of MPAS output file (history*, diagnostics*)
        mesh_path: Path of static/init mesh to provide cell lat/lons.
@@ -586,45 +605,49 @@ def accumulated_swe_plot(diag_ds, mesh_ds, domain_name="colorado12km"):
     init_dt, valid_dt, fhour = ds_times(diag_ds)
     cycle = str(init_dt.hour).zfill(2)
     fhour_str = "f" + str(fhour).zfill(2)
-
-    lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
-    lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
-    lons_cell[lons_cell > 180] -= 360
-    # lons_cell = longtitude_360_to_180(lons_cell)
-
-    snow_in = diag_ds["snownc"][0] * MM_TO_IN
-
-    fig, ax = basemap()
-
-    cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
-    norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
-
-    rain_contours = ax.tricontourf(
-        lons_cell,
-        lats_cell,
-        snow_in,
-        PRECIP_CLEVS,
-        levels=PRECIP_CLEVS,
-        cmap=cmap,
-        norm=norm,
-        tranform=crs.PlateCarree(),
-    )
-    fig.colorbar(rain_contours, ax=ax, orientation="vertical", pad=0.05)
-    title = plot_title(init_dt, valid_dt, fhour, "Accum Swe", "Dan MPAS", "in")
-    ax.set_title(title)
-    ax.set_extent(WEST_CONUS_EXTENT, crs=crs.PlateCarree())
+    phase = functools.partial(spans.span, product="swe", fhour=fhour)
+
+    with phase("load"):
+        lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
+        lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
+        lons_cell[lons_cell > 180] -= 360
+        # lons_cell = longtitude_360_to_180(lons_cell)
+
+        snow_in = diag_ds["snownc"][0] * MM_TO_IN
+
+    with phase("contour"):
+        fig, ax = basemap()
+
+        cmap = mcolors.ListedColormap(PRECIP_CMAP_DATA)
+        norm = mcolors.BoundaryNorm(PRECIP_CLEVS, cmap.N)
+
+        rain_contours = ax.tricontourf(
+            lons_cell,
+            lats_cell,
+            snow_in,
+            PRECIP_CLEVS,
+            levels=PRECIP_CLEVS,
+            cmap=cmap,
+            norm=norm,
+            tranform=crs.PlateCarree(),
+        )
+        fig.colorbar(rain_contours, ax=ax, orientation="vertical", pad=0.05)
+        title = plot_title(init_dt, valid_dt, fhour, "Accum Swe", "Dan MPAS", "in")
+        ax.set_title(title)
+        ax.set_extent(WEST_CONUS_EXTENT, crs=crs.PlateCarree())
 
     print("saving", f"products/images/{domain_name}-{cycle}z-swe-{fhour_str}.png")
-    fig.savefig(
-        f"products/images/mpas.{cycle}z.{domain_name}.swe.{fhour_str}.png",
-        bbox_inches="tight",
-    )
+    with phase("savefig"):
+        fig.savefig(
+            f"products/images/mpas.{cycle}z.{domain_name}.swe.{fhour_str}.png",
+            bbox_inches="tight",
+        )
     plt.close(fig)
 
     # fig.show()
 
 
-@time_it
+@spans.timed("plot", product="vort500")
 def plot_500_vorticity(diag_ds, mesh_ds, domain_name="colorado12km"):
     """outfile_path: Path of MPAS output file (history*, diagnostics*)
        mesh_path: Path of static/init mesh to provide cell lat/lons.
@@ -636,53 +659,59 @@ def plot_500_vorticity(diag_ds, mesh_ds, domain_name="colorado12km"):
     init_dt, valid_dt, fhour = ds_times(diag_ds)
     cycle = str(init_dt.hour).zfill(2)
     fhour_str = "f" + str(fhour).zfill(2)
-
-    lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
-    lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
-    lons_cell[lons_cell > 180] -= 360
-    # lons_cell = longtitude_360_to_180(lons_cell)
-
-    lats_vert = mesh_ds["latVertex"] * RADIAN_TO_DEGREE
-    lons_vert = mesh_ds["lonVertex"] * RADIAN_TO_DEGREE
-    lons_vert[lons_vert > 180] -= 360
-    # lons_vert = longtitude_360_to_180(lons_vert)
-
-    hgt_500_cell = diag_ds["height_500hPa"][0]
-    hgt_500_cell_dm = hgt_500_cell / 10
-    hgt_levels = np.arange(492, 594, 3)
-    u_500_cell = diag_ds["uzonal_500hPa"][0] * M_PER_S_TO_KT
-    v_500_cell = diag_ds["umeridional_500hPa"][0] * M_PER_S_TO_KT
-    vort_500_vert = diag_ds["vorticity_500hPa"][0]
-    vort_500_vert_scaled = vort_500_vert * 10**5
-
-    grid_500_x, grid_500_y, grid_500_u = grid_data(lons_cell, lats_cell, u_500_cell)
-    # grid_500_xvort, grid_500_yvort, grid_500_vert_scaled = grid_data(lons_vert, lats_vert, vort_500_vert_scaled)
-    _, _, grid_500_v = grid_data(lons_cell, lats_cell, v_500_cell)
+    phase = functools.partial(spans.span, product="vort500", fhour=fhour)
+
+    with phase("load"):
+        lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
+        lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
+        lons_cell[lons_cell > 180] -= 360
+        # lons_cell = longtitude_360_to_180(lons_cell)
+
+        lats_vert = mesh_ds["latVertex"] * RADIAN_TO_DEGREE
+        lons_vert = mesh_ds["lonVertex"] * RADIAN_TO_DEGREE
+        lons_vert[lons_vert > 180] -= 360
+        # lons_vert = longtitude_360_to_180(lons_vert)
+
+        hgt_500_cell = diag_ds["height_500hPa"][0]
+        hgt_500_cell_dm = hgt_500_cell / 10
+        hgt_levels = np.arange(492, 594, 3)
+        u_500_cell = diag_ds["uzonal_500hPa"][0] * M_PER_S_TO_KT
+        v_500_cell = diag_ds["umeridional_500hPa"][0] * M_PER_S_TO_KT
+        vort_500_vert = diag_ds["vorticity_500hPa"][0]
+        vort_500_vert_scaled = vort_500_vert * 10**5
+
+    with phase("interp"):
+        grid_500_x, grid_500_y, grid_500_u = grid_data(lons_cell, lats_cell, u_500_cell)
+        # grid_500_xvort, grid_500_yvort, grid_500_vert_scaled = grid_data(lons_vert, lats_vert, vort_500_vert_scaled)
+        _, _, grid_500_v = grid_data(lons_cell, lats_cell, v_500_cell)
 
     #central_longitude = np.mean([np.max(lons_cell), np.min(lons_cell)])
-    central_longitude = -113
-    fig, ax = basemap(crs.LambertConformal(central_longitude=central_longitude))
-    # fig, ax = basemap()
+    with phase("contour"):
+        central_longitude = -113
+        fig, ax = basemap(crs.LambertConformal(central_longitude=central_longitude))
+        # fig, ax = basemap()
 
-    fig, ax = add_geopotential_hgt(
-        fig, ax, lons_cell, lats_cell, hgt_500_cell_dm, hgt_levels
-    )
-    fig, ax = add_rel_vorticity(fig, ax, lons_vert, lats_vert, vort_500_vert_scaled)
-    # fig, ax = add_rel_vorticity_grid(fig, ax, grid_500_xvort, grid_500_yvort, grid_500_vert_scaled)
-    fig, ax = add_wind_barbs(
-        fig,
-        ax,
-        grid_500_x,
-        grid_500_y,
-        grid_500_u,
-        grid_500_v,
-    )
+        fig, ax = add_geopotential_hgt(
+            fig, ax, lons_cell, lats_cell, hgt_500_cell_dm, hgt_levels
+        )
+        fig, ax = add_rel_vorticity(fig, ax, lons_vert, lats_vert, vort_500_vert_scaled)
+        # fig, ax = add_rel_vorticity_grid(fig, ax, grid_500_xvort, grid_500_yvort, grid_500_vert_scaled)
+        fig, ax = add_wind_barbs(
+            fig,
+            ax,
+            grid_500_x,
+            grid_500_y,
+            grid_500_u,
+            grid_500_v,
+        )
 
-    # ax.set_xlim((np.min(lons_vert), np.max(lons_vert)))
-    # ax.set_ylim((np.min(lats_vert), np.max(lats_vert)))
+        # ax.set_xlim((np.min(lons_vert), np.max(lons_vert)))
+        # ax.set_ylim((np.min(lats_vert), np.max(lats_vert)))
 
-    title = plot_title(init_dt, valid_dt, fhour, "Rel Vort", "Dan MPAS", "10^5 s^-1")
-    ax.set_title(title)
+        title = plot_title(
+            init_dt, valid_dt, fhour, "Rel Vort", "Dan MPAS", "10^5 s^-1"
+        )
+        ax.set_title(title)
     # ax.set_extent(NA_EXTENT, crs=crs.PlateCarree())
     # left = np.min(lons_cell)
     # right = np.max(lons_cell)
@@ -691,10 +720,11 @@ def plot_500_vorticity(diag_ds, mesh_ds, domain_name="colorado12km"):
     # ax.set_extent([left, right, bottom, top], crs=crs.PlateCarree())
 
     print("saving", f"mpas.{cycle}z.{domain_name}.vort500.{fhour_str}.png")
-    fig.savefig(
-        f"products/images/mpas.{cycle}z.{domain_name}.vort500.{fhour_str}.png",
-        bbox_inches="tight",
-    )
+    with phase("savefig"):
+        fig.savefig(
+            f"products/images/mpas.{cycle}z.{domain_name}.vort500.{fhour_str}.png",
+            bbox_inches="tight",
+        )
 
     plt.close(fig)
     # fig.show()
@@ -708,7 +738,7 @@ def make_extent_mask(extent, lons, lats):
     return lon_mask & lat_mask
 
 
-@time_it
+@spans.timed("plot", product="rh700")
 def plot_700_rh(diag_ds, mesh_ds, domain_name="colorado12km"):
     """outfile_path: Path of MPAS output file (history*, diagnostics*)
        mesh_path: Path of static/init mesh to provide cell lat/lons.
@@ -720,63 +750,68 @@ def plot_700_rh(diag_ds, mesh_ds, domain_name="colorado12km"):
     init_dt, valid_dt, fhour = ds_times(diag_ds)
     cycle = str(init_dt.hour).zfill(2)
     fhour_str = "f" + str(fhour).zfill(2)
+    phase = functools.partial(spans.span, product="rh700", fhour=fhour)
 
-    lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
-    lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
-    lons_cell[lons_cell > 180] -= 360
-    # lons_cell = longtitude_360_to_180(lons_cell)
+    with phase("load"):
+        lats_cell = mesh_ds["latCell"] * RADIAN_TO_DEGREE
+        lons_cell = mesh_ds["lonCell"] * RADIAN_TO_DEGREE
+        lons_cell[lons_cell > 180] -= 360
+        # lons_cell = longtitude_360_to_180(lons_cell)
 
-    rh_700 = diag_ds["relhum_700hPa"][0]
-    hgt_700_cell = diag_ds["height_700hPa"][0]
-    hgt_700_cell_dm = hgt_700_cell / 10
-    hgt_700_levels = np.arange(180, 420, 3)
+        rh_700 = diag_ds["relhum_700hPa"][0]
+        hgt_700_cell = diag_ds["height_700hPa"][0]
+        hgt_700_cell_dm = hgt_700_cell / 10
+        hgt_700_levels = np.arange(180, 420, 3)
 
-    u_700_cell = diag_ds["uzonal_700hPa"][0] * M_PER_S_TO_KT
-    v_700_cell = diag_ds["umeridional_700hPa"][0] * M_PER_S_TO_KT
+        u_700_cell = diag_ds["uzonal_700hPa"][0] * M_PER_S_TO_KT
+        v_700_cell = diag_ds["umeridional_700hPa"][0] * M_PER_S_TO_KT
 
-    grid_700_x, grid_700_y, grid_700_u = grid_data(lons_cell, lats_cell, u_700_cell)
-    _, _, grid_700_v = grid_data(lons_cell, lats_cell, v_700_cell)
+    with phase("interp"):
+        grid_700_x, grid_700_y, grid_700_u = grid_data(lons_cell, lats_cell, u_700_cell)
+        _, _, grid_700_v = grid_data(lons_cell, lats_cell, v_700_cell)
 
     #central_longitude = np.mean([np.max(lons_cell), np.min(lons_cell)])
-    central_longitude = -113
-    fig, ax = basemap(crs.LambertConformal(central_longitude=central_longitude))
-    # ax.set_extent(NA_EXTENT, crs=crs.PlateCarree())
-
-    # Remove points where terrain is above the lowest contour level
-    # to not have messed up contour lines in these areas
-    unmasked = mesh_ds.ter < (10 * 180)
-    lons_cell_unmasked = lons_cell[unmasked]
-    lats_cell_unmasked = lats_cell[unmasked]
-    hgt_700_cell_dm_unmasked = hgt_700_cell_dm[unmasked]
-    fig, ax = add_geopotential_hgt(
-        fig,
-        ax,
-        lons_cell_unmasked,
-        lats_cell_unmasked,
-        hgt_700_cell_dm_unmasked,
-        hgt_700_levels,
-    )
+    with phase("contour"):
+        central_longitude = -113
+        fig, ax = basemap(crs.LambertConformal(central_longitude=central_longitude))
+        # ax.set_extent(NA_EXTENT, crs=crs.PlateCarree())
+
+        # Remove points where terrain is above the lowest contour level
+        # to not have messed up contour lines in these areas
+        unmasked = mesh_ds.ter < (10 * 180)
+        lons_cell_unmasked = lons_cell[unmasked]
+        lats_cell_unmasked = lats_cell[unmasked]
+        hgt_700_cell_dm_unmasked = hgt_700_cell_dm[unmasked]
+        fig, ax = add_geopotential_hgt(
+            fig,
+            ax,
+            lons_cell_unmasked,
+            lats_cell_unmasked,
+            hgt_700_cell_dm_unmasked,
+            hgt_700_levels,
+        )
 
-    fig, ax = add_relative_humidity(fig, ax, lons_cell, lats_cell, rh_700)
+        fig, ax = add_relative_humidity(fig, ax, lons_cell, lats_cell, rh_700)
 
-    fig, ax = add_wind_barbs(
-        fig,
-        ax,
-        grid_700_x,
-        grid_700_y,
-        grid_700_u,
-        grid_700_v,
-    )
+        fig, ax = add_wind_barbs(
+            fig,
+            ax,
+            grid_700_x,
+            grid_700_y,
+            grid_700_u,
+            grid_700_v,
+        )
 
-    title = plot_title(init_dt, valid_dt, fhour, "700mb RH", "Dan MPAS", "%")
-    ax.set_title(title)
+        title = plot_title(init_dt, valid_dt, fhour, "700mb RH", "Dan MPAS", "%")
+        ax.set_title(title)
     # ax.set_extent(NA_EXTENT, crs=crs.PlateCarree())
 
     print("saving", f"products/images/{domain_name}-{cycle}z-rh700-{fhour_str}.png")
-    fig.savefig(
-        f"products/images/mpas.{cycle}z.{domain_name}.rh700.{fhour_str}.png",
-        bbox_inches="tight",
-    )
+    with phase("savefig"):
+        fig.savefig(
+            f"products/images/mpas.{cycle}z.{domain_name}.rh700.{fhour_str}.png",
+            bbox_inches="tight",
+        )
     fig.show()
     # plt.close(fig)
 
@@ -923,14 +958,10 @@ def precip_plots(diag_files, mesh_file, domain_name):
 
 
 def downscaled_precip_plots(diag_files, mesh_file, downscale_file):
-    regions = [
-        ("frange-downscaled", FRONT_RANGE_EXTENT),
-        ("wasatch-downscaled", WASATCH_EXTENT),
-    ]
     mesh_ds = xr.open_dataset(mesh_file)
     downscale_ds = xr.open_dataset(downscale_file)
     for diag_file in diag_files:
-        for domain_name, extent in regions:
+        for domain_name, extent in DOWNSCALE_REGIONS:
             try:
                 diag_ds = xr.open_dataset(diag_file)
                 downscaled_precip_plot(
@@ -941,14 +972,10 @@ def downscaled_precip_plots(diag_files, mesh_file, downscale_file):
 
 
 def downscaled_swe_plots(diag_files, mesh_file, downscale_file):
-    regions = [
-        ("frange-downscaled", FRONT_RANGE_EXTENT),
-        ("wasatch-downscaled", WASATCH_EXTENT),
-    ]
     mesh_ds = xr.open_dataset(mesh_file)
     downscale_ds = xr.open_dataset(downscale_file)
     for diag_file in diag_files:
-        for domain_name, extent in regions:
+        for domain_name, extent in DOWNSCALE_REGIONS:
             try:
                 diag_ds = xr.open_dataset(diag_file)
                 downscaled_swe_plot(diag_ds, mesh_ds, downscale_ds, extent, domain_name)
@@ -956,13 +983,129 @@ def downscaled_swe_plots(diag_files, mesh_file, downscale_file):
                 print("precip plot exception: ", str(e))
 
 
-def main(domain_name="colorado12km", downscale_file="15km-800m-downscale.nc"):
+# Product name, as in products.PRODUCTS, to the function drawing it
+PLOTTERS = {
+    "precip": accumulated_precip_plot,
+    "swe": accumulated_swe_plot,
+    "vort500": plot_500_vorticity,
+    "rh700": plot_700_rh,
+}
+DOWNSCALED_PLOTTERS = {
+    "precip-downscaled": downscaled_precip_plot,
+    "swe-downscaled": downscaled_swe_plot,
+}
+
+# What a warm plot worker keeps loaded between diag files and cycles
+_worker_datasets = {}
+
+
+def product_names(downscaled=False):
+    return list(PLOTTERS) + (list(DOWNSCALED_PLOTTERS) if downscaled else [])
+
+
+def init_worker(mesh_file, downscale_file=None, cpus=None):
+    """Pool initializer for long lived plot workers. The mesh geometry and
+    downscale ratios are loaded once instead of for every product. cpus pins
+    the worker to cores kept free of MPI ranks"""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    with xr.open_dataset(mesh_file) as mesh_ds:
+        _worker_datasets["mesh"] = mesh_ds[MESH_VARIABLES].load()
+    if downscale_file and os.path.exists(downscale_file):
+        with xr.open_dataset(downscale_file) as downscale_ds:
+            _worker_datasets["downscale"] = downscale_ds.load()
+
+
+def plot_product(diag_file, product, domain_name):
+    "Draws one product of one diag file in a worker set up by init_worker"
+    mesh_ds = _worker_datasets["mesh"]
+    try:
+        with xr.open_dataset(diag_file) as diag_ds:
+            init_dt, _, _ = ds_times(diag_ds)
+            # Workers outlive cycles so the cycle comes from the file
+            spans.set_cycle(init_dt)
+            if product in DOWNSCALED_PLOTTERS:
+                for region, extent in DOWNSCALE_REGIONS:
+                    DOWNSCALED_PLOTTERS[product](
+                        diag_ds, mesh_ds, _worker_datasets["downscale"], extent, region
+                    )
+            else:
+                PLOTTERS[product](diag_ds, mesh_ds, domain_name)
+    finally:
+        # Some plots leave their figure open, a long lived worker can't
+        plt.close("all")
+    return diag_file, product
+
+
+def queue_products(pool, diag_file, domain_name, products):
+    "Queues each product of a diag file on a pool set up by init_worker"
+    return [
+        pool.apply_async(
+            plot_product,
+            (diag_file, product, domain_name),
+            error_callback=error_callback,
+        )
+        for product in products
+    ]
+
+
+def render_live(pool, watcher, running, products_dir, domain_name, products):
+    """Publishes each diag file to products_dir and queues its products as
+    soon as the watcher sees the model close it, while running() is True.
+    Returns the queued results"""
+    results = []
+    for diag_file in watcher.follow(running, products_dir):
+        print("Plotting", diag_file)
+        results += queue_products(pool, diag_file, domain_name, products)
+    return results
+
+
+def watch(
+    domain_name,
+    run_dir,
+    init_date,
+    flength,
+    products_dir="products/mpas",
+    workers=2,
+    downscale_file="15km-800m-downscale.nc",
+    startup_timeout=diag_watcher.STARTUP_SECONDS,
+):
+    """Draws the products of each hour of the forecast running in run_dir
+    while later hours are still integrating, until the model exits. A
+    forecast that already finished is drawn from its files, and the watch
+    stops after startup_timeout seconds if no model starts"""
+    watcher = diag_watcher.DiagWatcher(run_dir, init_date, flength, startup_timeout)
+    products = product_names(os.path.exists(downscale_file))
+    with mp.Pool(
+        workers,
+        initializer=init_worker,
+        initargs=(workspace.static_path(domain_name), downscale_file),
+    ) as pool:
+        results = render_live(
+            pool, watcher, watcher.model_running, products_dir, domain_name, products
+        )
+        for result in results:
+            result.wait()
+
+
+def main(
+    domain_name="colorado12km",
+    downscale_file="15km-800m-downscale.nc",
+    file_dir="products/mpas",
+):
+    """file_dir: Directory of diag files, products/mpas/<domain> for runs made
+    in a workspace"""
     # domain_name = "colorado12km"
-    file_dir = "products/mpas"
     files = sorted([f"{file_dir}/{f}" for f in os.listdir(file_dir) if ".nc" in f])
 
     # mesh_ds = xr.open_dataset(f"MPAS-Model/{domain_name}.static.nc")
-    mesh_file = f"MPAS-Model/{domain_name}.static.nc"
+    mesh_file = workspace.static_path(domain_name)
+
+    # Run on its own, the plots' spans go to the cycle of the diag files
+    if spans.cycle_id() == spans.UNKNOWN_CYCLE and files:
+        with xr.open_dataset(files[0]) as ds:
+            init_dt, _, _ = ds_times(ds)
+        spans.set_cycle(init_dt)
 
     with mp.Pool() as pool:
         """
@@ -1037,6 +1180,62 @@ if __name__ == "__main__":
         help="Precip downscale ratio file",
     )
 
+    parser.add_argument(
+        "--products-dir",
+        type=str,
+        default="products/mpas",
+        help="Directory holding the diag files",
+    )
+
+    parser.add_argument(
+        "--watch",
+        type=str,
+        default=None,
+        help="Run directory of a running model to draw each hour from as it is written",
+    )
+
+    parser.add_argument(
+        "--init",
+        type=str,
+        default=None,
+        help="YYYYMMDDHH of the watched forecast",
+    )
+
+    parser.add_argument(
+        "--length",
+        type=int,
+        default=24,
+        help="Forecast hours of the watched forecast",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="Plot processes, cores the model leaves free when watching",
+    )
+
+    parser.add_argument(
+        "--startup-minutes",
+        type=float,
+        default=diag_watcher.STARTUP_SECONDS / 60,
+        help="Stop watching if the model has not started by then",
+    )
+
     args = parser.parse_args()
 
-    main(domain_name=args.domain)
+    if args.watch:
+        init_date = datetime.strptime(args.init, "%Y%m%d%H")
+        spans.set_cycle(init_date)
+        watch(
+            args.domain,
+            args.watch,
+            init_date,
+            args.length,
+            products_dir=args.products_dir,
+            workers=args.workers,
+            downscale_file=args.downscale_file,
+            startup_timeout=args.startup_minutes * 60,
+        )
+    else:
+        main(domain_name=args.domain, file_dir=args.products_dir)
@@ -0,0 +1,64 @@
+"""Catalog of the plot products and the diagnostics fields each one reads.
+The diagnostics stream list is generated from it so the model only writes
+what plot_raw.py uses"""
+
+DIAGNOSTICS_STREAM_LIST = "stream_list.atmosphere.diagnostics"
+
+# Read by every product to label the valid and initial times
+TIME_FIELDS = ("initial_time", "xtime")
+
+# Product name, as in the image file names, to the diag fields it reads.
+# Mesh coordinates and terrain come from the static file
+PRODUCTS = {
+    "precip": ("rainnc",),
+    "swe": ("snownc",),
+    "vort500": (
+        "height_500hPa",
+        "uzonal_500hPa",
+        "umeridional_500hPa",
+        "vorticity_500hPa",
+    ),
+    "rh700": (
+        "relhum_700hPa",
+        "height_700hPa",
+        "uzonal_700hPa",
+        "umeridional_700hPa",
+    ),
+}
+
+# Extra surface and severe weather fields kept when archiving a run
+ARCHIVE_FIELDS = (
+    "rainc",
+    "t2m",
+    "q2",
+    "u10",
+    "v10",
+    "mslp",
+    "precipw",
+    "olrtoa",
+    "refl10cm_max",
+    "cape",
+    "cin",
+    "updraft_helicity_max",
+    "wind_speed_level1_max",
+)
+
+
+def diagnostics_fields(products=None, archive=False):
+    """Diag fields for the products, every product if None. Ordered and
+    without duplicates"""
+    if products is None:
+        products = list(PRODUCTS)
+
+    fields = list(TIME_FIELDS)
+    for product in products:
+        fields += PRODUCTS[product]
+    if archive:
+        fields += ARCHIVE_FIELDS
+
+    return list(dict.fromkeys(fields))
+
+
+def write_stream_list(fpath, fields):
+    with open(fpath, "w") as f:
+        f.write("\n".join(fields) + "\n")
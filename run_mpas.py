@@ -1,6 +1,4 @@
 from datetime import datetime, timedelta
-import requests
-import concurrent.futures
 import f90nml
 import os
 import xml.etree.ElementTree as ET
@@ -9,12 +7,45 @@ import subprocess
 import xarray as xr
 import numpy as np
 import argparse
+import concurrent.futures
+import functools
+import glob
+from itertools import repeat
+import json
+import shutil
+import string
+import threading
+import time
+
+import cache
+import decomposition
+import grib_check
+import intermediate
+import io_tuning
+import manifest
+import mesh
+import mpas_log
+import nomads
+import perf_history
+import pipeline
+import planner
+import products
+import spans
+import supervisor
+import ungrib
+import vtable
+import workspace
 
 NAMELIST_DATE_FORMAT = "%Y-%m-%d_%H:%M:%S"
 RUN_DURATION_FORMAT = "%-d_%H:%M:%S"
 
 ROOT_DIR = os.environ["ROOT_DIR"]
+WPS_DIR = f"{ROOT_DIR}/tools/WPS-4.4"
+MPAS_DIR = f"{ROOT_DIR}/MPAS-Model"
 NCPUS = 6
+# First guess levels init_atmosphere reads, surface included
+NFGLEVELS = 38
+VALIDATION_ATTEMPTS = 2
 
 RADIAN_TO_DEGREE = 180 / np.pi
 
@@ -110,7 +141,21 @@ def is_last_cycle_yesterday():
         return False
 
 
-def latest_gfs_init_date():
+def gfs_product(resolution_km, limited_area=True):
+    """The GFS product a run downloads, 0.5 degree for global meshes and for
+    limited areas of 25km and coarser"""
+    if resolution_km >= 25 or not limited_area:
+        return "pgrb2.0p50"
+    return "pgrb2.0p25"
+
+
+def latest_gfs_init_date(discover=False, product="pgrb2.0p25"):
+    """discover: Probe NOMADS for the newest cycle with the product's
+    analysis published"""
+    if discover:
+        date, _ = nomads.discover_latest_cycle(product)
+        return date
+
     now = datetime.utcnow()
     cycle = select_gfs_cycle()
     print("CYCLE", cycle)
@@ -132,11 +177,49 @@ def grib_filename(valid_dt, cycle, fhour, model="gfs"):
     return fname
 
 
-def download_filtered_grib(init_date, cycle, fhour, extent=DEFAULT_EXTENT):
-    """Downloads gribs filtered to selected area"""
+def grib_path(init_date, cycle, fhour):
+    return f"{ROOT_DIR}/data/grib/{grib_filename(init_date, cycle, fhour, 'gfs')}"
+
+
+def grib_cache_fields(init_date, fhour, product, extent=None, fields="all"):
+    "Identifies a downloaded GRIB file in the cache"
+    if extent is not None:
+        extent = [[round(float(v), 3) for v in pair] for pair in extent]
+    return {
+        "cycle": init_date.isoformat(),
+        "fhour": fhour,
+        "product": product,
+        "extent": extent,
+        "fields": fields,
+    }
+
+
+def fetch_cached_grib(cache_fields, fpath):
+    grib_cache = cache.grib_cache()
+    if grib_cache.fetch(grib_cache.key(**cache_fields), fpath):
+        print("Cached", os.path.basename(fpath))
+        return True
+    return False
+
+
+def store_cached_grib(cache_fields, fpath):
+    grib_cache = cache.grib_cache()
+    grib_cache.store(grib_cache.key(**cache_fields), fpath, **cache_fields)
+
+
+def download_filtered_grib(
+    init_date, cycle, fhour, extent=DEFAULT_EXTENT, field_params=None
+):
+    """Downloads gribs filtered to selected area
+    field_params: var_*/lev_* filter parameters. Every variable and level
+                  is requested when None"""
 
-    grib_dir = f"{ROOT_DIR}/data/grib"
-    fname = grib_filename(init_date, cycle, fhour, "gfs")
+    fpath = grib_path(init_date, cycle, fhour)
+    cache_fields = grib_cache_fields(
+        init_date, fhour, "pgrb2.0p25", extent, field_params or "all"
+    )
+    if fetch_cached_grib(cache_fields, fpath):
+        return 200, 0
 
     fhour = str(fhour).zfill(3)
     cycle = str(cycle).zfill(2)
@@ -147,8 +230,6 @@ def download_filtered_grib(init_date, cycle, fhour, extent=DEFAULT_EXTENT):
 
     params = {
         "file": f"gfs.t{cycle}z.pgrb2.0p25.f{fhour}",
-        "all_lev": "on",
-        "all_var": "on",
         "subregion": "",
         "leftlon": leflon,
         "rightlon": rightlon,
@@ -157,19 +238,31 @@ def download_filtered_grib(init_date, cycle, fhour, extent=DEFAULT_EXTENT):
         "dir": f"/gfs.{init_day_of_year}/{cycle}/atmos",
     }
 
+    if field_params:
+        params.update(field_params)
+    else:
+        params.update({"all_lev": "on", "all_var": "on"})
+
     url = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl?"
 
-    print("Downloading", fname)
-    r = requests.get(url, params=params)
-    with open(f"{grib_dir}/{fname}", "wb") as f:
-        f.write(r.content)
+    print("Downloading", os.path.basename(fpath))
+    with spans.span("download", kind="download", fhour=int(fhour)) as span:
+        status_code, transferred = nomads.download_file(url, fpath, params=params)
+        span.update(bytes=transferred, status=status_code)
+    if 200 <= status_code < 300:
+        store_cached_grib(cache_fields, fpath)
 
-    return r.status_code
+    return status_code, transferred
 
 
-def download_0p50_grib(date, cycle, fhour):
-    grib_dir = f"{ROOT_DIR}/data/grib"
-    fname = grib_filename(date, cycle, fhour, "gfs")
+def download_0p50_grib(date, cycle, fhour, keep=None, fields="all"):
+    """keep: Optional .idx record predicate. When given only the matching
+    messages are fetched with byte range requests
+    fields: Identifies the message subset keep selects in the GRIB cache"""
+    fpath = grib_path(date, cycle, fhour)
+    cache_fields = grib_cache_fields(date, fhour, "pgrb2.0p50", fields=fields)
+    if fetch_cached_grib(cache_fields, fpath):
+        return 200, 0
 
     fhour = str(fhour).zfill(3)
     cycle = str(cycle).zfill(2)
@@ -183,73 +276,367 @@ def download_0p50_grib(date, cycle, fhour):
 
     url = base_url + date_url
 
-    print("Downloading", fname)
-    r = requests.get(url)
-    with open(f"{grib_dir}/{fname}", "wb") as f:
-        f.write(r.content)
+    print("Downloading", os.path.basename(fpath))
+    with spans.span("download", kind="download", fhour=int(fhour)) as span:
+        if keep is not None:
+            status_code, transferred = nomads.download_grib_subset(url, fpath, keep)
+        else:
+            status_code, transferred = nomads.download_file(url, fpath)
+        span.update(bytes=transferred, status=status_code)
 
-    return r.status_code
+    if 200 <= status_code < 300:
+        store_cached_grib(cache_fields, fpath)
 
+    return status_code, transferred
 
-def download_0p50_gribs(date, flength):
-    "0.5deg gribs every 3 hours"
-    cycle = str(date.hour).zfill(2)
 
-    fhours = [i for i in range(0, flength + 1, 3)]
-    dates = [date for i in fhours]
-    cycles = [cycle for i in fhours]
+def vtable_filter_params():
+    "NOMADS filter parameters for the fields ungrib needs, None on failure"
+    try:
+        return vtable.filter_params(vtable.read_vtable(), NFGLEVELS)
+    except (OSError, KeyError) as e:
+        print("Requesting all GRIB fields:", str(e))
+        return None
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        responses = executor.map(download_0p50_grib, dates, cycles, fhours)
 
-    return responses
+def vtable_idx_filter():
+    "Predicate for the .idx records ungrib needs, None if it can't be built"
+    try:
+        return vtable.idx_filter(vtable.read_vtable())
+    except (OSError, KeyError) as e:
+        print("Not subsetting GRIB files:", str(e))
+        return None
 
 
-def download_gribs(init_date, flength, extent=DEFAULT_EXTENT):
+def validate_gribs(init_date, fhours, refetch_job, cache_fields, on_invalid=None):
+    """Checks the downloaded GRIB files of a cycle and re-downloads the
+    broken forecast hours until they pass or the attempts run out.
+    refetch_job(fhour): download job for the scheduler
+    cache_fields(fhour): GRIB cache fields of the hour's file
+    on_invalid(fhour): Called before a broken hour's file is deleted"""
     cycle = str(init_date.hour).zfill(2)
+    entries = vtable.read_vtable()
+    report_path = (
+        f"{ROOT_DIR}/data/reports/grib-validation.{init_date.strftime('%Y%m%d%H')}.json"
+    )
+
+    for attempt in range(VALIDATION_ATTEMPTS + 1):
+        fpaths = {fhour: grib_path(init_date, cycle, fhour) for fhour in fhours}
+        report = grib_check.validate_gribs(fpaths, entries, NFGLEVELS)
+        with open(report_path, "w") as f:
+            json.dump({"attempt": attempt, "hours": report}, f, indent=2)
+
+        broken = [fhour for fhour in fhours if report[fhour]["problems"]]
+        if not broken:
+            for fhour in fhours:
+                for warning in report[fhour]["warnings"]:
+                    print("GRIB", fhour, warning)
+            return report
+
+        for fhour in broken:
+            print("Invalid GRIB", fhour, report[fhour]["problems"])
+
+        if attempt == VALIDATION_ATTEMPTS:
+            raise RuntimeError(f"GRIB forecast hours {broken} still invalid")
+
+        grib_cache = cache.grib_cache()
+        for fhour in broken:
+            if on_invalid is not None:
+                on_invalid(fhour)
+            grib_cache.remove(grib_cache.key(**cache_fields(fhour)))
+            if os.path.exists(fpaths[fhour]):
+                os.remove(fpaths[fhour])
+
+        nomads.DownloadScheduler().run([refetch_job(fhour) for fhour in broken])
+
+
+def notify_on_success(job, fhour, on_ready):
+    "Wraps a download job to call on_ready(fhour) once its file is written"
+    func, args = job
+
+    def download(*args):
+        status_code, transferred = func(*args)
+        if on_ready is not None and 200 <= status_code < 300:
+            on_ready(fhour)
+        return status_code, transferred
 
-    fhours = [i for i in range(flength + 1)]
-    init_dates = [init_date for i in fhours]
-    cycles = [cycle for i in fhours]
-    extents = [extent for i in fhours]
+    return download, args
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        responses = executor.map(
-            download_filtered_grib, init_dates, cycles, fhours, extents
+
+def download_0p50_gribs(
+    date, flength, wait=False, subset=True, on_ready=None, on_invalid=None
+):
+    """0.5deg gribs every 3 hours
+    wait: Download each hour as soon as it is published instead of
+          assuming the whole cycle is already on NOMADS
+    subset: Only download the messages listed in Vtable.GFS
+    on_ready: Called with each forecast hour once its file is in data/grib,
+              and again for every hour once all of them passed validation
+    on_invalid: Called with an hour that failed validation before its file
+                is deleted and downloaded again, see validate_gribs"""
+    cycle = str(date.hour).zfill(2)
+    keep = vtable_idx_filter() if subset else None
+    # A Vtable edit changes the subset so it has to change the cache key
+    fields = cache.file_digest(vtable.VTABLE_GFS) if keep else "all"
+
+    all_fhours = list(range(0, flength + 1, 3))
+    fhours = []
+    for fhour in all_fhours:
+        cache_fields = grib_cache_fields(date, fhour, "pgrb2.0p50", fields=fields)
+        if not fetch_cached_grib(cache_fields, grib_path(date, cycle, fhour)):
+            fhours.append(fhour)
+        elif on_ready is not None:
+            on_ready(fhour)
+
+    if wait:
+        fhours = nomads.wait_for_fhours(date, fhours, "pgrb2.0p50")
+
+    def job(fhour):
+        return (download_0p50_grib, (date, cycle, fhour, keep, fields))
+
+    jobs = (notify_on_success(job(fhour), fhour, on_ready) for fhour in fhours)
+    status_codes = nomads.DownloadScheduler().run(jobs)
+
+    validate_gribs(
+        date,
+        all_fhours,
+        job,
+        lambda fhour: grib_cache_fields(date, fhour, "pgrb2.0p50", fields=fields),
+        on_invalid,
+    )
+
+    if on_ready is not None:
+        for fhour in all_fhours:
+            on_ready(fhour)
+
+    return status_codes
+
+
+def download_gribs(
+    init_date,
+    flength,
+    extent=DEFAULT_EXTENT,
+    wait=False,
+    trim_fields=True,
+    on_ready=None,
+    on_invalid=None,
+):
+    """trim_fields: Only request the variables and levels in Vtable.GFS
+    on_ready: Called with each forecast hour once its file is in data/grib,
+              and again for every hour once all of them passed validation
+    on_invalid: Called with an hour that failed validation before its file
+                is deleted and downloaded again, see validate_gribs"""
+    cycle = str(init_date.hour).zfill(2)
+    field_params = vtable_filter_params() if trim_fields else None
+
+    def cache_fields(fhour):
+        return grib_cache_fields(
+            init_date, fhour, "pgrb2.0p25", extent, field_params or "all"
         )
 
-    return responses
+    all_fhours = list(range(flength + 1))
+    fhours = []
+    for fhour in all_fhours:
+        if not fetch_cached_grib(
+            cache_fields(fhour), grib_path(init_date, cycle, fhour)
+        ):
+            fhours.append(fhour)
+        elif on_ready is not None:
+            on_ready(fhour)
+
+    if wait:
+        fhours = nomads.wait_for_fhours(init_date, fhours, "pgrb2.0p25")
+
+    def job(fhour):
+        return (
+            download_filtered_grib,
+            (init_date, cycle, fhour, extent, field_params),
+        )
+
+    jobs = (notify_on_success(job(fhour), fhour, on_ready) for fhour in fhours)
+    status_codes = nomads.DownloadScheduler().run(jobs)
+
+    validate_gribs(init_date, all_fhours, job, cache_fields, on_invalid)
+
+    if on_ready is not None:
+        for fhour in all_fhours:
+            on_ready(fhour)
 
+    return status_codes
 
-def download_latest_grib(flength=12, globe=False, extent=DEFAULT_EXTENT):
-    date = latest_gfs_init_date()
+
+def download_latest_grib(
+    flength=12, globe=False, extent=DEFAULT_EXTENT, discover=False, init_date=None
+):
+    """discover: Probe NOMADS for the newest published cycle and fetch each
+    forecast hour as it appears rather than guessing the cycle from the clock
+    init_date: Download this cycle instead of the latest"""
+    product = "pgrb2.0p50" if globe else "pgrb2.0p25"
+    date = init_date or latest_gfs_init_date(discover, product)
     if globe:
-        download_0p50_gribs(date, flength)
+        download_0p50_gribs(date, flength, wait=discover)
     else:
-        download_gribs(date, flength, extent=extent)
+        download_gribs(date, flength, extent=extent, wait=discover)
+    cache.grib_cache().evict()
     return date
 
 
-def update_wps_namelist(init_date, flength):
+def update_wps_namelist(
+    init_date, flength, start_hour=0, out_path=None, interval_seconds=3600
+):
+    """start_hour: Forecast hour to start ungribbing from. Set equal to
+    flength to ungrib a single time
+    out_path: Write the namelist here instead of back over WPS-4.4/namelist.wps"""
 
-    start_str = init_date.strftime(NAMELIST_DATE_FORMAT)
+    start_date = init_date + timedelta(hours=start_hour)
+    start_str = start_date.strftime(NAMELIST_DATE_FORMAT)
     end_date = init_date + timedelta(hours=flength)
     print(init_date, end_date, flength)
     end_str = end_date.strftime(NAMELIST_DATE_FORMAT)
-    fpath = f"{ROOT_DIR}/tools/WPS-4.4/namelist.wps"
+    fpath = f"{WPS_DIR}/namelist.wps"
     wps_nml = f90nml.read(fpath)
 
     wps_nml["share"]["start_date"] = start_str
     wps_nml["share"]["end_date"] = end_str
-    wps_nml["share"]["interval_seconds"] = 3600
-    with open(fpath, "w") as f:
+    wps_nml["share"]["interval_seconds"] = interval_seconds
+    with open(out_path or fpath, "w") as f:
         wps_nml.write(f)
 
     return wps_nml
 
 
-def prep_initial_streams(domain_name):
-    fpath = f"{ROOT_DIR}/MPAS-Model/streams.init_atmosphere"
+def gribfile_suffix(i):
+    "AAA, AAB, ... as link_grib.csh names them"
+    letters = string.ascii_uppercase
+    return letters[i // 676] + letters[i // 26 % 26] + letters[i % 26]
+
+
+def ungrib_workers(n_times):
+    return max(1, min(n_times, os.cpu_count() or 1))
+
+
+def ungrib_window(init_date, fhours, work_dir):
+    """Ungribs the forecast hours in their own working directory so several
+    ungrib.exe can run at once. Returns the FILE:* paths written"""
+    cycle = str(init_date.hour).zfill(2)
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    os.symlink(f"{WPS_DIR}/ungrib.exe", f"{work_dir}/ungrib.exe")
+    os.symlink(f"{WPS_DIR}/ungrib/Variable_Tables/Vtable.GFS", f"{work_dir}/Vtable")
+    for i, fhour in enumerate(fhours):
+        os.symlink(
+            grib_path(init_date, cycle, fhour),
+            f"{work_dir}/GRIBFILE.{gribfile_suffix(i)}",
+        )
+
+    step = fhours[1] - fhours[0] if len(fhours) > 1 else 1
+    update_wps_namelist(
+        init_date,
+        fhours[-1],
+        start_hour=fhours[0],
+        out_path=f"{work_dir}/namelist.wps",
+        interval_seconds=step * 3600,
+    )
+
+    supervisor.run(
+        ["./ungrib.exe"],
+        "ungrib",
+        start_date=init_date + timedelta(hours=fhours[0]),
+        end_date=init_date + timedelta(hours=fhours[-1]),
+        cwd=work_dir,
+        output_path=f"{work_dir}/ungrib.stdout",
+    )
+
+    return sorted(glob.glob(f"{work_dir}/FILE:*"))
+
+
+def parallel_ungrib_hours(init_date, fhours, workers=None, out_dir=WPS_DIR):
+    """Splits the forecast hours into contiguous time windows, ungribs them
+    concurrently and moves the FILE:* intermediates into out_dir where
+    run_init_atmosphere.sh links them from"""
+    if workers is None:
+        workers = ungrib_workers(len(fhours))
+
+    n_windows = min(workers, len(fhours))
+    size = -(-len(fhours) // n_windows)
+    windows = [fhours[i : i + size] for i in range(0, len(fhours), size)]
+    work_dirs = [f"{out_dir}/parallel/window{i}" for i in range(len(windows))]
+
+    print(f"Ungribbing {len(fhours)} times in {len(windows)} windows")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(windows)) as executor:
+        outputs = list(
+            executor.map(ungrib_window, repeat(init_date), windows, work_dirs)
+        )
+
+    for fpaths in outputs:
+        for fpath in fpaths:
+            os.replace(fpath, f"{out_dir}/{os.path.basename(fpath)}")
+
+    shutil.rmtree(f"{out_dir}/parallel")
+
+
+def intermediate_name(init_date, fhour):
+    return f"FILE:{init_date + timedelta(hours=fhour):%Y-%m-%d_%H}"
+
+
+def intermediate_cache_fields(init_date, fhour, python_ungrib=False):
+    """Identifies the intermediate file written from one GRIB file by its
+    content, the Vtable and the ungrib settings of namelist.wps"""
+    cycle = str(init_date.hour).zfill(2)
+    wps_nml = f90nml.read(f"{WPS_DIR}/namelist.wps")
+    return {
+        "grib_sha256": cache.file_digest(grib_path(init_date, cycle, fhour)),
+        "vtable_sha256": cache.file_digest(vtable.VTABLE_GFS),
+        "ungrib": dict(wps_nml["ungrib"]),
+        "nfglevels": NFGLEVELS,
+        "writer": "ungrib.py" if python_ungrib else "ungrib.exe",
+        "fname": intermediate_name(init_date, fhour),
+    }
+
+
+def link_cached_intermediates(init_date, fhours, python_ungrib=False, run_dir=MPAS_DIR):
+    """Links cached intermediates for the forecast hours into the MPAS run
+    directory. Returns {fhour: cache fields} of the hours still to ungrib"""
+    intermediate_cache = cache.intermediate_cache()
+    pending = {}
+    for fhour in fhours:
+        fields = intermediate_cache_fields(init_date, fhour, python_ungrib)
+        dest = f"{run_dir}/{fields['fname']}"
+        if intermediate_cache.fetch(intermediate_cache.key(**fields), dest):
+            print("Cached", fields["fname"])
+        else:
+            pending[fhour] = fields
+    return pending
+
+
+def store_intermediates(pending, wps_dir=WPS_DIR):
+    "Adds the FILE:* ungrib wrote for the pending hours to the cache"
+    intermediate_cache = cache.intermediate_cache()
+    for fields in pending.values():
+        fpath = f"{wps_dir}/{fields['fname']}"
+        if os.path.exists(fpath):
+            intermediate_cache.store(intermediate_cache.key(**fields), fpath, **fields)
+
+
+def drop_intermediate(init_date, fhour, python_ungrib=False, dirs=(WPS_DIR, MPAS_DIR)):
+    """Removes the intermediate file of a forecast hour and its cache entry
+    before the GRIB file it was written from is replaced"""
+    fname = intermediate_name(init_date, fhour)
+    cycle = str(init_date.hour).zfill(2)
+    if os.path.exists(grib_path(init_date, cycle, fhour)):
+        intermediate_cache = cache.intermediate_cache()
+        fields = intermediate_cache_fields(init_date, fhour, python_ungrib)
+        intermediate_cache.remove(intermediate_cache.key(**fields))
+    for dir in dirs:
+        if os.path.lexists(f"{dir}/{fname}"):
+            os.remove(f"{dir}/{fname}")
+
+
+def prep_initial_streams(domain_name, run_dir=MPAS_DIR):
+    fpath = f"{run_dir}/streams.init_atmosphere"
     tree = ET.parse(fpath)
     root = tree.getroot()
 
@@ -270,8 +657,8 @@ def prep_initial_streams(domain_name):
         f.write(pretty_xml)
 
 
-def prep_lbc_streams(domain_name):
-    fpath = f"{ROOT_DIR}/MPAS-Model/streams.init_atmosphere"
+def prep_lbc_streams(domain_name, run_dir=MPAS_DIR):
+    fpath = f"{run_dir}/streams.init_atmosphere"
     tree = ET.parse(fpath)
     root = tree.getroot()
 
@@ -296,8 +683,13 @@ def prep_lbc_streams(domain_name):
         f.write(pretty_xml)
 
 
-def prep_run_streams(domain_name):
-    fpath = f"{ROOT_DIR}/MPAS-Model/streams.atmosphere"
+def prep_run_streams(
+    domain_name, archive_diagnostics=False, io_config=None, run_dir=MPAS_DIR
+):
+    """The diagnostics stream only writes the fields in the product catalog,
+    plus the archive set if archive_diagnostics. io_config sets the output
+    streams' io_type and precision"""
+    fpath = f"{run_dir}/streams.atmosphere"
     tree = ET.parse(fpath)
     root = tree.getroot()
 
@@ -310,10 +702,16 @@ def prep_run_streams(domain_name):
 
         if node.attrib["name"] == "diagnostics":
             node.attrib["output_interval"] = output_interval
+            for child in list(node):
+                node.remove(child)
+            ET.SubElement(node, "file", name=products.DIAGNOSTICS_STREAM_LIST)
 
         if node.attrib["name"] == "lbc_in":
             node.attrib["input_interval"] = lbc_interval
 
+    if io_config is not None:
+        io_tuning.apply_streams(root, io_config)
+
     new_xml = ET.tostring(root)
     pretty_xml = minidom.parseString(new_xml).toprettyxml(indent="    ")
     pretty_xml_lines = pretty_xml.splitlines()
@@ -324,9 +722,16 @@ def prep_run_streams(domain_name):
     with open(fpath, "w") as f:
         f.write(pretty_xml)
 
+    products.write_stream_list(
+        f"{run_dir}/{products.DIAGNOSTICS_STREAM_LIST}",
+        products.diagnostics_fields(archive=archive_diagnostics),
+    )
+
 
-def prep_initial_namelist(domain_name, init_date, flength, limited_area=True):
-    fpath = f"{ROOT_DIR}/MPAS-Model/namelist.init_atmosphere"
+def prep_initial_namelist(
+    domain_name, init_date, flength, limited_area=True, run_dir=MPAS_DIR
+):
+    fpath = f"{run_dir}/namelist.init_atmosphere"
     nml = f90nml.read(fpath)
 
     start_str = init_date.strftime(NAMELIST_DATE_FORMAT)
@@ -340,7 +745,7 @@ def prep_initial_namelist(domain_name, init_date, flength, limited_area=True):
 
     nml["dimensions"]["config_nvertlevels"] = 55
     nml["dimensions"]["config_nsoillevels"] = 4
-    nml["dimensions"]["config_nfglevels"] = 38
+    nml["dimensions"]["config_nfglevels"] = NFGLEVELS
     nml["dimensions"]["config_nfgsoillevels"] = 4
 
     nml["vertical_grid"]["config_blend_bdy_terrain"] = limited_area
@@ -354,12 +759,15 @@ def prep_initial_namelist(domain_name, init_date, flength, limited_area=True):
         nml.write(f)
 
 
-def prep_lbc_namelist(domain_name, init_date, flength):
-    fpath = f"{ROOT_DIR}/MPAS-Model/namelist.init_atmosphere"
+def prep_lbc_namelist(domain_name, init_date, flength, start_hour=0, run_dir=MPAS_DIR):
+    """start_hour: First boundary time to write, for splitting the forecast
+    into chunks"""
+    fpath = f"{run_dir}/namelist.init_atmosphere"
     nml = f90nml.read(fpath)
     lbc_interval = 3600
 
-    start_str = init_date.strftime(NAMELIST_DATE_FORMAT)
+    start_date = init_date + timedelta(hours=start_hour)
+    start_str = start_date.strftime(NAMELIST_DATE_FORMAT)
     end_date = init_date + timedelta(hours=flength)
     end_str = end_date.strftime(NAMELIST_DATE_FORMAT)
     case = 9
@@ -381,10 +789,31 @@ def prep_lbc_namelist(domain_name, init_date, flength):
         nml.write(f)
 
 
+def mesh_time_step(domain_name, resolution_km, flength, sub_steps, ranks=NCPUS):
+    """config_dt and config_len_disp from the mesh's finest cells. Falls back
+    to the nominal resolution when the static file lacks dcEdge/areaCell.
+    ranks: MPI ranks of the run, for the table's predicted wall times"""
+    try:
+        spacing = mesh.analyze(workspace.static_path(domain_name))
+    except (OSError, AttributeError) as e:
+        print("Mesh analysis failed, using resolution_km:", str(e))
+        return 6.0 * resolution_km, 1000.0 * resolution_km
+
+    mesh.print_dt_table(mesh.dt_table(spacing, flength, ranks, sub_steps))
+    return mesh.stable_dt(spacing, sub_steps), mesh.len_disp(spacing)
+
+
 def prep_run_namelist(
-    domain_name, init_date, flength, resolution_km, limited_area=True
+    domain_name,
+    init_date,
+    flength,
+    resolution_km,
+    limited_area=True,
+    io_config=None,
+    run_dir=MPAS_DIR,
+    ranks=NCPUS,
 ):
-    fpath = f"{ROOT_DIR}/MPAS-Model/namelist.atmosphere"
+    fpath = f"{run_dir}/namelist.atmosphere"
     nml = f90nml.read(fpath)
 
     td = timedelta(hours=flength)
@@ -393,44 +822,390 @@ def prep_run_namelist(
 
     nml["nhyd_model"]["config_start_time"] = start_str
     nml["nhyd_model"]["config_run_duration"] = run_duration_str
-    nml["nhyd_model"]["config_dt"] = 6 * resolution_km
-    nml["nhyd_model"]["config_len_disp"] = 1000 * resolution_km
+    sub_steps = nml["nhyd_model"].get(
+        "config_number_of_sub_steps", mesh.DEFAULT_SUB_STEPS
+    )
+    dt, len_disp = mesh_time_step(domain_name, resolution_km, flength, sub_steps, ranks)
+    nml["nhyd_model"]["config_dt"] = dt
+    nml["nhyd_model"]["config_len_disp"] = len_disp
 
     nml["limited_area"]["config_apply_lbcs"] = limited_area
     nml["decomposition"][
         "config_block_decomp_file_prefix"
     ] = f"{domain_name}.graph.info.part."
+    if io_config is not None:
+        io_tuning.apply_namelist(nml, io_config)
 
     with open(fpath, "w") as f:
         nml.write(f)
 
 
-def prep_initial_conditions(domain_name, init_date, flength, limited_area=True):
-    prep_initial_streams(domain_name)
-    prep_initial_namelist(domain_name, init_date, flength, limited_area=limited_area)
+def prep_initial_conditions(
+    domain_name, init_date, flength, limited_area=True, run_dir=MPAS_DIR
+):
+    prep_initial_streams(domain_name, run_dir=run_dir)
+    prep_initial_namelist(
+        domain_name, init_date, flength, limited_area=limited_area, run_dir=run_dir
+    )
+
+
+def prep_lbc(domain_name, init_date, flength, run_dir=MPAS_DIR):
+    prep_lbc_streams(domain_name, run_dir=run_dir)
+    prep_lbc_namelist(domain_name, init_date, flength, run_dir=run_dir)
+
+
+def lbc_chunk_ranks(domain_name, n_chunks, ncpus=NCPUS, run_dir=MPAS_DIR):
+    "MPI ranks for each LBC chunk from the core budget"
+    return decomposition.decompose(
+        domain_name, max(1, ncpus // n_chunks), run_dir=run_dir
+    )
+
+
+def mpas_script(name, run_dir=MPAS_DIR, wps_dir=WPS_DIR, ranks=NCPUS):
+    "Command line for run_init_atmosphere.sh or run_atmosphere.sh"
+    return [f"{ROOT_DIR}/scripts/{name}", run_dir, wps_dir, str(ranks)]
+
+
+def run_mpas_script(
+    name,
+    stage,
+    init_date,
+    flength,
+    run_dir=MPAS_DIR,
+    wps_dir=WPS_DIR,
+    ranks=NCPUS,
+    timeout=None,
+):
+    """Runs an MPAS script under the supervisor, following the core's log for
+    progress. run_dir/progress.<stage>.json shows how far it got.
+    timeout: Wall clock limit, see stage_timeout. Defaults to the stage's
+    fixed supervisor.STAGE_TIMEOUTS"""
+    core = "atmosphere" if name == "run_atmosphere.sh" else "init_atmosphere"
+    perf_history.clear_log(run_dir, stage)
+    usage = supervisor.run(
+        mpas_script(name, run_dir, wps_dir, ranks),
+        stage,
+        log_path=mpas_log.log_path(run_dir, core),
+        start_date=init_date,
+        end_date=init_date + timedelta(hours=flength),
+        progress_path=f"{run_dir}/progress.{stage}.json",
+        timeout=timeout or supervisor.stage_timeout(stage),
+    )
+    perf_history.save_log(run_dir, core, stage)
+    return usage
+
+
+def record_performance(
+    domain_name, init_date, flength, ranks, stage_seconds, run_dir=MPAS_DIR
+):
+    """Adds the finished run's timers and stage times to the performance
+    history and reports regressions against earlier runs"""
+    nml = f90nml.read(f"{run_dir}/namelist.atmosphere")
+    progress = supervisor.read_progress(f"{run_dir}/progress.model.json") or {}
+    perf_history.record_run(
+        domain_name,
+        init_date,
+        run_dir,
+        decomposition.mesh_cells(domain_name),
+        ranks,
+        nml["nhyd_model"]["config_dt"],
+        flength,
+        stage_seconds,
+        max_rss_mb=(progress.get("usage") or {}).get("max_rss_mb"),
+    )
+    perf_history.print_report(domain_name)
+
+
+def stage_timeout(domain_name, resolution_km, stage, flength, ranks=NCPUS):
+    """Wall clock limit of an MPAS stage scaled to the planner's estimate for
+    the mesh, forecast length and ranks"""
+    try:
+        run = planner.estimate(domain_name, resolution_km, flength, ranks, (stage,))
+    except OSError:
+        # No static file to size the mesh from
+        return supervisor.stage_timeout(stage)
+    return supervisor.stage_timeout(stage, run.stage_seconds[stage])
+
+
+def fit_deadline(
+    domain_name,
+    init_date,
+    resolution_km,
+    flength,
+    on_deadline="shorten",
+    stages=manifest.STAGES,
+    ranks=NCPUS,
+):
+    """Forecast length to run so the stages left finish before the next
+    cycle is out. on_deadline: "shorten" to the longest length that does,
+    "refuse" to raise instead, "ignore" to run flength regardless"""
+    if on_deadline == "ignore":
+        return flength
+
+    seconds_left = (
+        planner.cycle_deadline(init_date) - datetime.utcnow()
+    ).total_seconds()
+    run = planner.estimate(domain_name, resolution_km, flength, ranks, stages)
+    planner.print_estimate(run)
+    if planner.fits(run, seconds_left):
+        return flength
+
+    print(f"A {flength}h forecast would finish after the next GFS cycle is out")
+    shorter = None
+    if on_deadline == "shorten":
+        shorter = planner.longest_run(
+            domain_name, resolution_km, flength, ranks, seconds_left, stages=stages
+        )
+    if shorter is None:
+        raise RuntimeError(
+            f"{domain_name} {init_date:%Y%m%d%H} cannot finish by "
+            f"{planner.cycle_deadline(init_date):%Y-%m-%d %H:%M}Z"
+        )
+    print(f"Shortening the forecast to {shorter.flength}h")
+    planner.print_estimate(shorter)
+    return shorter.flength
+
+
+def resumed_flength(stages, init_date, flength):
+    """Forecast length a rerun of the manifest's cycle keeps without fitting
+    it to the deadline, None for a new run or a new length, which reruns
+    from the download anyway. Stages skipped by from_stage keep the length
+    they ran with"""
+    downloaded = stages.init_date == init_date and stages.recorded_inputs("download")
+    recorded = downloaded["flength"] if downloaded else None
+    if stages.first > 0:
+        if recorded is not None and recorded < flength:
+            print(
+                f"Stages before {manifest.STAGES[stages.first]} ran a "
+                f"{recorded}h forecast, not {flength}h"
+            )
+            return recorded
+        return flength
+    if recorded == flength:
+        return flength
+    if recorded is not None:
+        print(f"{init_date:%Y%m%d%H} ran {recorded}h before, rerunning all stages")
+    return None
+
+
+def lbc_chunk(
+    domain_name, init_date, fhours, work_dir, ranks, run_dir=MPAS_DIR, wps_dir=WPS_DIR
+):
+    """Runs init_atmosphere case 9 for the forecast hours in its own
+    directory. Returns the lbc.*.nc paths written"""
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    links = [
+        f"{run_dir}/init_atmosphere_model",
+        f"{run_dir}/{domain_name}.init.nc",
+        f"{run_dir}/{domain_name}.graph.info.part.{ranks}",
+    ]
+    links += glob.glob(f"{run_dir}/stream_list.*")
+    # Cache hits are linked into the run directory, ungrib output is not
+    for fhour in fhours:
+        name = intermediate_name(init_date, fhour)
+        for directory in (run_dir, wps_dir):
+            if os.path.exists(f"{directory}/{name}"):
+                links.append(f"{directory}/{name}")
+                break
+    for src in links:
+        dest = f"{work_dir}/{os.path.basename(src)}"
+        if os.path.exists(src) and not os.path.lexists(dest):
+            os.symlink(os.path.realpath(src), dest)
+
+    for fname in ("namelist.init_atmosphere", "streams.init_atmosphere"):
+        shutil.copyfile(f"{run_dir}/{fname}", f"{work_dir}/{fname}")
+    prep_lbc_streams(domain_name, run_dir=work_dir)
+    prep_lbc_namelist(
+        domain_name, init_date, fhours[-1], start_hour=fhours[0], run_dir=work_dir
+    )
+
+    supervisor.run(
+        ["mpiexec", "-n", str(ranks), "./init_atmosphere_model"],
+        "lbc",
+        log_path=mpas_log.log_path(work_dir, "init_atmosphere"),
+        cwd=work_dir,
+        output_path=f"{work_dir}/init_atmosphere.stdout",
+    )
+
+    return sorted(glob.glob(f"{work_dir}/lbc.*.nc"))
+
 
+def parallel_lbc(
+    domain_name,
+    init_date,
+    flength,
+    n_chunks,
+    ncpus=NCPUS,
+    run_dir=MPAS_DIR,
+    wps_dir=WPS_DIR,
+):
+    """Splits the hourly boundary times into contiguous chunks, runs a case 9
+    init for each concurrently and gathers the lbc.*.nc into run_dir.
+    The initial conditions must already be in {domain_name}.init.nc"""
+    fhours = list(range(0, flength + 1))
+    n_chunks = max(1, min(n_chunks, len(fhours)))
+    size = -(-len(fhours) // n_chunks)
+    chunks = [fhours[i : i + size] for i in range(0, len(fhours), size)]
+    ranks = lbc_chunk_ranks(domain_name, len(chunks), ncpus, run_dir=run_dir)
+    work_dirs = [f"{run_dir}/lbc_chunks/chunk{i}" for i in range(len(chunks))]
+
+    print(f"Boundary conditions in {len(chunks)} chunks of {ranks} ranks")
+    perf_history.clear_log(run_dir, "lbc")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        outputs = list(
+            executor.map(
+                lbc_chunk,
+                repeat(domain_name),
+                repeat(init_date),
+                chunks,
+                work_dirs,
+                repeat(ranks),
+                repeat(run_dir),
+                repeat(wps_dir),
+            )
+        )
 
-def prep_lbc(domain_name, init_date, flength):
-    prep_lbc_streams(domain_name)
-    prep_lbc_namelist(domain_name, init_date, flength)
+    for fpaths in outputs:
+        for fpath in fpaths:
+            os.replace(fpath, f"{run_dir}/{os.path.basename(fpath)}")
 
+    # The first chunk's timers stand for the stage, covering fewer hours
+    perf_history.save_log(run_dir, "init_atmosphere", "lbc", log_dir=work_dirs[0])
+    shutil.rmtree(f"{run_dir}/lbc_chunks")
 
-def prep_run(domain_name, init_date, flength, resolution_km, limited_area=True):
-    prep_run_streams(domain_name)
+
+def strong_scaling(
+    domain_name,
+    init_date,
+    resolution_km,
+    rank_counts,
+    run_dir=MPAS_DIR,
+    wps_dir=WPS_DIR,
+    hours=1,
+):
+    """Times a short forecast at each rank count and records the time to
+    solution so decomposition.decompose picks the fastest next time"""
+    graph = decomposition.graph_path(domain_name, run_dir)
+    if graph is None:
+        print("No graph.info for", domain_name, "skipping scaling test")
+        return
+    mesh_sha256 = cache.file_digest(graph)
+
+    prep_run(
+        domain_name,
+        init_date,
+        hours,
+        resolution_km,
+        run_dir=run_dir,
+        ranks=max(rank_counts),
+    )
+    for ranks in rank_counts:
+        if not decomposition.ensure_partition(domain_name, ranks, run_dir):
+            continue
+        start = time.monotonic()
+        run_mpas_script(
+            "run_atmosphere.sh", "model", init_date, hours, run_dir, wps_dir, ranks
+        )
+        seconds = time.monotonic() - start
+        print(f"{domain_name}: {ranks} ranks took {seconds:.1f}s for {hours}h")
+        decomposition.record_scaling(domain_name, mesh_sha256, ranks, seconds)
+
+
+def tune_io(
+    domain_name,
+    init_date,
+    resolution_km,
+    ranks,
+    run_dir=MPAS_DIR,
+    wps_dir=WPS_DIR,
+    hours=2,
+):
+    """Runs a short forecast with each candidate output configuration and
+    records the stall per write, so later runs use the best one"""
+    # Hourly diagnostics including the initial time
+    n_writes = hours + 1
+    for config in io_tuning.candidate_configs(ranks):
+        prep_run(
+            domain_name,
+            init_date,
+            hours,
+            resolution_km,
+            io_config=config,
+            run_dir=run_dir,
+            ranks=ranks,
+        )
+        try:
+            run_mpas_script(
+                "run_atmosphere.sh", "model", init_date, hours, run_dir, wps_dir, ranks
+            )
+        except subprocess.CalledProcessError:
+            # netcdf4 needs PIO built against parallel HDF5
+            print("Output config", io_tuning.config_key(config), "failed")
+            continue
+
+        seconds = io_tuning.write_stall(run_dir, n_writes)
+        if seconds is None:
+            continue
+        print(f"{io_tuning.config_key(config)}: {seconds:.2f}s per write")
+        io_tuning.record_stall(domain_name, ranks, config, seconds)
+
+    for fpath in glob.glob(f"{run_dir}/diag*") + glob.glob(f"{run_dir}/history*"):
+        os.remove(fpath)
+
+
+def prep_run(
+    domain_name,
+    init_date,
+    flength,
+    resolution_km,
+    limited_area=True,
+    archive_diagnostics=False,
+    io_config=None,
+    run_dir=MPAS_DIR,
+    ranks=NCPUS,
+):
+    prep_run_streams(
+        domain_name,
+        archive_diagnostics=archive_diagnostics,
+        io_config=io_config,
+        run_dir=run_dir,
+    )
     prep_run_namelist(
-        domain_name, init_date, flength, resolution_km, limited_area=limited_area
+        domain_name,
+        init_date,
+        flength,
+        resolution_km,
+        limited_area=limited_area,
+        io_config=io_config,
+        run_dir=run_dir,
+        ranks=ranks,
     )
 
 
-def global_simulation(domain_name="colorado12km", resolution_km=12, flength=12):
+def global_simulation(
+    domain_name="colorado12km",
+    resolution_km=12,
+    flength=12,
+    discover=False,
+    archive_diagnostics=False,
+    on_deadline="shorten",
+):
+    "Returns the init date of the cycle run"
     SCRIPT_DIR = f"{ROOT_DIR}/scripts"
-    init_dt = latest_gfs_init_date()
+    init_dt = latest_gfs_init_date(discover, gfs_product(resolution_km, False))
+    spans.set_cycle(init_dt)
+    flength = fit_deadline(
+        domain_name, init_dt, resolution_km, flength, on_deadline, stages=("model",)
+    )
 
     """
     print("Cleaning generated files from running model")
     subprocess.call(f"{SCRIPT_DIR}/clean_all.sh")
     # Only need to download initial conditions
-    init_dt = download_latest_grib(1, globe=True)
+    init_dt = download_latest_grib(1, globe=True, discover=discover)
 
     print("WPS")
     update_wps_namelist(init_dt, flength)
@@ -442,58 +1217,605 @@ def global_simulation(domain_name="colorado12km", resolution_km=12, flength=12):
 
     """
     print("Running")
-    prep_run(domain_name, init_dt, flength, resolution_km, limited_area=False)
-    subprocess.call(f"{SCRIPT_DIR}/run_atmosphere.sh")
+    prep_run(
+        domain_name,
+        init_dt,
+        flength,
+        resolution_km,
+        limited_area=False,
+        archive_diagnostics=archive_diagnostics,
+    )
+    run_mpas_script(
+        "run_atmosphere.sh",
+        "model",
+        init_dt,
+        flength,
+        timeout=stage_timeout(domain_name, resolution_km, "model", flength),
+    )
 
     subprocess.call(
         f"mv {ROOT_DIR}/MPAS-Model/diag* {ROOT_DIR}/products/mpas/", shell=True
     )
-
-
-def limited_area_simulation(domain_name="colorado12km", resolution_km=12, flength=12):
+    return init_dt
+
+
+def limited_area_simulation(
+    domain_name="colorado12km",
+    resolution_km=12,
+    flength=12,
+    discover=False,
+    parallel_ungrib=False,
+    python_ungrib=False,
+    lbc_chunks=0,
+    use_workspace=False,
+    scaling_ranks=None,
+    archive_diagnostics=False,
+    tune_output=False,
+    from_stage=None,
+    until_stage=None,
+    on_deadline="shorten",
+    plot_cores=0,
+):
+    """use_workspace: Run in runs/<domain>/<cycle> instead of MPAS-Model so
+    other domains or cycles can run at the same time
+    scaling_ranks: Time a short forecast at each of these rank counts first
+    and run the full forecast with the fastest
+    archive_diagnostics: Also write the archive fields to the diag files
+    tune_output: Time short forecasts with each output configuration first
+    and run the full forecast with the one that stalls least per write
+    from_stage, until_stage: Rerun the stages from from_stage on, taking the
+    earlier ones as done, and stop after until_stage. Otherwise a rerun of
+    the same cycle skips the stages runs/<domain>/manifest.json shows are
+    up to date
+    on_deadline: What to do when the forecast would finish after the next
+    cycle is out, see fit_deadline. Not applied when resuming a cycle
+    plot_cores: Cores left free of MPI ranks for drawing the products while
+    the model runs
+    Returns the init date of the cycle run"""
     SCRIPT_DIR = f"{ROOT_DIR}/scripts"
-    init_dt = latest_gfs_init_date()
+    model_cores = max(1, NCPUS - plot_cores)
 
-    static_path = f"{ROOT_DIR}/MPAS-Model/{domain_name}.static.nc"
-    extent = get_mesh_extent(static_path)
+    extent = get_mesh_extent(workspace.static_path(domain_name))
     buffered_extent = add_extent_buffer(extent)
-
-    print("Cleaning generated files from running model")
-    subprocess.call(f"{SCRIPT_DIR}/clean_all.sh")
     global_conditions = resolution_km >= 25
-    init_dt = download_latest_grib(
-        flength, globe=global_conditions, extent=buffered_extent
+    fhour_step = 3 if global_conditions else 1
+
+    stages = manifest.Manifest(
+        manifest.manifest_path(domain_name), from_stage, until_stage
     )
+    if stages.skipped("download"):
+        init_dt = stages.init_date
+        if init_dt is None:
+            raise RuntimeError(f"No earlier {domain_name} run to resume")
+    else:
+        init_dt = latest_gfs_init_date(discover, gfs_product(resolution_km))
+    spans.set_cycle(init_dt)
+    resumed = resumed_flength(stages, init_dt, flength)
+    if resumed is not None:
+        flength = resumed
+        print(f"Resuming {init_dt:%Y%m%d%H} with a {flength}h forecast")
+    else:
+        flength = fit_deadline(
+            domain_name,
+            init_dt,
+            resolution_km,
+            flength,
+            on_deadline,
+            stages=manifest.STAGES[: stages.last + 1],
+            ranks=model_cores,
+        )
+    fhours = list(range(0, flength + 1, fhour_step))
+    cycle = str(init_dt.hour).zfill(2)
+    gribs = [grib_path(init_dt, cycle, fhour) for fhour in fhours]
+
+    run_dir, wps_dir = MPAS_DIR, WPS_DIR
+    if use_workspace:
+        ws = workspace.Workspace(domain_name, init_dt)
+        run_dir, wps_dir = ws.path, ws.wps_dir
+    resuming = stages.start(init_dt, run_dir) or stages.first > 0
+    if use_workspace and resuming:
+        ws.open()
+    elif use_workspace:
+        ws.create()
+    elif not resuming:
+        print("Cleaning generated files from running model")
+        subprocess.call(f"{SCRIPT_DIR}/clean_all.sh")
+
+    def download():
+        download_latest_grib(
+            flength,
+            globe=global_conditions,
+            extent=buffered_extent,
+            discover=discover,
+            init_date=init_dt,
+        )
+
+    stages.run(
+        "download",
+        download,
+        {"flength": flength, "extent": buffered_extent, "globe": global_conditions},
+        lambda: gribs,
+    )
+
+    ranks = decomposition.decompose(domain_name, model_cores, run_dir=run_dir)
+    intermediates = [
+        f"{run_dir}/{intermediate_name(init_dt, fhour)}" for fhour in fhours
+    ]
+
+    def wps():
+        pending = link_cached_intermediates(init_dt, fhours, python_ungrib, run_dir)
+        todo = sorted(pending)
+        if not todo:
+            print("Every intermediate file was cached")
+        elif python_ungrib:
+            todo_gribs = [grib_path(init_dt, cycle, fhour) for fhour in todo]
+            ungrib.convert_gribs(todo_gribs, NFGLEVELS, out_dir=wps_dir)
+        elif parallel_ungrib or use_workspace:
+            # run_wps.sh works in the shared WPS-4.4 directory
+            workers = None if parallel_ungrib else 1
+            parallel_ungrib_hours(init_dt, todo, workers=workers, out_dir=wps_dir)
+        else:
+            update_wps_namelist(init_dt, todo[-1], start_hour=todo[0])
+            supervisor.run(
+                f"{SCRIPT_DIR}/run_wps.sh",
+                "ungrib",
+                start_date=init_dt + timedelta(hours=todo[0]),
+                end_date=init_dt + timedelta(hours=todo[-1]),
+            )
+        store_intermediates(pending, wps_dir)
+        cache.intermediate_cache().evict()
+        intermediate.check_intermediates(NFGLEVELS, dirs=(wps_dir, run_dir))
+        # Outputs have to live in run_dir for the manifest to track them
+        for fhour in todo:
+            name = intermediate_name(init_dt, fhour)
+            if not os.path.exists(f"{run_dir}/{name}"):
+                cache.link_or_copy(f"{wps_dir}/{name}", f"{run_dir}/{name}")
 
     print("WPS")
-    update_wps_namelist(init_dt, flength)
-    subprocess.call(f"{SCRIPT_DIR}/run_wps.sh")
+    stages.run(
+        "wps",
+        wps,
+        {
+            "gribs": manifest.digests(gribs),
+            "vtable": cache.file_digest(vtable.VTABLE_GFS),
+            "python_ungrib": python_ungrib,
+        },
+        lambda: intermediates,
+    )
+
+    init_file = f"{run_dir}/{domain_name}.init.nc"
+    init_config = [
+        f"{run_dir}/namelist.init_atmosphere",
+        f"{run_dir}/streams.init_atmosphere",
+    ]
 
     print("Initial Conditions")
-    prep_initial_conditions(domain_name, init_dt, flength)
-    subprocess.call(f"{SCRIPT_DIR}/run_init_atmosphere.sh")
+    prep_initial_conditions(domain_name, init_dt, flength, run_dir=run_dir)
+    stages.run(
+        "init",
+        lambda: run_mpas_script(
+            "run_init_atmosphere.sh", "init", init_dt, 0, run_dir, wps_dir, ranks
+        ),
+        {
+            "config": manifest.digests(init_config),
+            "static": manifest.digests([workspace.static_path(domain_name)]),
+            "intermediates": manifest.states(intermediates[:1]),
+        },
+        lambda: [init_file],
+    )
+
+    def boundary_conditions():
+        if lbc_chunks > 1:
+            parallel_lbc(
+                domain_name,
+                init_dt,
+                flength,
+                lbc_chunks,
+                run_dir=run_dir,
+                wps_dir=wps_dir,
+            )
+        else:
+            run_mpas_script(
+                "run_init_atmosphere.sh",
+                "lbc",
+                init_dt,
+                flength,
+                run_dir,
+                wps_dir,
+                ranks,
+                stage_timeout(domain_name, resolution_km, "lbc", flength, ranks),
+            )
 
     print("Boundary Conditions")
-    prep_lbc(domain_name, init_dt, flength)
-    subprocess.call(f"{SCRIPT_DIR}/run_init_atmosphere.sh")
+    prep_lbc(domain_name, init_dt, flength, run_dir=run_dir)
+    stages.run(
+        "lbc",
+        boundary_conditions,
+        {
+            "config": manifest.digests(init_config),
+            "init": manifest.states([init_file]),
+            "intermediates": manifest.states(intermediates),
+        },
+        lambda: sorted(glob.glob(f"{run_dir}/lbc.*.nc")),
+    )
+
+    if stages.skipped("model"):
+        return init_dt
+
+    if scaling_ranks:
+        print("Strong scaling test")
+        strong_scaling(
+            domain_name,
+            init_dt,
+            resolution_km,
+            scaling_ranks,
+            run_dir=run_dir,
+            wps_dir=wps_dir,
+        )
+        ranks = decomposition.decompose(domain_name, model_cores, run_dir=run_dir)
+
+    if tune_output:
+        print("Output tuning")
+        tune_io(
+            domain_name, init_dt, resolution_km, ranks, run_dir=run_dir, wps_dir=wps_dir
+        )
+
+    products_dir = ws.products_dir() if use_workspace else f"{ROOT_DIR}/products/mpas"
+    diag_files = [
+        f"{products_dir}/diag.{init_dt + timedelta(hours=fhour):%Y-%m-%d_%H.%M.%S}.nc"
+        for fhour in range(flength + 1)
+    ]
+
+    def run_model():
+        run_mpas_script(
+            "run_atmosphere.sh",
+            "model",
+            init_dt,
+            flength,
+            run_dir,
+            wps_dir,
+            ranks,
+            stage_timeout(domain_name, resolution_km, "model", flength, ranks),
+        )
+        if use_workspace:
+            ws.collect_products()
+        else:
+            subprocess.call(
+                f"mv {ROOT_DIR}/MPAS-Model/diag* {ROOT_DIR}/products/mpas/", shell=True
+            )
 
     print("Running")
-    prep_run(domain_name, init_dt, flength, resolution_km)
-    subprocess.call(f"{SCRIPT_DIR}/run_atmosphere.sh")
+    prep_run(
+        domain_name,
+        init_dt,
+        flength,
+        resolution_km,
+        archive_diagnostics=archive_diagnostics,
+        io_config=io_tuning.best_config(domain_name, ranks),
+        run_dir=run_dir,
+        ranks=ranks,
+    )
+    run_config = [
+        f"{run_dir}/namelist.atmosphere",
+        f"{run_dir}/streams.atmosphere",
+        f"{run_dir}/{products.DIAGNOSTICS_STREAM_LIST}",
+    ]
+    ran = stages.run(
+        "model",
+        run_model,
+        {
+            "config": manifest.digests(run_config),
+            "init": manifest.states([init_file]),
+            "lbc": manifest.states(glob.glob(f"{run_dir}/lbc.*.nc")),
+        },
+        lambda: [fpath for fpath in diag_files if os.path.exists(fpath)],
+    )
+    if ran:
+        record_performance(
+            domain_name, init_dt, flength, ranks, stages.timings, run_dir=run_dir
+        )
+    return init_dt
+
+
+def streaming_limited_area_simulation(
+    domain_name="colorado12km",
+    resolution_km=12,
+    flength=12,
+    discover=False,
+    parallel_ungrib=False,
+    python_ungrib=False,
+    lbc_chunks=0,
+    use_workspace=False,
+    archive_diagnostics=False,
+    on_deadline="shorten",
+    plot_cores=0,
+):
+    """Same stages as limited_area_simulation but each forecast hour is
+    ungribbed as soon as its GRIB lands, and the initial conditions start
+    once hour 0 is ungribbed, overlapping preprocessing with the downloads.
+    Hours that fail the validation after all downloads are ungribbed again
+    from their new file before the boundary conditions.
+    parallel_ungrib: Ungrib hours concurrently in their own directories
+    python_ungrib: Write the intermediate files with ungrib.py in a process pool
+    instead of running ungrib.exe
+    lbc_chunks: Split the boundary conditions into this many concurrent
+    init_atmosphere runs
+    use_workspace: Run in runs/<domain>/<cycle> instead of MPAS-Model
+    archive_diagnostics: Also write the archive fields to the diag files
+    on_deadline: What to do when the forecast would finish after the next
+    cycle is out, see fit_deadline
+    plot_cores: Cores left free of MPI ranks for drawing the products while
+    the model runs
+    Returns the init date of the cycle run"""
+    SCRIPT_DIR = f"{ROOT_DIR}/scripts"
+    model_cores = max(1, NCPUS - plot_cores)
 
-    subprocess.call(
-        f"mv {ROOT_DIR}/MPAS-Model/diag* {ROOT_DIR}/products/mpas/", shell=True
+    extent = get_mesh_extent(workspace.static_path(domain_name))
+    buffered_extent = add_extent_buffer(extent)
+
+    if not use_workspace:
+        print("Cleaning generated files from running model")
+        subprocess.call(f"{SCRIPT_DIR}/clean_all.sh")
+    global_conditions = resolution_km >= 25
+    fhour_step = 3 if global_conditions else 1
+
+    init_dt = latest_gfs_init_date(discover, gfs_product(resolution_km))
+    spans.set_cycle(init_dt)
+    flength = fit_deadline(
+        domain_name, init_dt, resolution_km, flength, on_deadline, ranks=model_cores
     )
+    fhours = list(range(0, flength + 1, fhour_step))
+    cycle = str(init_dt.hour).zfill(2)
+
+    run_dir, wps_dir = MPAS_DIR, WPS_DIR
+    if use_workspace:
+        ws = workspace.Workspace(domain_name, init_dt).create()
+        run_dir, wps_dir = ws.path, ws.wps_dir
+    ranks = decomposition.decompose(domain_name, model_cores, run_dir=run_dir)
+
+    stages = pipeline.EventPipeline()
+    entries = executor = None
+    if python_ungrib:
+        entries = vtable.read_vtable()
+        executor = ungrib.pool_executor()
+
+    # Hours whose GRIB failed validation after they may have been ungribbed.
+    # The download stage ungribs them again once their new file passed
+    refetched = set()
+    # Held while an hour's GRIB or intermediate file is read or replaced
+    hour_locks = {fhour: threading.Lock() for fhour in fhours}
+
+    def on_invalid(fhour):
+        with hour_locks[fhour]:
+            refetched.add(fhour)
+            drop_intermediate(init_dt, fhour, python_ungrib, dirs=(wps_dir, run_dir))
+
+    def on_ready(fhour):
+        _, problems = grib_check.scan_grib2(grib_path(init_dt, cycle, fhour))
+        if problems:
+            return
+        if fhour in refetched:
+            with stages.locks["wps"], hour_locks[fhour]:
+                print("Ungribbing again", fhour)
+                ungrib_cached(fhour)
+        stages.emit(f"grib:{fhour}")
+
+    def download():
+        if global_conditions:
+            download_0p50_gribs(
+                init_dt,
+                flength,
+                wait=discover,
+                on_ready=on_ready,
+                on_invalid=on_invalid,
+            )
+        else:
+            download_gribs(
+                init_dt,
+                flength,
+                extent=buffered_extent,
+                wait=discover,
+                on_ready=on_ready,
+                on_invalid=on_invalid,
+            )
+
+    def ungrib_hour(fhour):
+        grib_file = grib_path(init_dt, cycle, fhour)
+        if python_ungrib:
+            executor.submit(
+                ungrib.convert_grib, grib_file, wps_dir, entries, NFGLEVELS
+            ).result()
+        elif parallel_ungrib or use_workspace:
+            work_dir = f"{wps_dir}/parallel/f{fhour:03d}"
+            for fpath in ungrib_window(init_dt, [fhour], work_dir):
+                os.replace(fpath, f"{wps_dir}/{os.path.basename(fpath)}")
+            shutil.rmtree(work_dir)
+        else:
+            update_wps_namelist(init_dt, fhour, start_hour=fhour)
+            supervisor.run(
+                [f"{SCRIPT_DIR}/run_ungrib_file.sh", grib_file],
+                f"ungrib:{fhour}",
+                timeout=supervisor.STAGE_TIMEOUTS["ungrib"],
+            )
+
+    def ungrib_cached(fhour):
+        pending = link_cached_intermediates(init_dt, [fhour], python_ungrib, run_dir)
+        if pending:
+            ungrib_hour(fhour)
+            store_intermediates(pending, wps_dir)
+
+    def cached_ungrib_hour(fhour):
+        with hour_locks[fhour]:
+            # Otherwise on_ready ungribs it once the new file is in
+            if fhour not in refetched:
+                ungrib_cached(fhour)
+
+    def run_init():
+        prep_initial_conditions(domain_name, init_dt, flength, run_dir=run_dir)
+        run_mpas_script(
+            "run_init_atmosphere.sh", "init", init_dt, 0, run_dir, wps_dir, ranks
+        )
 
+    def initial_conditions():
+        with hour_locks[0]:
+            if 0 not in refetched:
+                run_init()
+
+    def boundary_conditions():
+        if 0 in refetched:
+            print("Hour 0 was downloaded again, redoing the initial conditions")
+            run_init()
+        intermediate.check_intermediates(NFGLEVELS, dirs=(wps_dir, run_dir))
+        if lbc_chunks > 1:
+            parallel_lbc(
+                domain_name,
+                init_dt,
+                flength,
+                lbc_chunks,
+                run_dir=run_dir,
+                wps_dir=wps_dir,
+            )
+            return
+        prep_lbc(domain_name, init_dt, flength, run_dir=run_dir)
+        run_mpas_script(
+            "run_init_atmosphere.sh",
+            "lbc",
+            init_dt,
+            flength,
+            run_dir,
+            wps_dir,
+            ranks,
+            stage_timeout(domain_name, resolution_km, "lbc", flength, ranks),
+        )
 
-def main(domain_name="colorado12km", resolution_km=12, flength=12, limited_area=True):
-    if limited_area:
-        limited_area_simulation(
-            domain_name=domain_name, resolution_km=resolution_km, flength=flength
+    def run_model():
+        prep_run(
+            domain_name,
+            init_dt,
+            flength,
+            resolution_km,
+            archive_diagnostics=archive_diagnostics,
+            io_config=io_tuning.best_config(domain_name, ranks),
+            run_dir=run_dir,
+            ranks=ranks,
+        )
+        run_mpas_script(
+            "run_atmosphere.sh",
+            "model",
+            init_dt,
+            flength,
+            run_dir,
+            wps_dir,
+            ranks,
+            stage_timeout(domain_name, resolution_km, "model", flength, ranks),
         )
+
+    if parallel_ungrib or python_ungrib:
+        stages.add_lock("wps", ungrib_workers(len(fhours)))
+    elif use_workspace:
+        stages.add_lock("wps", 1)
+    stages.add_stage("download", download)
+    for fhour in fhours:
+        stages.add_stage(
+            f"ungrib:{fhour}",
+            functools.partial(cached_ungrib_hour, fhour),
+            after=[f"grib:{fhour}"],
+            lock="wps",
+        )
+    # init_atmosphere and atmosphere_model share the run directory
+    stages.add_stage("init", initial_conditions, after=["ungrib:0"], lock="mpas")
+    # The download stage ends after validation and any ungrib it redid
+    stages.add_stage(
+        "lbc",
+        boundary_conditions,
+        after=["download", "init"] + [f"ungrib:{fhour}" for fhour in fhours],
+        lock="mpas",
+    )
+    stages.add_stage("model", run_model, after=["lbc"], lock="mpas")
+    try:
+        stages.run()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    cache.intermediate_cache().evict()
+    record_performance(
+        domain_name,
+        init_dt,
+        flength,
+        ranks,
+        {name: end - start for name, (start, end) in stages.timings.items()},
+        run_dir=run_dir,
+    )
+
+    if use_workspace:
+        ws.collect_products()
     else:
-        global_simulation(
-            domain_name=domain_name, resolution_km=resolution_km, flength=flength
+        subprocess.call(
+            f"mv {ROOT_DIR}/MPAS-Model/diag* {ROOT_DIR}/products/mpas/", shell=True
+        )
+    return init_dt
+
+
+def main(
+    domain_name="colorado12km",
+    resolution_km=12,
+    flength=12,
+    limited_area=True,
+    discover=False,
+    stream=False,
+    parallel_ungrib=False,
+    python_ungrib=False,
+    lbc_chunks=0,
+    use_workspace=False,
+    scaling_ranks=None,
+    archive_diagnostics=False,
+    tune_output=False,
+    from_stage=None,
+    until_stage=None,
+    on_deadline="shorten",
+    plot_cores=0,
+):
+    "Returns the init date of the cycle run"
+    if limited_area and stream:
+        return streaming_limited_area_simulation(
+            domain_name=domain_name,
+            resolution_km=resolution_km,
+            flength=flength,
+            discover=discover,
+            parallel_ungrib=parallel_ungrib,
+            python_ungrib=python_ungrib,
+            lbc_chunks=lbc_chunks,
+            use_workspace=use_workspace,
+            archive_diagnostics=archive_diagnostics,
+            on_deadline=on_deadline,
+            plot_cores=plot_cores,
+        )
+    elif limited_area:
+        return limited_area_simulation(
+            domain_name=domain_name,
+            resolution_km=resolution_km,
+            flength=flength,
+            discover=discover,
+            parallel_ungrib=parallel_ungrib,
+            python_ungrib=python_ungrib,
+            lbc_chunks=lbc_chunks,
+            use_workspace=use_workspace,
+            scaling_ranks=scaling_ranks,
+            archive_diagnostics=archive_diagnostics,
+            tune_output=tune_output,
+            from_stage=from_stage,
+            until_stage=until_stage,
+            on_deadline=on_deadline,
+            plot_cores=plot_cores,
+        )
+    else:
+        return global_simulation(
+            domain_name=domain_name,
+            resolution_km=resolution_km,
+            flength=flength,
+            discover=discover,
+            archive_diagnostics=archive_diagnostics,
+            on_deadline=on_deadline,
         )
 
 
@@ -524,15 +1846,127 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    parser.add_argument(
+        "--discover-cycle",
+        action="store_true",
+        help="Find the newest cycle on NOMADS and download hours as they publish",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Ungrib and start initial conditions while downloads are running",
+    )
+
+    parser.add_argument(
+        "--parallel-ungrib",
+        action="store_true",
+        help="Run ungrib over time windows concurrently, one per core",
+    )
+
+    parser.add_argument(
+        "--python-ungrib",
+        action="store_true",
+        help="Write the WPS intermediate files in Python instead of ungrib.exe",
+    )
+
+    parser.add_argument(
+        "--lbc-chunks",
+        type=int,
+        default=0,
+        help="Generate boundary conditions in this many time chunks at once",
+    )
+
+    parser.add_argument(
+        "--workspace",
+        action="store_true",
+        help="Run in runs/<domain>/<cycle> so other runs can share the host",
+    )
+
+    parser.add_argument(
+        "--scaling-ranks",
+        type=str,
+        default=None,
+        help="Comma separated rank counts to time before the forecast, e.g. 2,4,6",
+    )
+
+    parser.add_argument(
+        "--archive-diagnostics",
+        action="store_true",
+        help="Write the archive fields to the diag files as well as the plotted ones",
+    )
+
+    parser.add_argument(
+        "--tune-output",
+        action="store_true",
+        help="Time each PIO and output format option before the forecast",
+    )
+
+    parser.add_argument(
+        "--from-stage",
+        choices=manifest.STAGES,
+        default=None,
+        help="Rerun from this stage of the last run, taking earlier ones as done",
+    )
+
+    parser.add_argument(
+        "--until-stage",
+        choices=manifest.STAGES,
+        default=None,
+        help="Stop after this stage",
+    )
+
+    parser.add_argument(
+        "--on-deadline",
+        choices=("shorten", "refuse", "ignore"),
+        default="shorten",
+        help="Shorten or refuse a forecast that would end after the next cycle is out",
+    )
+
+    parser.add_argument(
+        "--plot-cores",
+        type=int,
+        default=0,
+        help="Cores left free of MPI ranks for plotting alongside the model",
+    )
+
     args = parser.parse_args()
     domain = args.domain
     resolution = args.resolution
     flength = args.length
     limited_area = args.limited_area
+    discover = args.discover_cycle
+    stream = args.stream
+    parallel_ungrib = args.parallel_ungrib
+    python_ungrib = args.python_ungrib
+    lbc_chunks = args.lbc_chunks
+    use_workspace = args.workspace
+    archive_diagnostics = args.archive_diagnostics
+    tune_output = args.tune_output
+    from_stage = args.from_stage
+    until_stage = args.until_stage
+    on_deadline = args.on_deadline
+    plot_cores = args.plot_cores
+    scaling_ranks = None
+    if args.scaling_ranks:
+        scaling_ranks = [int(n) for n in args.scaling_ranks.split(",")]
 
     main(
         domain_name=domain,
         resolution_km=resolution,
         flength=flength,
         limited_area=limited_area,
+        discover=discover,
+        stream=stream,
+        parallel_ungrib=parallel_ungrib,
+        python_ungrib=python_ungrib,
+        lbc_chunks=lbc_chunks,
+        use_workspace=use_workspace,
+        scaling_ranks=scaling_ranks,
+        archive_diagnostics=archive_diagnostics,
+        tune_output=tune_output,
+        from_stage=from_stage,
+        until_stage=until_stage,
+        on_deadline=on_deadline,
+        plot_cores=plot_cores,
     )
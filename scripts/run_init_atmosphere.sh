@@ -1,5 +1,13 @@
 #!/bin/bash
 
-cd ${ROOT_DIR}/MPAS-Model
-ln -s ${ROOT_DIR}/tools/WPS-4.4/FILE* .
-mpiexec -n 6 ./init_atmosphere_model
+# Usage: run_init_atmosphere.sh [run dir] [intermediate file dir] [MPI ranks]
+RUN_DIR=${1:-${ROOT_DIR}/MPAS-Model}
+FILE_DIR=${2:-${ROOT_DIR}/tools/WPS-4.4}
+NRANKS=${3:-6}
+
+cd ${RUN_DIR}
+# Cache hits are already linked here, only link what ungrib wrote
+for f in ${FILE_DIR}/FILE*; do
+    [ -e "$f" ] && ln -sf "$f" .
+done
+mpiexec -n ${NRANKS} ./init_atmosphere_model
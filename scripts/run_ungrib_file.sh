@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Ungribs a single GRIB file. Usage: run_ungrib_file.sh <grib file>
+
+cd ${TOOLS_DIR}/WPS-4.4
+rm -f GRIBFILE.*
+ln -sf $1 GRIBFILE.AAA
+ln -sf ungrib/Variable_Tables/Vtable.GFS Vtable
+./ungrib.exe
@@ -0,0 +1,140 @@
+"""JSON-lines spans for the pipeline stages, downloads, model binaries and
+plot phases. Every span carries its wall time, CPU time and peak RSS and the
+cycle it belongs to, so data/reports/spans/<cycle>.jsonl rebuilds where a
+whole cycle spent its time, across run_mpas.py, plot_raw.py and their
+worker processes"""
+
+import argparse
+from contextlib import contextmanager
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+SPANS_DIR = f"{ROOT_DIR}/data/reports/spans"
+# Inherited by subprocesses and pool workers so their spans join the cycle
+CYCLE_ENV = "MPAS_CYCLE_ID"
+UNKNOWN_CYCLE = "unknown"
+
+
+def set_cycle(init_date):
+    os.environ[CYCLE_ENV] = f"{init_date:%Y%m%d%H}"
+
+
+def cycle_id():
+    return os.environ.get(CYCLE_ENV, UNKNOWN_CYCLE)
+
+
+def spans_path(cycle):
+    return f"{SPANS_DIR}/{cycle}.jsonl"
+
+
+def peak_rss_mb():
+    "High water mark of this process, ru_maxrss is in kilobytes on Linux"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def emit(record):
+    "Appends one line in a single write so concurrent processes don't interleave"
+    os.makedirs(SPANS_DIR, exist_ok=True)
+    line = (json.dumps(record, default=str) + "\n").encode()
+    fd = os.open(
+        spans_path(record["cycle"]), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+    )
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the block as a span. Yields the span's attribute dict so the
+    block can add to it, e.g. bytes downloaded. CPU time is the calling
+    thread's, child processes report their own through attributes"""
+    record = dict(attrs)
+    start = time.time()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        end = time.time()
+        if "bytes" in record and end > start:
+            record["mb_per_second"] = record["bytes"] / 1e6 / (end - start)
+        record.update(
+            {
+                "cycle": cycle_id(),
+                "name": name,
+                "start": start,
+                "end": end,
+                "wall_seconds": end - start,
+                "cpu_seconds": time.thread_time() - cpu_start,
+                "max_rss_mb": peak_rss_mb(),
+                "pid": os.getpid(),
+                "thread": threading.current_thread().name,
+            }
+        )
+        try:
+            emit(record)
+        except OSError as e:
+            print("Span", name, "not recorded:", str(e))
+
+
+def timed(name=None, **attrs):
+    "Decorator recording every call of a function as a span"
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__, **attrs):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def read_spans(cycle):
+    spans = []
+    try:
+        with open(spans_path(cycle)) as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return sorted(spans, key=lambda s: s["start"])
+
+
+def print_timeline(cycle):
+    spans = read_spans(cycle)
+    if not spans:
+        print("No spans for cycle", cycle)
+        return
+    t0 = spans[0]["start"]
+    for s in spans:
+        label = s["name"] + "".join(
+            f" {key}={s[key]}" for key in ("stage", "product", "fhour") if key in s
+        )
+        print(
+            f"{s['start'] - t0:9.1f}s {s['wall_seconds']:9.1f}s "
+            f"cpu {s['cpu_seconds']:8.1f}s rss {s['max_rss_mb']:7.0f}MB  {label}"
+        )
+    print(f"Cycle {cycle} took {max(s['end'] for s in spans) - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cycle", type=str, help="YYYYMMDDHH")
+    args = parser.parse_args()
+
+    print_timeline(args.cycle)
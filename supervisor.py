@@ -0,0 +1,325 @@
+"""Runs ungrib, init_atmosphere_model and atmosphere_model under asyncio
+instead of blocking on subprocess.call. Their output and log file are
+followed for the model time reached, the process group is killed when a
+stage overruns its timeout or its output stalls, and each stage's CPU time
+and peak memory are recorded. Progress is kept in a json file other
+processes can poll"""
+
+import argparse
+import asyncio
+from collections import deque, namedtuple
+from datetime import datetime
+import json
+import os
+import re
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import spans
+
+POLL_SECONDS = 5
+KILL_GRACE_SECONDS = 10
+TAIL_LINES = 20
+
+# No output or log line for this long means the binary hung
+STALL_TIMEOUT = 15 * 60
+# Wall clock limit per stage, None for no limit. The least stage_timeout()
+# allows when the run is expected to take longer
+STAGE_TIMEOUTS = {
+    "ungrib": 30 * 60,
+    "init": 60 * 60,
+    "lbc": 2 * 60 * 60,
+    "model": 12 * 60 * 60,
+}
+# A stage is killed after this many times its expected wall time
+TIMEOUT_FACTOR = 3
+
+# Model time reached, from atmosphere_model's log and ungrib's output
+PROGRESS_PATTERNS = (
+    (
+        re.compile(r"Begin timestep (\d{4}-\d\d-\d\d_\d\d:\d\d:\d\d)"),
+        "%Y-%m-%d_%H:%M:%S",
+    ),
+    (
+        re.compile(r"Inventory for date = (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)"),
+        "%Y-%m-%d %H:%M:%S",
+    ),
+)
+
+Usage = namedtuple("Usage", ["wall_seconds", "cpu_seconds", "max_rss_mb"])
+
+
+class ProcessFailed(subprocess.CalledProcessError):
+    "Non-zero exit, timeout or hang. Callers catching CalledProcessError see it"
+
+    def __init__(self, returncode, cmd, reason, tail=()):
+        super().__init__(returncode, cmd, output="".join(tail))
+        self.reason = reason
+
+    def __str__(self):
+        return f"{self.reason}\n{self.output}" if self.output else self.reason
+
+
+def model_time(line):
+    for pattern, date_format in PROGRESS_PATTERNS:
+        match = pattern.search(line)
+        if match:
+            return datetime.strptime(match.group(1), date_format)
+    return None
+
+
+def read_progress(fpath):
+    "The progress a running or finished stage last wrote, None if there's none"
+    try:
+        with open(fpath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class LogTail:
+    """New lines of a log file the binary (re)creates after start. Files left
+    from an earlier run are ignored until they are rewritten"""
+
+    def __init__(self, fpath, start):
+        self.fpath = fpath
+        self.start = start
+        self.inode = None
+        self.offset = 0
+        self.partial = ""
+
+    def read(self):
+        try:
+            stat = os.stat(self.fpath)
+        except OSError:
+            return []
+        if stat.st_mtime < self.start:
+            return []
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.inode, self.offset, self.partial = stat.st_ino, 0, ""
+
+        with open(self.fpath, errors="replace") as f:
+            f.seek(self.offset)
+            text = f.read()
+            self.offset = f.tell()
+
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        return lines
+
+
+class Monitor:
+    """Tracks the last output time and model time of one stage and writes
+    them to progress_path"""
+
+    def __init__(self, stage, start_date=None, end_date=None, progress_path=None):
+        self.stage = stage
+        self.start_date = start_date
+        self.end_date = end_date
+        self.progress_path = progress_path
+        self.started = time.time()
+        self.last_output = self.started
+        self.model_time = None
+        self.tail = deque(maxlen=TAIL_LINES)
+
+    def line(self, line):
+        self.last_output = time.time()
+        self.tail.append(line if line.endswith("\n") else line + "\n")
+        reached = model_time(line)
+        if reached is not None:
+            self.model_time = reached
+
+    def fraction(self):
+        if None in (self.model_time, self.start_date, self.end_date):
+            return None
+        span = (self.end_date - self.start_date).total_seconds()
+        done = (self.model_time - self.start_date).total_seconds()
+        return min(1.0, max(0.0, done / span)) if span > 0 else None
+
+    def write(self, status, usage=None):
+        if self.progress_path is None:
+            return
+        elapsed = time.time() - self.started
+        fraction = self.fraction()
+        eta = None
+        if fraction:
+            eta = elapsed * (1 - fraction) / fraction
+        progress = {
+            "stage": self.stage,
+            "status": status,
+            "start_date": self.start_date and self.start_date.isoformat(),
+            "started": self.started,
+            "elapsed": elapsed,
+            "last_output": self.last_output,
+            "model_time": self.model_time and self.model_time.isoformat(),
+            "fraction": fraction,
+            "eta_seconds": eta,
+            "usage": usage and usage._asdict(),
+        }
+        tmp = f"{self.progress_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(progress, f, indent=2)
+        os.replace(tmp, self.progress_path)
+
+
+async def _read_output(stream, monitor, out):
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        text = line.decode(errors="replace")
+        out.write(text)
+        out.flush()
+        monitor.line(text)
+
+
+def _signal_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def _stop(proc, wait):
+    _signal_group(proc.pid, signal.SIGTERM)
+    done, _ = await asyncio.wait({wait}, timeout=KILL_GRACE_SECONDS)
+    if not done:
+        _signal_group(proc.pid, signal.SIGKILL)
+        await wait
+
+
+async def supervise(
+    cmd,
+    stage,
+    log_path=None,
+    start_date=None,
+    end_date=None,
+    timeout=None,
+    stall_timeout=STALL_TIMEOUT,
+    cwd=None,
+    output_path=None,
+    progress_path=None,
+):
+    """Runs cmd in its own process group, following its output and log_path.
+    start_date and end_date bound the model time for the progress fraction.
+    Returns the stage's Usage, raises ProcessFailed"""
+    if isinstance(cmd, str):
+        cmd = [cmd]
+    monitor = Monitor(stage, start_date, end_date, progress_path)
+    log_tail = LogTail(log_path, monitor.started) if log_path else None
+
+    fd, rusage_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    out = open(output_path, "w") if output_path else sys.stdout
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.abspath(__file__),
+            "--rusage",
+            rusage_path,
+            *cmd,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+        )
+        reader = asyncio.create_task(_read_output(proc.stdout, monitor, out))
+        wait = asyncio.create_task(proc.wait())
+
+        failure = None
+        while failure is None:
+            done, _ = await asyncio.wait({wait}, timeout=POLL_SECONDS)
+            if log_tail is not None:
+                for line in log_tail.read():
+                    monitor.line(line)
+            if done:
+                break
+
+            now = time.time()
+            if timeout is not None and now - monitor.started > timeout:
+                failure = f"{stage} timed out after {timeout:.0f}s"
+            elif now - monitor.last_output > stall_timeout:
+                failure = f"{stage} hung, no output for {stall_timeout:.0f}s"
+            else:
+                monitor.write("running")
+
+        if failure is not None:
+            await _stop(proc, wait)
+        await reader
+
+        usage = Usage(time.time() - monitor.started, None, None)
+        try:
+            with open(rusage_path) as f:
+                usage = Usage(usage.wall_seconds, **json.load(f))
+        except (OSError, ValueError, TypeError):
+            pass
+    finally:
+        os.remove(rusage_path)
+        if output_path:
+            out.close()
+
+    if failure is None and proc.returncode != 0:
+        failure = f"{stage} exited with {proc.returncode}"
+    monitor.write("failed" if failure else "done", usage)
+    if failure is not None:
+        raise ProcessFailed(proc.returncode, cmd, failure, monitor.tail)
+
+    print(
+        f"{stage}: {usage.wall_seconds:.1f}s wall, "
+        + (
+            f"{usage.cpu_seconds:.1f}s CPU, {usage.max_rss_mb:.0f} MB max RSS"
+            if usage.cpu_seconds is not None
+            else "no rusage"
+        )
+    )
+    return usage
+
+
+def stage_timeout(stage, expected_seconds=None):
+    """TIMEOUT_FACTOR times the stage's expected wall time, e.g. from the
+    planner, but at least STAGE_TIMEOUTS"""
+    floor = STAGE_TIMEOUTS.get(stage)
+    if floor is None or expected_seconds is None:
+        return floor
+    return max(floor, TIMEOUT_FACTOR * expected_seconds)
+
+
+def run(cmd, stage, **kwargs):
+    """Blocking supervise() for the pipeline's threads. The stage's default
+    timeout comes from STAGE_TIMEOUTS"""
+    kwargs.setdefault("timeout", STAGE_TIMEOUTS.get(stage))
+    with spans.span(stage, kind="process", log_path=kwargs.get("log_path")) as span:
+        usage = asyncio.run(supervise(cmd, stage, **kwargs))
+        span["child_cpu_seconds"] = usage.cpu_seconds
+        span["child_max_rss_mb"] = usage.max_rss_mb
+    return usage
+
+
+def _run_with_rusage(rusage_path, cmd):
+    """Runs cmd to completion and writes the resource usage of it and its
+    children, which are exactly this wrapper's children"""
+    returncode = subprocess.call(cmd)
+    rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(rusage_path, "w") as f:
+        json.dump(
+            {
+                "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+                # ru_maxrss is in kilobytes on Linux
+                "max_rss_mb": rusage.ru_maxrss / 1024,
+            },
+            f,
+        )
+    return returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rusage", type=str, required=True)
+    parser.add_argument("cmd", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.exit(_run_with_rusage(args.rusage, args.cmd))
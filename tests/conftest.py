@@ -0,0 +1,10 @@
+"""The modules are flat files in the repository root that read ROOT_DIR when
+imported"""
+
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("ROOT_DIR", REPO_DIR)
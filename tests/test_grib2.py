@@ -0,0 +1,119 @@
+"""Decodes messages eccodes packs and compares them with its own decoding"""
+
+import numpy as np
+import pytest
+
+import grib2
+
+eccodes = pytest.importorskip("eccodes")
+
+MISSING = 9999.0
+# Points of the GRIB2 sample's 16x31 grid, first and last included
+MISSING_POINTS = [0, 3, 100, 101, 495]
+
+
+def sample_values(n_points, missing):
+    rng = np.random.default_rng(0)
+    values = 250 + 20 * np.sin(np.arange(n_points) / 17) + rng.normal(0, 1, n_points)
+    values = np.round(values, 2)
+    if missing:
+        values[MISSING_POINTS] = MISSING
+    return values
+
+
+def write_message(fpath, packing_type, order=None, missing="bitmap"):
+    """Packs a field on the sample lat/lon grid. missing: "bitmap", "in-band"
+    for complex packing's missing value management, or None. Returns the
+    values eccodes decodes, NaN where missing, in grib2's orientation"""
+    gid = eccodes.codes_grib_new_from_samples("GRIB2")
+    try:
+        eccodes.codes_set(gid, "packingType", packing_type)
+        eccodes.codes_set(gid, "bitsPerValue", 16)
+        if order is not None:
+            eccodes.codes_set(gid, "orderOfSpatialDifferencing", order)
+        if missing == "bitmap":
+            eccodes.codes_set(gid, "bitmapPresent", 1)
+        elif missing == "in-band":
+            eccodes.codes_set(gid, "missingValueManagementUsed", 1)
+        eccodes.codes_set(gid, "missingValue", MISSING)
+
+        n_points = eccodes.codes_get(gid, "numberOfDataPoints")
+        eccodes.codes_set_values(gid, sample_values(n_points, missing))
+        with open(fpath, "wb") as f:
+            f.write(eccodes.codes_get_message(gid))
+
+        decoded = eccodes.codes_get_values(gid)
+        shape = (eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni"))
+    finally:
+        eccodes.codes_release(gid)
+
+    decoded = np.where(decoded == MISSING, np.nan, decoded).reshape(shape)
+    # The sample scans north to south
+    return decoded[::-1]
+
+
+@pytest.mark.parametrize(
+    "packing_type,template,order,missing",
+    [
+        ("grid_simple", grib2.SIMPLE_PACKING, None, None),
+        ("grid_simple", grib2.SIMPLE_PACKING, None, "bitmap"),
+        ("grid_complex", grib2.COMPLEX_PACKING, None, "bitmap"),
+        ("grid_complex", grib2.COMPLEX_PACKING, None, "in-band"),
+        (
+            "grid_complex_spatial_differencing",
+            grib2.COMPLEX_PACKING_SPATIAL_DIFF,
+            1,
+            "bitmap",
+        ),
+        (
+            "grid_complex_spatial_differencing",
+            grib2.COMPLEX_PACKING_SPATIAL_DIFF,
+            2,
+            "bitmap",
+        ),
+        (
+            "grid_complex_spatial_differencing",
+            grib2.COMPLEX_PACKING_SPATIAL_DIFF,
+            2,
+            "in-band",
+        ),
+    ],
+)
+def test_decode_matches_eccodes(tmp_path, packing_type, template, order, missing):
+    fpath = tmp_path / "field.grib2"
+    expected = write_message(fpath, packing_type, order, missing)
+
+    (field,) = grib2.fields(fpath)
+    assert grib2._uint(field.section5, 10, 2) == template
+    values = field.values()
+
+    assert values.dtype == np.float32
+    assert values.shape == expected.shape
+    np.testing.assert_array_equal(np.isnan(values), np.isnan(expected))
+    assert np.isnan(values).sum() == (len(MISSING_POINTS) if missing else 0)
+    np.testing.assert_allclose(values, expected, rtol=1e-6, equal_nan=True)
+
+
+def test_fields_reads_every_message(tmp_path):
+    fpath = tmp_path / "fields.grib2"
+    write_message(tmp_path / "a.grib2", "grid_simple")
+    write_message(tmp_path / "b.grib2", "grid_complex_spatial_differencing", 2)
+    fpath.write_bytes(
+        (tmp_path / "a.grib2").read_bytes() + (tmp_path / "b.grib2").read_bytes()
+    )
+
+    templates = [grib2._uint(f.section5, 10, 2) for f in grib2.fields(fpath)]
+    assert templates == [
+        grib2.SIMPLE_PACKING,
+        grib2.COMPLEX_PACKING_SPATIAL_DIFF,
+    ]
+
+
+def test_unsupported_template(tmp_path):
+    fpath = tmp_path / "field.grib2"
+    write_message(fpath, "grid_simple")
+    (field,) = grib2.fields(fpath)
+    section5 = bytearray(field.section5)
+    section5[10] = 40
+    with pytest.raises(grib2.GribError):
+        grib2.decode_values(bytes(section5), field.section7)
@@ -0,0 +1,180 @@
+"""Structural checks of GRIB2 files before ungrib reads them"""
+
+import os
+import struct
+
+import pytest
+
+import grib_check
+import vtable
+
+
+def section4(level_type, scale, value):
+    "Product definition section with only the first fixed surface set"
+    section = bytearray(34)
+    section[:5] = struct.pack(">IB", 34, grib_check.PRODUCT_SECTION)
+    section[22] = level_type
+    section[23] = scale
+    section[24:28] = struct.pack(">I", value)
+    return bytes(section)
+
+
+@pytest.mark.parametrize(
+    "level_type,scale,value,expected",
+    [
+        (100, 0, 50000, 50000),
+        (106, 2, 10, 0.1),
+        # Sign bits, not two's complement
+        (103, 0x81, 20, 200),
+        (160, 0, 0x80000005, -5),
+        (1, 0, 0xFFFFFFFF, None),
+        (255, 0, 0, None),
+    ],
+)
+def test_first_surface(level_type, scale, value, expected):
+    assert grib_check._first_surface(section4(level_type, scale, value)) == (
+        level_type,
+        pytest.approx(expected) if expected is not None else None,
+    )
+
+
+def test_first_surface_largest_value_is_not_missing():
+    # Only all bits set marks a missing value
+    assert grib_check._first_surface(section4(160, 0, 0x7FFFFFFF)) == (
+        160,
+        0x7FFFFFFF,
+    )
+
+
+TEMPERATURE = (0, 0, 0)
+HEIGHT = (0, 3, 5)
+PRESSURE = (0, 3, 0)
+NFGLEVELS = 4
+LEVELS_PA = [100000, 97500, 95000]
+
+
+def entry(code, grib2_level, level1=None):
+    return vtable.VtableEntry(11, 100, level1, None, "TT", "K", "", *code, grib2_level)
+
+
+ENTRIES = [
+    entry(TEMPERATURE, vtable.ISOBARIC),
+    entry(HEIGHT, vtable.ISOBARIC),
+    entry(PRESSURE, vtable.MEAN_SEA_LEVEL, 0),
+]
+
+
+def message(code, level_type, level):
+    "GRIB2 message of one product whose sections scan_grib2 reads"
+    discipline, category, parameter = code
+    product = bytearray(section4(level_type, 0, level))
+    product[9:11] = bytes([category, parameter])
+    data = struct.pack(">IB", 5, grib_check.DATA_SECTION)
+    length = grib_check.SECTION0_SIZE + len(product) + len(data) + 4
+    section0 = b"GRIB" + bytes([0, 0, discipline, 2]) + struct.pack(">Q", length)
+    return section0 + bytes(product) + data + grib_check.END_MARKER
+
+
+def inventory(skip=()):
+    "Messages of every Vtable field and level, less the (code, level) in skip"
+    fields = []
+    for code in (TEMPERATURE, HEIGHT):
+        for pa in LEVELS_PA:
+            fields.append((code, vtable.ISOBARIC, pa))
+    fields.append((PRESSURE, vtable.MEAN_SEA_LEVEL, 0))
+    return [field for field in fields if (field[0], field[2]) not in skip]
+
+
+def write_grib(fpath, fields):
+    with open(fpath, "wb") as f:
+        for field in fields:
+            f.write(message(*field))
+    return str(fpath)
+
+
+def test_scan(tmp_path):
+    fields, problems = grib_check.scan_grib2(write_grib(tmp_path / "f", inventory()))
+    assert problems == []
+    assert len(fields) == 7
+    assert fields[0] == (0, 0, 0, vtable.ISOBARIC, 100000)
+
+
+def test_scan_truncated(tmp_path):
+    fpath = write_grib(tmp_path / "f", inventory())
+    with open(fpath, "r+b") as f:
+        f.truncate(os.path.getsize(fpath) - 10)
+    fields, problems = grib_check.scan_grib2(fpath)
+    assert len(fields) == 6
+    assert problems[0].startswith("Truncated message")
+
+
+def test_scan_html(tmp_path):
+    fpath = tmp_path / "f"
+    fpath.write_bytes(b"\n<!DOCTYPE html><html><body>Too many requests</body></html>")
+    assert grib_check.scan_grib2(str(fpath)) == ([], ["HTML instead of GRIB"])
+
+
+def test_scan_unterminated(tmp_path):
+    fpath = tmp_path / "f"
+    fpath.write_bytes(message(TEMPERATURE, vtable.ISOBARIC, 100000)[:-4] + b"0000")
+    _, problems = grib_check.scan_grib2(str(fpath))
+    assert problems == ["Message at byte 0 not terminated by 7777"]
+
+
+def test_scan_empty(tmp_path):
+    fpath = tmp_path / "f"
+    fpath.write_bytes(b"")
+    assert grib_check.scan_grib2(str(fpath)) == ([], ["Empty file"])
+
+
+def validate(tmp_path, hours):
+    "hours: {fhour: fields}"
+    fpaths = {
+        fhour: write_grib(tmp_path / f"f{fhour:03d}", fields)
+        for fhour, fields in hours.items()
+    }
+    return grib_check.validate_gribs(fpaths, ENTRIES, NFGLEVELS)
+
+
+def test_expected_levels():
+    assert grib_check.expected_levels(NFGLEVELS) == set(LEVELS_PA)
+    assert 1 in grib_check.expected_levels(len(vtable.GFS_ISOBARIC_LEVELS) + 1)
+
+
+def test_validate_complete(tmp_path):
+    report = validate(tmp_path, {fhour: inventory() for fhour in range(3)})
+    assert all(
+        not hour["problems"] and not hour["warnings"] for hour in report.values()
+    )
+
+
+def test_validate_short_file(tmp_path):
+    hours = {fhour: inventory() for fhour in range(3)}
+    hours[1] = inventory(skip={(HEIGHT, 95000), (PRESSURE, 0)})
+    report = validate(tmp_path, hours)
+    assert report[0]["problems"] == report[2]["problems"] == []
+    assert report[1]["problems"] == [
+        f"No [{PRESSURE}] on level type {vtable.MEAN_SEA_LEVEL}",
+        f"No [{HEIGHT}] at [95000] Pa",
+    ]
+
+
+def test_validate_never_provided(tmp_path):
+    # Levels and fields no hour has are checked against the Vtable, but only
+    # warned about
+    skip = {(HEIGHT, 95000), (PRESSURE, 0)}
+    report = validate(tmp_path, {fhour: inventory(skip) for fhour in range(3)})
+    for hour in report.values():
+        assert hour["problems"] == []
+        assert hour["warnings"] == [
+            f"No [{PRESSURE}] on level type {vtable.MEAN_SEA_LEVEL}, "
+            "nor in most hours",
+            f"No [{HEIGHT}] at [95000] Pa in most hours",
+        ]
+
+
+def test_validate_missing_file(tmp_path):
+    fpaths = {0: write_grib(tmp_path / "f000", inventory())}
+    fpaths[1] = str(tmp_path / "f001")
+    report = grib_check.validate_gribs(fpaths, ENTRIES, NFGLEVELS)
+    assert report[1]["problems"] == ["File missing"]
@@ -0,0 +1,65 @@
+"""When a recorded stage counts as up to date"""
+
+import pytest
+
+import manifest
+import spans
+
+
+@pytest.fixture
+def stages(tmp_path, monkeypatch):
+    monkeypatch.setattr(spans, "SPANS_DIR", str(tmp_path / "spans"))
+    return manifest.Manifest(str(tmp_path / "manifest.json"))
+
+
+def write(fpath, text):
+    fpath.write_text(text)
+    return str(fpath)
+
+
+def test_unrecorded_stage_is_not_current(stages):
+    assert not stages.is_current("init", {"flength": 12})
+
+
+def test_recorded_stage_is_current(stages, tmp_path):
+    output = write(tmp_path / "init.nc", "init")
+    assert stages.run("init", lambda: None, {"flength": 12}, lambda: [output])
+
+    assert stages.is_current("init", {"flength": 12})
+    reloaded = manifest.Manifest(stages.fpath)
+    assert reloaded.is_current("init", {"flength": 12})
+    assert not reloaded.run("init", pytest.fail, {"flength": 12}, lambda: [output])
+
+
+def test_inputs_compare_as_stored(stages):
+    stages.run("download", lambda: None, {"extent": (1.5, 2.5)}, lambda: [])
+    assert stages.is_current("download", {"extent": [1.5, 2.5]})
+    assert not stages.is_current("download", {"extent": [1.5, 3.5]})
+    assert not stages.is_current("download", {"extent": [1.5, 2.5], "globe": True})
+
+
+def test_replaced_output_is_not_current(stages, tmp_path):
+    output = write(tmp_path / "lbc.nc", "lbc")
+    stages.run("lbc", lambda: None, {}, lambda: [output])
+
+    write(tmp_path / "lbc.nc", "lbc rewritten")
+    assert not stages.is_current("lbc", {})
+
+
+def test_missing_output_is_not_current(stages, tmp_path):
+    output = write(tmp_path / "diag.nc", "diag")
+    stages.run("model", lambda: None, {}, lambda: [output])
+
+    (tmp_path / "diag.nc").unlink()
+    assert not stages.is_current("model", {})
+
+
+def test_failed_stage_is_not_current(stages):
+    def fail():
+        raise RuntimeError("init_atmosphere failed")
+
+    stages.run("init", lambda: None, {}, lambda: [])
+    with pytest.raises(RuntimeError):
+        stages.run("init", fail, {"flength": 6}, lambda: [])
+    assert not stages.is_current("init", {})
+    assert not stages.is_current("init", {"flength": 6})
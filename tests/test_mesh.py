@@ -0,0 +1,56 @@
+"""Time step and dissipation length from a mesh's cell spacing"""
+
+import pytest
+
+import mesh
+import run_mpas
+
+
+def spacing(min_dc, n_cells=10000):
+    return mesh.MeshSpacing(n_cells, min_dc, min_dc * 1.1, min_dc * 1.5)
+
+
+@pytest.mark.parametrize(
+    "min_dc,sub_steps,dt",
+    [
+        # Acoustic limit 74.1s
+        (12000, 2, 72.0),
+        # Acoustic limit 18.5s
+        (3000, 2, 18.0),
+        # More sub steps leave the advective limit of 35s
+        (3000, 4, 30.0),
+        (1, 2, 1.0),
+    ],
+)
+def test_stable_dt(min_dc, sub_steps, dt):
+    assert mesh.stable_dt(spacing(min_dc), sub_steps) == dt
+
+
+@pytest.mark.parametrize("min_dc", [500, 3000, 12000, 60000, 120000])
+def test_stable_dt_within_limits(min_dc):
+    dt = mesh.stable_dt(spacing(min_dc))
+    assert mesh.OUTPUT_INTERVAL % dt == 0
+    assert mesh.acoustic_courant(dt, min_dc) <= mesh.ACOUSTIC_COURANT
+    assert mesh.advective_courant(dt, min_dc) <= mesh.ADVECTIVE_COURANT
+    assert dt == max(mesh.candidate_dts(mesh.dt_limit(spacing(min_dc))))
+
+
+def test_dt_table_marks_stable():
+    rows = mesh.dt_table(spacing(12000), 24, 8)
+    assert [row[0] for row in rows if row[3]][-1] == 72
+    assert not rows[-1][3]
+
+
+def test_len_disp():
+    assert mesh.len_disp(spacing(11937.5)) == 11900
+    assert mesh.len_disp(spacing(30)) == 30
+
+
+def test_time_step_table_uses_run_ranks(monkeypatch):
+    monkeypatch.setattr(mesh, "analyze", lambda fpath: spacing(12000))
+    tables = []
+    monkeypatch.setattr(mesh, "print_dt_table", tables.append)
+
+    run_mpas.mesh_time_step("test", 12, 24, 2, ranks=3)
+    run_mpas.mesh_time_step("test", 12, 24, 2, ranks=6)
+    assert tables[0][0][4] == pytest.approx(2 * tables[1][0][4])
@@ -0,0 +1,53 @@
+"""Core shares, the shared download extent and global mesh detection"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import mesh
+import multi_domain
+
+
+def test_core_shares_use_every_core():
+    shares = multi_domain.core_shares({"a": 3, "b": 1}, 8)
+    assert shares == {"a": 6, "b": 2}
+
+
+def test_core_shares_remainders_go_to_largest_fractions():
+    shares = multi_domain.core_shares({"a": 1, "b": 1, "c": 1}, 7)
+    assert sum(shares.values()) == 7
+    assert sorted(shares.values()) == [2, 2, 3]
+
+
+def test_core_shares_small_domains_get_one_core_without_oversubscribing():
+    shares = multi_domain.core_shares({"big": 100, "b": 1, "c": 1, "d": 1}, 6)
+    assert sum(shares.values()) == 6
+    assert shares == {"big": 3, "b": 1, "c": 1, "d": 1}
+
+
+def test_core_shares_one_core_per_domain():
+    shares = multi_domain.core_shares({"a": 100, "b": 1, "c": 1, "d": 1}, 4)
+    assert shares == {"a": 1, "b": 1, "c": 1, "d": 1}
+
+
+def test_core_shares_more_domains_than_cores():
+    with pytest.raises(ValueError):
+        multi_domain.core_shares({"a": 1, "b": 1, "c": 1}, 2)
+
+
+def test_union_extent():
+    extents = [((-110, -100), (35, 42)), ((-125, -105), (30, 49))]
+    assert multi_domain.union_extent(extents) == ((-125, -100), (30, 49))
+
+
+@pytest.mark.parametrize("mask,expected", [([0, 0, 0], False), ([0, 1, 7], True)])
+def test_is_limited_area(tmp_path, mask, expected):
+    fpath = tmp_path / "static.nc"
+    xr.Dataset({"bdyMaskCell": ("nCells", np.array(mask, dtype="i4"))}).to_netcdf(fpath)
+    assert mesh.is_limited_area(fpath) is expected
+
+
+def test_mesh_without_boundary_mask_is_global(tmp_path):
+    fpath = tmp_path / "static.nc"
+    xr.Dataset({"areaCell": ("nCells", np.ones(3))}).to_netcdf(fpath)
+    assert not mesh.is_limited_area(fpath)
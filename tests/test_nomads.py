@@ -0,0 +1,328 @@
+"""Inventory parsing and byte range merging of the GRIB subset downloads,
+the request budget and the download scheduler"""
+
+from datetime import datetime
+import threading
+import time
+
+import pytest
+import requests
+
+import nomads
+
+IDX = """\
+1:0:d=2026101800:HGT:1000 mb:anl:
+2:1000:d=2026101800:TMP:1000 mb:anl:
+3:2500:d=2026101800:UGRD:1000 mb:anl:
+4:200000:d=2026101800:VGRD:1000 mb:anl:
+5:201000:d=2026101800:PRMSL:mean sea level:anl:
+"""
+
+
+def test_parse_idx():
+    records = nomads.parse_idx(IDX)
+
+    assert [r.number for r in records] == [1, 2, 3, 4, 5]
+    assert records[0] == nomads.IdxRecord(1, 0, 999, "HGT", "1000 mb", "anl")
+    assert records[3].end == 200999
+    # The last message runs to the end of the file
+    assert records[-1].start == 201000
+    assert records[-1].end is None
+    assert records[-1].level == "mean sea level"
+
+
+def test_parse_idx_skips_short_lines():
+    records = nomads.parse_idx("\n" + IDX + "garbage\n")
+    assert len(records) == 5
+
+
+def test_coalesce_adjacent_ranges():
+    records = nomads.parse_idx(IDX)
+    assert nomads.coalesce_ranges(records[:3]) == [(0, 199999)]
+
+
+def test_coalesce_keeps_distant_ranges_apart():
+    records = nomads.parse_idx(IDX)
+    ranges = nomads.coalesce_ranges([records[0], records[3]], gap=0)
+    assert ranges == [(0, 999), (200000, 200999)]
+
+
+def test_coalesce_bridges_small_gaps():
+    records = nomads.parse_idx(IDX)
+    ranges = nomads.coalesce_ranges([records[0], records[2]], gap=1500)
+    assert ranges == [(0, 199999)]
+
+
+def test_coalesce_sorts_and_runs_to_the_end():
+    records = nomads.parse_idx(IDX)
+    ranges = nomads.coalesce_ranges([records[4], records[3], records[0]], gap=0)
+    assert ranges == [(0, 999), (200000, None)]
+    assert nomads.range_header(ranges) == "bytes=0-999,200000-"
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=b"", headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.headers = headers or {}
+        self.text = body.decode(errors="replace")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i : i + chunk_size]
+
+
+class FakeSession:
+    """Answers each GET with the next of responses, raising the exceptions
+    among them"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class CountingBucket(nomads.TokenBucket):
+    def __init__(self):
+        super().__init__(rate=1e6, capacity=1e6)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        super().acquire()
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    bucket = CountingBucket()
+    monkeypatch.setattr(nomads, "_budget", bucket)
+    monkeypatch.setattr(nomads, "BACKOFF_BASE", 0.001)
+    return bucket
+
+
+def fake_session(monkeypatch, responses):
+    session = FakeSession(responses)
+    monkeypatch.setattr(nomads, "get_session", lambda: session)
+    return session
+
+
+def test_request_budget_is_process_wide():
+    assert nomads.request_budget() is nomads.request_budget()
+    assert not hasattr(nomads.DownloadScheduler(), "bucket")
+
+
+def test_token_bucket_rate():
+    bucket = nomads.TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    # Two from the burst, five at 50 per second
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_drain():
+    bucket = nomads.TokenBucket(rate=50, capacity=5)
+    bucket.drain()
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.015
+
+
+def test_every_request_takes_a_token(monkeypatch, tmp_path, budget):
+    fake_session(
+        monkeypatch,
+        [FakeResponse(200, IDX.encode()), FakeResponse(206, b"x" * 2000)],
+    )
+    status_code, _ = nomads.download_grib_subset(
+        "https://nomads/f000",
+        str(tmp_path / "f000"),
+        lambda name, level, forecast: name in ("HGT", "VGRD"),
+    )
+
+    assert status_code == 206
+    # The .idx and one multi range request
+    assert budget.acquired == 2
+
+
+def test_listing_polls_take_tokens(monkeypatch, budget):
+    listing = "gfs.t00z.pgrb2.0p25.f000.idx gfs.t00z.pgrb2.0p25.f001.idx"
+    fake_session(monkeypatch, [FakeResponse(200, listing.encode())])
+    fhours = nomads.published_fhours(datetime(2026, 10, 18, 0))
+    assert fhours == {0, 1}
+    assert budget.acquired == 1
+
+
+def test_scheduled_download_is_not_retried_twice(monkeypatch, tmp_path, budget):
+    error = requests.exceptions.ConnectionError("reset")
+    session = fake_session(monkeypatch, [error, error, FakeResponse(200, b"grib")])
+    fpath = tmp_path / "f000"
+    job = (nomads.download_file, ("https://nomads/f000", str(fpath)))
+
+    assert nomads.DownloadScheduler().run([job]) == [200]
+    # Each failure costs one request, retried by the scheduler only
+    assert len(session.requests) == 3
+    assert fpath.read_bytes() == b"grib"
+
+
+def test_unscheduled_download_retries_itself(monkeypatch, tmp_path, budget):
+    error = requests.exceptions.ConnectionError("reset")
+    fake_session(monkeypatch, [error, FakeResponse(200, b"grib")])
+    fpath = tmp_path / "f000"
+    assert nomads.download_file("https://nomads/f000", str(fpath)) == (200, 4)
+
+
+def test_scheduler_backs_off_when_throttled(monkeypatch, budget):
+    codes = [429, 503, 200]
+    scheduler = nomads.DownloadScheduler(start_workers=4)
+    status_codes = scheduler.run([(lambda: (codes.pop(0), 10), ())])
+
+    assert status_codes == [200]
+    # Halved twice, then one success grows it back by one
+    assert scheduler.limit == 2
+    assert scheduler.backoff_until > 0
+
+
+def test_scheduler_gives_up_after_max_attempts(monkeypatch, budget):
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        return 429, 0
+
+    assert nomads.DownloadScheduler().run([(throttled, ())]) == [429]
+    assert len(calls) == nomads.MAX_ATTEMPTS
+
+
+def test_scheduler_concurrency_limit(budget):
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def job():
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.pop()
+        return 200, 0
+
+    scheduler = nomads.DownloadScheduler(start_workers=2, max_workers=2)
+    assert scheduler.run([(job, ())] * 8) == [200] * 8
+    assert max(peak) == 2
+
+
+@pytest.mark.parametrize("status_code", [429, 503, 500])
+def test_throttled_inventory_is_returned(monkeypatch, tmp_path, budget, status_code):
+    session = fake_session(monkeypatch, [FakeResponse(status_code)])
+    fpath = tmp_path / "f000"
+    result = nomads.download_grib_subset("https://nomads/f000", str(fpath), any)
+
+    assert result == (status_code, 0)
+    assert len(session.requests) == 1
+    assert not fpath.exists()
+
+
+def test_missing_inventory_downloads_full_file(monkeypatch, tmp_path, budget):
+    session = fake_session(monkeypatch, [FakeResponse(404), FakeResponse(200, b"g")])
+    fpath = tmp_path / "f000"
+    result = nomads.download_grib_subset("https://nomads/f000", str(fpath), any)
+
+    assert result == (200, 1)
+    assert session.requests[1][0] == "https://nomads/f000"
+    assert fpath.read_bytes() == b"g"
+
+
+BODY = b"GRIB" + bytes(range(256)) * 4 + b"7777"
+URL = "https://nomads.ncep.noaa.gov/gfs.t00z.pgrb2.0p25.f000"
+
+
+def test_download_writes_whole_file(tmp_path, budget, monkeypatch):
+    session = fake_session(monkeypatch, [FakeResponse(200, BODY)])
+    fpath = str(tmp_path / "f000")
+
+    assert nomads.download_file(URL, fpath) == (200, len(BODY))
+    assert open(fpath, "rb").read() == BODY
+    assert "Range" not in session.requests[0][1]["headers"]
+    assert not (tmp_path / ".f000.part").exists()
+
+
+def test_download_resumes_partial_file(tmp_path, budget, monkeypatch):
+    (tmp_path / ".f000.part").write_bytes(BODY[:100])
+    session = fake_session(monkeypatch, [FakeResponse(206, BODY[100:])])
+    fpath = str(tmp_path / "f000")
+
+    assert nomads.download_file(URL, fpath) == (206, len(BODY) - 100)
+    assert open(fpath, "rb").read() == BODY
+    assert session.requests[0][1]["headers"] == {"Range": "bytes=100-"}
+
+
+def test_download_restarts_when_range_ignored(tmp_path, budget, monkeypatch):
+    (tmp_path / ".f000.part").write_bytes(b"stale")
+    fake_session(monkeypatch, [FakeResponse(200, BODY)])
+    fpath = str(tmp_path / "f000")
+
+    assert nomads.download_file(URL, fpath) == (200, len(BODY))
+    assert open(fpath, "rb").read() == BODY
+
+
+def test_download_resumes_after_dropped_connection(tmp_path, budget, monkeypatch):
+    (tmp_path / ".f000.part").write_bytes(BODY[:100])
+    session = fake_session(
+        monkeypatch,
+        [requests.exceptions.ConnectionError("reset"), FakeResponse(206, BODY[100:])],
+    )
+    fpath = str(tmp_path / "f000")
+
+    assert nomads.download_file(URL, fpath) == (206, len(BODY) - 100)
+    assert open(fpath, "rb").read() == BODY
+    assert len(session.requests) == 2
+
+
+def test_download_finishes_complete_partial_file(tmp_path, budget, monkeypatch):
+    # The last transfer got every byte but stopped before the rename
+    (tmp_path / ".f000.part").write_bytes(BODY)
+    headers = {"Content-Range": f"bytes */{len(BODY)}"}
+    session = fake_session(monkeypatch, [FakeResponse(416, headers=headers)])
+    fpath = str(tmp_path / "f000")
+
+    assert nomads.download_file(URL, fpath) == (206, 0)
+    assert open(fpath, "rb").read() == BODY
+    assert len(session.requests) == 1
+    assert not (tmp_path / ".f000.part").exists()
+
+
+@pytest.mark.parametrize("content_range", ["bytes */99", "bytes */*", None])
+def test_download_restarts_stale_partial_file(
+    tmp_path, budget, monkeypatch, content_range
+):
+    (tmp_path / ".f000.part").write_bytes(BODY[:100] + b"longer than the file")
+    headers = {"Content-Range": content_range} if content_range else {}
+    session = fake_session(
+        monkeypatch, [FakeResponse(416, headers=headers), FakeResponse(200, BODY)]
+    )
+    fpath = str(tmp_path / "f000")
+
+    assert nomads.download_file(URL, fpath) == (200, len(BODY))
+    assert open(fpath, "rb").read() == BODY
+    assert "Range" not in session.requests[1][1]["headers"]
+
+
+def test_range_total():
+    assert nomads.range_total("bytes */1234") == 1234
+    assert nomads.range_total("bytes 0-99/1234") == 1234
+    assert nomads.range_total("bytes 0-99/*") is None
+    assert nomads.range_total(None) is None
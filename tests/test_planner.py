@@ -0,0 +1,151 @@
+"""Forecast length and rank choices against the next cycle's deadline"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import manifest
+import planner
+import run_mpas
+
+SIZE = planner.MeshSize(n_cells=10000, n_vert_levels=55)
+DT = 60.0
+# Without history: 540s of download, wps and init, 10s of lbc per hour and
+# 108 core seconds of model per hour at this size and time step
+ESTIMATE = {"records": [], "size": SIZE, "dt": DT}
+INIT_DATE = datetime(2026, 10, 18, 0)
+
+
+def wall_seconds(flength, ranks):
+    return 540 + 10 * flength + 108 * flength / ranks
+
+
+def test_estimate_without_history():
+    run = planner.estimate("test", 12, 10, 2, **ESTIMATE)
+    assert run.stage_seconds == pytest.approx(
+        {"download": 300, "wps": 120, "init": 120, "lbc": 100, "model": 540}
+    )
+    assert run.wall_seconds == pytest.approx(wall_seconds(10, 2))
+
+
+def test_estimate_scales_model_with_history():
+    records = [
+        {
+            "ranks": 2,
+            "n_cells": 10000,
+            "flength": 6,
+            "dt": 60.0,
+            "stages": {"model": 648.0, "lbc": 120.0},
+        }
+    ]
+    run = planner.estimate("test", 12, 12, 2, records=records, size=SIZE, dt=DT)
+    # Twice the default cell step cost, 20s of lbc per hour
+    assert run.stage_seconds["model"] == pytest.approx(2 * 108 * 12 / 2)
+    assert run.stage_seconds["lbc"] == pytest.approx(240)
+
+
+def test_longest_run():
+    seconds_left = wall_seconds(10, 1) + planner.PLOT_MARGIN_SECONDS
+    run = planner.longest_run("test", 12, 24, 1, seconds_left, **ESTIMATE)
+    assert run.flength == 10
+
+
+def test_longest_run_none_fits():
+    assert planner.longest_run("test", 12, 24, 1, 100, **ESTIMATE) is None
+
+
+def test_fewest_ranks():
+    seconds_left = wall_seconds(10, 3) + planner.PLOT_MARGIN_SECONDS
+    run = planner.fewest_ranks("test", 12, 10, 6, seconds_left, **ESTIMATE)
+    assert run.ranks == 3
+
+
+def test_fewest_ranks_none_fit():
+    seconds_left = wall_seconds(10, 7) + planner.PLOT_MARGIN_SECONDS
+    assert planner.fewest_ranks("test", 12, 10, 6, seconds_left, **ESTIMATE) is None
+
+
+def test_memory_limits_ranks():
+    run = planner.estimate("test", 12, 10, 4, **ESTIMATE)
+    assert planner.fits(run, 1e9, memory_mb=run.rank_memory_mb * 4)
+    assert not planner.fits(run, 1e9, memory_mb=run.rank_memory_mb * 3)
+
+
+@pytest.fixture
+def deadline(monkeypatch):
+    """Sets the seconds left before the next cycle, for a mesh and history
+    matching ESTIMATE"""
+    monkeypatch.setattr(planner, "mesh_size", lambda domain_name: SIZE)
+    monkeypatch.setattr(planner, "model_dt", lambda domain_name, res: DT)
+    monkeypatch.setattr(planner.perf_history, "read_history", lambda name: [])
+    monkeypatch.setattr(planner, "host_memory_mb", lambda: 1e6)
+
+    def set_seconds_left(seconds):
+        deadline = datetime.utcnow() + timedelta(seconds=seconds)
+        monkeypatch.setattr(planner, "cycle_deadline", lambda init_date: deadline)
+
+    return set_seconds_left
+
+
+def test_fit_deadline_keeps_length_that_fits(deadline):
+    deadline(3600 * 24)
+    assert run_mpas.fit_deadline("test", INIT_DATE, 12, 24, ranks=1) == 24
+
+
+def test_fit_deadline_shortens(deadline):
+    deadline(wall_seconds(10, 1) + planner.PLOT_MARGIN_SECONDS + 30)
+    assert run_mpas.fit_deadline("test", INIT_DATE, 12, 24, ranks=1) == 10
+
+
+def test_fit_deadline_refuses(deadline):
+    deadline(wall_seconds(10, 1) + planner.PLOT_MARGIN_SECONDS + 30)
+    with pytest.raises(RuntimeError):
+        run_mpas.fit_deadline("test", INIT_DATE, 12, 24, "refuse", ranks=1)
+
+
+def test_fit_deadline_nothing_fits(deadline):
+    deadline(60)
+    with pytest.raises(RuntimeError):
+        run_mpas.fit_deadline("test", INIT_DATE, 12, 24, ranks=1)
+
+
+def test_fit_deadline_ignored(deadline):
+    deadline(60)
+    assert run_mpas.fit_deadline("test", INIT_DATE, 12, 24, "ignore", ranks=1) == 24
+
+
+def recorded(tmp_path, flength, from_stage=None):
+    "Manifest of a run of INIT_DATE whose download had flength hours"
+    stages = manifest.Manifest(str(tmp_path / "manifest.json"), from_stage)
+    stages.data = {
+        "init_date": INIT_DATE.strftime(manifest.DATE_FORMAT),
+        "run_dir": str(tmp_path),
+        "stages": {"download": {"inputs": {"flength": flength}, "outputs": {}}},
+    }
+    return stages
+
+
+def test_new_cycle_is_fitted(tmp_path):
+    stages = recorded(tmp_path, 24)
+    next_cycle = INIT_DATE + timedelta(hours=6)
+    assert run_mpas.resumed_flength(stages, next_cycle, 24) is None
+
+
+def test_rerun_of_same_length_resumes(tmp_path):
+    assert run_mpas.resumed_flength(recorded(tmp_path, 24), INIT_DATE, 24) == 24
+
+
+def test_rerun_of_new_length_is_fitted(tmp_path):
+    assert run_mpas.resumed_flength(recorded(tmp_path, 24), INIT_DATE, 48) is None
+    assert run_mpas.resumed_flength(recorded(tmp_path, 24), INIT_DATE, 12) is None
+
+
+def test_from_stage_keeps_recorded_length(tmp_path):
+    stages = recorded(tmp_path, 24, from_stage="lbc")
+    assert run_mpas.resumed_flength(stages, INIT_DATE, 48) == 24
+    assert run_mpas.resumed_flength(stages, INIT_DATE, 12) == 12
+
+
+def test_from_stage_without_record(tmp_path):
+    stages = manifest.Manifest(str(tmp_path / "manifest.json"), "model")
+    assert run_mpas.resumed_flength(stages, INIT_DATE, 24) == 24
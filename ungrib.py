@@ -0,0 +1,150 @@
+"""Python replacement for ungrib.exe on the GFS GRIB2 files. Decodes the
+messages named in Vtable.GFS and writes the FILE:YYYY-MM-DD_HH intermediate
+files directly, one forecast hour per process"""
+
+import concurrent.futures
+from itertools import repeat
+import multiprocessing
+import os
+
+import grib2
+import intermediate
+import spans
+import vtable
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+WPS_DIR = intermediate.WPS_DIR
+MAP_SOURCE = "NCEP GFS"
+HDATE_FORMAT = "%Y-%m-%d_%H:%M:%S"
+INSTANTANEOUS_PRODUCT = 0
+
+
+def entry_matches(entry, field, isobaric_pa):
+    """True if the GRIB field is the one the Vtable entry describes.
+    isobaric_pa: Pressure levels (Pa) kept for wildcard isobaric entries"""
+    code = (entry.discipline, entry.category, entry.parameter)
+    if field.code not in vtable.equivalent_codes(code):
+        return False
+
+    level_type, value = field.first_surface
+    if level_type != entry.grib2_level:
+        return False
+
+    if level_type == vtable.ISOBARIC:
+        if entry.level1 is None:
+            return round(value, 2) in isobaric_pa
+        return round(value / 100, 2) == entry.level1
+    if level_type == vtable.HEIGHT_ABOVE_GROUND:
+        return value == entry.level1
+    if level_type == vtable.DEPTH_BELOW_GROUND:
+        # Vtable soil layers are in cm, GRIB2 in m
+        _, bottom = field.second_surface
+        if bottom is None:
+            return False
+        return (round(value * 100), round(bottom * 100)) == (
+            entry.level1,
+            entry.level2,
+        )
+
+    return True
+
+
+def slab_key(entry, field):
+    "(field name, xlvl) ungrib files the entry's data under"
+    _, value = field.first_surface
+    if entry.grib2_level == vtable.ISOBARIC:
+        return intermediate.FIELD_ALIASES.get(entry.name, entry.name), value
+    if entry.grib2_level == vtable.MEAN_SEA_LEVEL:
+        return entry.name, intermediate.SEA_LEVEL_XLVL
+    return entry.name, intermediate.SURFACE_XLVL
+
+
+def to_slab(entry, field, name, xlvl):
+    ni, nj, lat1, lon1, lat2, lon2, di, dj, scan_mode = field.grid()
+    # values() always returns rows south to north and columns west to east
+    startlon = lon2 if scan_mode & 0x80 else lon1
+    return intermediate.Slab(
+        hdate=field.valid_time().strftime(HDATE_FORMAT),
+        map_source=MAP_SOURCE,
+        field=name,
+        units=entry.units,
+        desc=entry.description,
+        xlvl=xlvl,
+        startloc="SWCORNER",
+        startlat=min(lat1, lat2),
+        startlon=startlon,
+        deltalat=dj,
+        deltalon=di,
+        values=field.values(),
+    )
+
+
+@spans.timed("ungrib", kind="python")
+def convert_grib(grib_fpath, out_dir, entries, nfglevels, prefix="FILE"):
+    """Writes the intermediate file for one GRIB2 file and returns its path.
+    Max wind and tropopause fields are skipped as check_intermediates treats
+    them as optional. When several Vtable entries fill the same field and
+    level the first one in the Vtable wins, as it would in ungrib"""
+    isobaric_pa = {round(mb * 100.0, 2) for mb in vtable.isobaric_levels(nfglevels)}
+
+    found = {}
+    valid_time = None
+    for field in grib2.fields(grib_fpath):
+        if field.product_template != INSTANTANEOUS_PRODUCT:
+            continue
+
+        for index, entry in enumerate(entries):
+            if entry.grib2_level in (vtable.MAX_WIND, vtable.TROPOPAUSE):
+                continue
+            if not entry_matches(entry, field, isobaric_pa):
+                continue
+
+            key = slab_key(entry, field)
+            if key not in found or index < found[key][0]:
+                found[key] = (index, to_slab(entry, field, *key))
+            valid_time = field.valid_time()
+            break
+
+    if valid_time is None:
+        raise RuntimeError(f"No Vtable fields in {grib_fpath}")
+
+    # Vtable order, then pressure levels from the surface up
+    slabs = [slab for _, slab in sorted(found.values(), key=_slab_order)]
+    fpath = f"{out_dir}/{prefix}:{valid_time:%Y-%m-%d_%H}"
+    intermediate.write_intermediate(fpath, slabs)
+    return fpath
+
+
+def _slab_order(item):
+    index, slab = item
+    return index, -slab.xlvl
+
+
+def pool_executor(workers=None):
+    """Process pool for convert_grib. Spawned rather than forked since the
+    callers run the downloads in threads"""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def convert_gribs(grib_fpaths, nfglevels, out_dir=WPS_DIR, entries=None, workers=None):
+    "Converts each forecast hour in its own process. Returns the FILE:* paths"
+    if entries is None:
+        entries = vtable.read_vtable()
+
+    workers = min(workers or os.cpu_count() or 1, len(grib_fpaths))
+    print(f"Converting {len(grib_fpaths)} GRIB files in {workers} processes")
+    with pool_executor(workers) as executor:
+        return list(
+            executor.map(
+                convert_grib,
+                grib_fpaths,
+                repeat(out_dir),
+                repeat(entries),
+                repeat(nfglevels),
+            )
+        )
@@ -0,0 +1,234 @@
+"""Reads the ungrib Variable Table to work out which GRIB messages WPS uses"""
+
+from collections import namedtuple
+import os
+import re
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+VTABLE_GFS = f"{ROOT_DIR}/tools/WPS-4.4/ungrib/Variable_Tables/Vtable.GFS"
+
+VtableEntry = namedtuple(
+    "VtableEntry",
+    [
+        "grib1_param",
+        "level_type",
+        "level1",
+        "level2",
+        "name",
+        "units",
+        "description",
+        "discipline",
+        "category",
+        "parameter",
+        "grib2_level",
+    ],
+)
+
+# wgrib2 abbreviations of the GRIB2 (discipline, category, parameter) codes
+# used by Vtable.GFS. Soil temperature is listed as TMP in the Vtable but
+# GFS encodes it as TSOIL
+GRIB2_NAMES = {
+    (0, 0, 0): {"TMP", "TSOIL"},
+    (0, 1, 0): {"SPFH"},
+    (0, 1, 1): {"RH"},
+    (0, 1, 11): {"SNOD"},
+    (0, 1, 13): {"WEASD"},
+    (0, 2, 2): {"UGRD"},
+    (0, 2, 3): {"VGRD"},
+    (0, 3, 0): {"PRES"},
+    (0, 3, 1): {"PRMSL"},
+    (0, 3, 5): {"HGT"},
+    (0, 3, 192): {"MSLET"},
+    (2, 0, 0): {"LAND"},
+    (2, 0, 192): {"SOILW"},
+    (2, 3, 18): {"TSOIL"},
+    (10, 2, 0): {"ICEC"},
+}
+
+ISOBARIC = 100
+SURFACE = 1
+MEAN_SEA_LEVEL = 101
+HEIGHT_ABOVE_GROUND = 103
+DEPTH_BELOW_GROUND = 106
+MAX_WIND = 6
+TROPOPAUSE = 7
+
+FIXED_LEVEL_NAMES = {
+    SURFACE: "surface",
+    MEAN_SEA_LEVEL: "mean sea level",
+    MAX_WIND: "max wind",
+    TROPOPAUSE: "tropopause",
+}
+
+ISOBARIC_LEVEL_RE = re.compile(r"^([\d.]+) mb$")
+
+
+def _to_int(s):
+    try:
+        return int(s)
+    except ValueError:
+        return None
+
+
+def read_vtable(fpath=VTABLE_GFS):
+    """Returns the GRIB2 entries of a Vtable. Level1 is None for the '*'
+    wildcard. Rows without GRIB2 codes are skipped"""
+    entries = []
+    with open(fpath) as f:
+        for line in f:
+            cols = [col.strip() for col in line.split("|")]
+            if len(cols) < 11 or not cols[0].isdigit():
+                continue
+
+            discipline, category, parameter, grib2_level = map(_to_int, cols[7:11])
+            if None in (discipline, category, parameter, grib2_level):
+                continue
+
+            level1 = None if cols[2] == "*" else _to_int(cols[2])
+            entries.append(
+                VtableEntry(
+                    grib1_param=int(cols[0]),
+                    level_type=_to_int(cols[1]),
+                    level1=level1,
+                    level2=_to_int(cols[3]),
+                    name=cols[4],
+                    units=cols[5],
+                    description=cols[6],
+                    discipline=discipline,
+                    category=category,
+                    parameter=parameter,
+                    grib2_level=grib2_level,
+                )
+            )
+
+    return entries
+
+
+def idx_level(entry):
+    """wgrib2 style level string of an entry. Returns None for every
+    isobaric level"""
+    if entry.grib2_level == ISOBARIC:
+        return None if entry.level1 is None else f"{entry.level1} mb"
+    if entry.grib2_level == HEIGHT_ABOVE_GROUND:
+        return f"{entry.level1} m above ground"
+    if entry.grib2_level == DEPTH_BELOW_GROUND:
+        # GRIB1 soil layers are in cm, wgrib2 prints meters
+        top = f"{entry.level1 / 100:g}"
+        bottom = f"{entry.level2 / 100:g}"
+        return f"{top}-{bottom} m below ground"
+    if entry.grib2_level in FIXED_LEVEL_NAMES:
+        return FIXED_LEVEL_NAMES[entry.grib2_level]
+
+    raise KeyError(f"Unsupported GRIB2 level type {entry.grib2_level}")
+
+
+def idx_keys(entries):
+    """Set of (wgrib2 name, level string) pairs ungrib reads. Level is None
+    when any isobaric level is wanted. Raises KeyError when an entry cannot
+    be mapped so callers can fall back to the full file"""
+    keys = set()
+    for entry in entries:
+        code = (entry.discipline, entry.category, entry.parameter)
+        if code not in GRIB2_NAMES:
+            raise KeyError(f"No wgrib2 name for GRIB2 code {code} ({entry.name})")
+
+        level = idx_level(entry)
+        for name in GRIB2_NAMES[code]:
+            keys.add((name, level))
+
+    return keys
+
+
+def idx_filter(entries):
+    """Returns a predicate telling whether an .idx record
+    (name, level, forecast) is needed by ungrib"""
+    keys = idx_keys(entries)
+
+    def keep(name, level, forecast):
+        # Averages and accumulations are never read by ungrib
+        if "ave" in forecast or "acc" in forecast:
+            return False
+        if (name, level) in keys:
+            return True
+        return (name, None) in keys and bool(ISOBARIC_LEVEL_RE.match(level))
+
+    return keep
+
+
+# Isobaric levels (mb) in the GFS 0.25 degree pgrb2 files, surface upwards
+GFS_ISOBARIC_LEVELS = [
+    1000,
+    975,
+    950,
+    925,
+    900,
+    850,
+    800,
+    750,
+    700,
+    650,
+    600,
+    550,
+    500,
+    450,
+    400,
+    350,
+    300,
+    250,
+    200,
+    150,
+    100,
+    70,
+    50,
+    40,
+    30,
+    20,
+    15,
+    10,
+    7,
+    5,
+    3,
+    2,
+    1,
+    0.7,
+    0.4,
+    0.2,
+    0.1,
+    0.07,
+    0.04,
+    0.02,
+    0.01,
+]
+
+
+def isobaric_levels(nfglevels):
+    """Isobaric levels init_atmosphere can hold. config_nfglevels counts the
+    surface level as well, so keep the lowest nfglevels - 1"""
+    return GFS_ISOBARIC_LEVELS[: nfglevels - 1]
+
+
+def filter_params(entries, nfglevels):
+    """var_* and lev_* parameters for the NOMADS filter CGI covering only the
+    fields and levels ungrib reads. The filter returns every combination of
+    the chosen variables and levels"""
+    params = {}
+    for name, level in sorted(idx_keys(entries), key=str):
+        params[f"var_{name}"] = "on"
+        if level is None:
+            for mb in isobaric_levels(nfglevels):
+                params[f"lev_{mb:g}_mb"] = "on"
+        else:
+            params[f"lev_{level.replace(' ', '_')}"] = "on"
+
+    return params
+
+
+def equivalent_codes(code):
+    """GRIB2 codes holding the same field as code, e.g. soil temperature is
+    (0, 0, 0) in the Vtable but (2, 3, 18) in GFS"""
+    names = GRIB2_NAMES.get(code, set())
+    equivalent = {
+        other for other, other_names in GRIB2_NAMES.items() if other_names & names
+    }
+    return equivalent | {code}
@@ -0,0 +1,109 @@
+"""Self contained run directories, one per (domain, cycle), so several runs
+can share the host instead of all rewriting the files in MPAS-Model"""
+
+import glob
+import os
+import shutil
+
+ROOT_DIR = os.environ["ROOT_DIR"]
+
+RUNS_DIR = f"{ROOT_DIR}/runs"
+CONF_DIR = f"{ROOT_DIR}/conf"
+MPAS_DIR = f"{ROOT_DIR}/MPAS-Model"
+STATIC_DIR = f"{ROOT_DIR}/data/static"
+PRODUCTS_DIR = f"{ROOT_DIR}/products/mpas"
+
+# Namelists and streams are copied since every run edits its own
+TEMPLATE_PATTERNS = ("namelist.*", "streams.*", "stream_list.*")
+EXECUTABLES = ("init_atmosphere_model", "atmosphere_model")
+# Physics lookup tables read by atmosphere_model
+TABLE_PATTERNS = ("*.TBL", "*.DBL", "RRTMG_*", "COMPATIBILITY")
+
+
+def static_path(domain_name):
+    "The domain's static file, data/static taking precedence over MPAS-Model"
+    for directory in (STATIC_DIR, MPAS_DIR):
+        fpath = f"{directory}/{domain_name}.static.nc"
+        if os.path.exists(fpath):
+            return fpath
+    return f"{MPAS_DIR}/{domain_name}.static.nc"
+
+
+def _template_files(domain_name):
+    "Namelist and stream files from conf/<domain>, else from MPAS-Model"
+    conf_dir = f"{CONF_DIR}/{domain_name}"
+    directory = conf_dir if os.path.isdir(conf_dir) else MPAS_DIR
+    fpaths = []
+    for pattern in TEMPLATE_PATTERNS:
+        fpaths += glob.glob(f"{directory}/{pattern}")
+    return sorted(fpath for fpath in fpaths if os.path.isfile(fpath))
+
+
+def _shared_files(domain_name):
+    "Executables, tables and static files linked rather than copied"
+    fpaths = [f"{MPAS_DIR}/{name}" for name in EXECUTABLES]
+    for pattern in TABLE_PATTERNS:
+        fpaths += glob.glob(f"{MPAS_DIR}/{pattern}")
+
+    fpaths.append(static_path(domain_name))
+    partitions = {}
+    for directory in (MPAS_DIR, STATIC_DIR):
+        for fpath in glob.glob(f"{directory}/{domain_name}.graph.info*"):
+            partitions[os.path.basename(fpath)] = fpath
+    fpaths += partitions.values()
+
+    return [fpath for fpath in fpaths if os.path.exists(fpath)]
+
+
+class Workspace:
+    """runs/<domain>/<YYYYMMDDHH> holding everything init_atmosphere and
+    atmosphere_model read and write for one cycle. wps/ receives the
+    intermediate files"""
+
+    def __init__(self, domain_name, init_date, runs_dir=RUNS_DIR):
+        self.domain_name = domain_name
+        self.init_date = init_date
+        self.path = f"{runs_dir}/{domain_name}/{init_date:%Y%m%d%H}"
+        self.wps_dir = f"{self.path}/wps"
+
+    def create(self):
+        "Builds the directory from scratch, replacing any earlier attempt"
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.wps_dir)
+
+        for fpath in _template_files(self.domain_name):
+            shutil.copyfile(fpath, f"{self.path}/{os.path.basename(fpath)}")
+        for fpath in _shared_files(self.domain_name):
+            os.symlink(
+                os.path.realpath(fpath), f"{self.path}/{os.path.basename(fpath)}"
+            )
+
+        print("Workspace", self.path)
+        return self
+
+    def open(self):
+        "Reuses the directory of an earlier attempt at this cycle if there is one"
+        if not os.path.isdir(self.path):
+            return self.create()
+        print("Reusing workspace", self.path)
+        return self
+
+    def products_dir(self):
+        return f"{PRODUCTS_DIR}/{self.domain_name}"
+
+    def collect_products(self):
+        "Moves the diag files into products/mpas/<domain>"
+        dest = self.products_dir()
+        os.makedirs(dest, exist_ok=True)
+        for fpath in sorted(glob.glob(f"{self.path}/diag*")):
+            os.replace(fpath, f"{dest}/{os.path.basename(fpath)}")
+        return dest
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+def cycle_dir(init_date, runs_dir=RUNS_DIR):
+    "Intermediate files shared by every domain run off one cycle"
+    return f"{runs_dir}/cycles/{init_date:%Y%m%d%H}"